@@ -1,26 +1,66 @@
 """
 Afya Medical EHR System - Local Deployment Version
 Updated with proper environment variable handling
+
+Workers build the app with create_app(). Creating tables and sample data
+is a one-shot step run once per deploy: flask --app app init-db
 """
 
 import os
+import io
+import csv
+import json
+import hmac
 import hashlib
-from datetime import datetime
+import click
+import logging
+import migrations
+from datetime import datetime, date
 from dotenv import load_dotenv
 from session_manager import SessionManager
-from medical_menu import MedicalMenu
-from flask import Flask, make_response, request, flash, url_for, redirect, render_template, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from redis_client import get_redis, pool_stats
+from medical_menu import MedicalMenu, MENU_ROUTES
+from ussd_router import MenuRouter
+from ussd_engine import SessionEngine
+from audit_log import AuditLogger
+from provider_auth import ProviderAuthenticator
+from pagination import keyset_page, Page
+from stats import ListStats
+from counters import SystemCounters
+from dashboard import DashboardSnapshot
+from patient_summary import PatientSummaries
+from emergency_cards import EmergencyCards
+from facility_index import FacilityIndex, geocode
+from search_index import SearchIndex
+from db_routing import DatabaseRouter, primary, engine_options, replica_binds
+from db_routing import database_url as database_url_for
+from sqlite_mode import SqliteMode, PRAGMAS as SQLITE_PRAGMAS, is_sqlite
+from write_queue import WriteQueue
+from sms_queue import SmsQueue, SmsDispatcher
+from request_stats import RequestStats
+from metrics import Metrics
+from structured_log import StructuredLogging
+from bulk_import import PatientImporter, read_rows, detect_format, load_checkpoint
+import export
+from models import (db, HealthcareFacility, HealthcareProvider, Patient,
+                    MedicalRecord, SystemLog, SystemCounter)
+from flask import Flask, Blueprint, Response, current_app, make_response, request, flash, url_for, redirect, render_template, jsonify, stream_with_context
+from sqlalchemy import text as sql_text, or_
+from sqlalchemy.orm import joinedload
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = Flask(__name__)
+log = logging.getLogger('afya.http')
+ussd_log = logging.getLogger('afya.ussd')
+
+# Routes, template filters and CLI commands; registered by create_app()
+main = Blueprint('main', __name__, cli_group=None)
 
 # Configuration for local deployment
 
 
-def configure_app():
+def configure_app(app):
     """Configure app for local deployment with environment variables"""
 
     # Load configuration from environment variables
@@ -33,114 +73,252 @@ def configure_app():
     database_url = os.environ.get('DATABASE_URL')
 
     if database_url:
-        # Handle PostgreSQL URL formats
-        if database_url.startswith('postgres://'):
-            database_url = database_url.replace(
-                'postgres://', 'postgresql://', 1)
-        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-        print(f"🐘 Using PostgreSQL database")
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url_for(database_url)
     else:
         # Fallback to SQLite for development
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///afya_medical.sqlite3'
-        print("🗃️ Using SQLite database (fallback)")
 
-    # Environment detection
+    # Connection pools, per worker process and per database: DB_POOL_SIZE
+    # kept open plus DB_MAX_OVERFLOW extra under load, DB_POOL_TIMEOUT
+    # seconds to wait for one, pre-ping to drop connections the server
+    # closed, and DB_POOL_RECYCLE seconds before a proxy's idle timeout
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        pre_ping=os.environ.get('DB_POOL_PRE_PING', 'True').lower() == 'true')
+
+    # Read replicas (comma separated URLs) take read-only queries; see
+    # db_routing.py. A browser reads the primary for REPLICA_STICKY_SECONDS
+    # after writing, and a replica that fails is skipped for
+    # REPLICA_RETRY_SECONDS.
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(
+        os.environ.get('DATABASE_REPLICA_URLS', ''), app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    app.config['REPLICA_STICKY_SECONDS'] = float(
+        os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    app.config['REPLICA_RETRY_SECONDS'] = float(
+        os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+    # SQLite production mode, on whenever the database is SQLite: WAL and
+    # tuned pragmas on every connection (SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE,
+    # ... override them; see sqlite_mode.py), and small writes group-committed
+    # by one writer per process, up to WRITE_BATCH_SIZE per commit gathered
+    # within WRITE_BATCH_WAIT seconds (write_queue.py)
+    app.config['SQLITE_MODE'] = is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']) and \
+        os.environ.get('SQLITE_MODE', 'True').lower() == 'true'
+    app.config['SQLITE_PRAGMAS'] = {
+        name: os.environ[f"SQLITE_{name.upper()}"] for name in SQLITE_PRAGMAS
+        if os.environ.get(f"SQLITE_{name.upper()}")}
+    app.config['WRITE_QUEUE_ENABLED'] = os.environ.get(
+        'WRITE_QUEUE_ENABLED', str(app.config['SQLITE_MODE'])).lower() == 'true'
+    app.config['WRITE_BATCH_SIZE'] = int(os.environ.get('WRITE_BATCH_SIZE', 100))
+    app.config['WRITE_BATCH_WAIT'] = float(
+        os.environ.get('WRITE_BATCH_WAIT', 0.002))
+
+    # Audit log write-behind settings
+    app.config['AUDIT_QUEUE_SIZE'] = int(
+        os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+    app.config['AUDIT_BATCH_SIZE'] = int(
+        os.environ.get('AUDIT_BATCH_SIZE', 200))
+    app.config['AUDIT_FLUSH_INTERVAL'] = float(
+        os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))
+    app.config['AUDIT_OVERFLOW_POLICY'] = os.environ.get(
+        'AUDIT_OVERFLOW_POLICY', 'drop_oldest')
+
+    # Seconds between counter reconcile passes (0 disables them)
+    app.config['COUNTERS_RECONCILE_INTERVAL'] = int(
+        os.environ.get('COUNTERS_RECONCILE_INTERVAL', 300))
+
+    # List page sizes; ?limit= may ask for up to LIST_MAX_PAGE_SIZE rows
+    app.config['LIST_PAGE_SIZE'] = int(os.environ.get('LIST_PAGE_SIZE', 25))
+    app.config['LIST_MAX_PAGE_SIZE'] = int(
+        os.environ.get('LIST_MAX_PAGE_SIZE', 100))
+
+    # Bulk patient import; the HTTP endpoint is off unless a token is set
+    app.config['IMPORT_CHUNK_SIZE'] = int(
+        os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+    app.config['IMPORT_API_TOKEN'] = os.environ.get('IMPORT_API_TOKEN')
+
+    # Records export endpoint, likewise off unless a token is set
+    app.config['EXPORT_API_TOKEN'] = os.environ.get('EXPORT_API_TOKEN')
+
+    # Patient and provider search endpoint, likewise off unless a token is set
+    app.config['SEARCH_API_TOKEN'] = os.environ.get('SEARCH_API_TOKEN')
+
+    # Outbound SMS: gateway (console, africastalking, twilio) and dispatcher
+    # settings; SMS_RATE_LIMIT (messages/s) defaults to the gateway's own limit
+    app.config['SMS_GATEWAY'] = os.environ.get('SMS_GATEWAY', 'console')
+    app.config['SMS_GATEWAY_URL'] = os.environ.get('SMS_GATEWAY_URL')
+    app.config['SMS_WORKER_THREADS'] = int(
+        os.environ.get('SMS_WORKER_THREADS', 4))
+    app.config['SMS_BATCH_SIZE'] = int(os.environ.get('SMS_BATCH_SIZE', 200))
+    app.config['SMS_BULK_SIZE'] = int(os.environ.get('SMS_BULK_SIZE', 0)) or None
+    app.config['SMS_RATE_LIMIT'] = float(
+        os.environ.get('SMS_RATE_LIMIT', 0)) or None
+    app.config['SMS_MAX_ATTEMPTS'] = int(os.environ.get('SMS_MAX_ATTEMPTS', 5))
+    app.config['SMS_RETRY_BASE'] = float(os.environ.get('SMS_RETRY_BASE', 5))
+    app.config['SMS_RETRY_MAX'] = float(os.environ.get('SMS_RETRY_MAX', 600))
+    # Shared secret for /sms/delivery-report?token=...; unset refuses reports
+    app.config['SMS_CALLBACK_TOKEN'] = os.environ.get('SMS_CALLBACK_TOKEN')
+
+    # Prometheus metrics at /metrics; workers share totals through Redis
+    app.config['METRICS_ENABLED'] = os.environ.get(
+        'METRICS_ENABLED', 'True').lower() == 'true'
+    app.config['METRICS_FLUSH_INTERVAL'] = int(
+        os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+    # Emergency info cards: served fresh for EMERGENCY_CARD_FRESH seconds,
+    # then stale while a background refresh runs; a hop waits at most
+    # EMERGENCY_CARD_BUDGET seconds for a card that is not cached yet
+    app.config['EMERGENCY_CARD_FRESH'] = int(
+        os.environ.get('EMERGENCY_CARD_FRESH', 300))
+    app.config['EMERGENCY_CARD_TTL'] = int(
+        os.environ.get('EMERGENCY_CARD_TTL', 30 * 86400))
+    app.config['EMERGENCY_CARD_BUDGET'] = float(
+        os.environ.get('EMERGENCY_CARD_BUDGET', 0.5))
+    app.config['EMERGENCY_CARD_THREADS'] = int(
+        os.environ.get('EMERGENCY_CARD_THREADS', 2))
+
+    # Nearest facilities: seconds between checks for other workers' facility
+    # changes, and where callers without a fixed-line area code are placed
+    app.config['FACILITY_INDEX_INTERVAL'] = int(
+        os.environ.get('FACILITY_INDEX_INTERVAL', 5))
+    app.config['FACILITY_DEFAULT_PLACE'] = os.environ.get(
+        'FACILITY_DEFAULT_PLACE', 'accra').lower()
+
+    # Patient and provider search: seconds between checks for other workers'
+    # changes, and the most results /api/search returns
+    app.config['SEARCH_INDEX_INTERVAL'] = int(
+        os.environ.get('SEARCH_INDEX_INTERVAL', 5))
+    app.config['SEARCH_MAX_RESULTS'] = int(
+        os.environ.get('SEARCH_MAX_RESULTS', 20))
+
+    # X-Afya-Queries / -Redis / -Time-Ms response headers, for load tests
+    app.config['REQUEST_STATS_HEADERS'] = os.environ.get(
+        'REQUEST_STATS_HEADERS', 'False').lower() == 'true'
+
+    # Structured logging: JSON on stdout, phones hashed with LOG_HASH_KEY
+    # (SECRET_KEY if unset). LOG_SAMPLING is e.g. "afya.ussd=0.1"; levels
+    # and rates can be changed at runtime with flask log-level.
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    app.config['LOG_SAMPLING'] = os.environ.get('LOG_SAMPLING', '')
+    app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    app.config['LOG_HASH_KEY'] = os.environ.get('LOG_HASH_KEY')
+    app.config['LOG_CONTROL_INTERVAL'] = int(
+        os.environ.get('LOG_CONTROL_INTERVAL', 10))
+    app.config['LOG_ADMIN_TOKEN'] = os.environ.get('LOG_ADMIN_TOKEN')
+
+    # Compile every template in create_app() instead of on first use
+    app.config['WARM_TEMPLATES'] = os.environ.get(
+        'WARM_TEMPLATES', 'True').lower() == 'true'
+
+    # One line per process; the default SECRET_KEY is the one worth shouting about
     env = os.environ.get('FLASK_ENV', 'development')
-    port = int(os.environ.get('PORT', 5000))
+    database = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+    replicas = len(app.config['SQLALCHEMY_BINDS'])
+    if replicas:
+        database += f" + {replicas} replica{'s' if replicas > 1 else ''}"
+    print(f"🚀 Afya {env}: {database}, "
+          f"Redis {'set' if os.environ.get('REDIS_URL') else 'not set'}"
+          + ("" if os.environ.get('SECRET_KEY') else ", ⚠️ default SECRET_KEY"))
 
-    print(f"🚀 Running in {env} mode on port {port}")
 
-    # Print loaded environment variables (safely)
-    print("📋 Environment variables loaded:")
-    print(
-        f"   - SECRET_KEY: {'✓ Set' if app.config['SECRET_KEY'] != 'dev-secret-key-change-in-production' else '⚠️ Using default'}")
-    print(
-        f"   - DATABASE_URL: {'✓ Set' if database_url else '⚠️ Using SQLite'}")
-    print(
-        f"   - REDIS_URL: {'✓ Set' if os.environ.get('REDIS_URL') else '⚠️ Not set'}")
-    print(
-        f"   - AFRICASTALKING_API_KEY: {'✓ Set' if os.environ.get('AFRICASTALKING_API_KEY') else '⚠️ Not set'}")
-    print(
-        f"   - TWILIO_ACCOUNT_SID: {'✓ Set' if os.environ.get('TWILIO_ACCOUNT_SID') else '⚠️ Not set'}")
+session = SessionManager()
+db_router = DatabaseRouter(db)
+sqlite_mode = SqliteMode(db)
+write_queue = WriteQueue()
+provider_auth = ProviderAuthenticator()
+sms_queue = SmsQueue()
+patient_summaries = PatientSummaries(db)
+emergency_cards = EmergencyCards(db)
+facility_index = FacilityIndex(db)
+search_index = SearchIndex(db)
+medical_menu = MedicalMenu(session, provider_auth, sms_queue, patient_summaries,
+                           emergency_cards, facility_index, search_index)
+ussd_router = MenuRouter(MENU_ROUTES, medical_menu)
+ussd_engine = SessionEngine(session, ussd_router, medical_menu.authenticate_provider,
+                            medical_menu.login_failed_menu)
+
+audit_log = AuditLogger()
+system_counters = SystemCounters()
+list_stats = ListStats(db, system_counters)
+dashboard = DashboardSnapshot(db, system_counters)
+request_stats = RequestStats()
+metrics = Metrics()
+structured_logging = StructuredLogging()
+
+
+def create_app():
+    """Application factory used by gunicorn, the flask CLI and app.py itself
+
+    Nothing here touches the database or Redis, so it is cheap enough to
+    run in every worker, or once in the gunicorn master with preload_app.
+    """
+    app = Flask(__name__)
+    configure_app(app)
+    structured_logging.init_app(app)
+
+    db.init_app(app)
+    db_router.init_app(app)
+    sqlite_mode.init_app(app)
+    write_queue.init_app(app, db)
+    audit_log.init_app(app, db, SystemLog, write_queue)
+    system_counters.init_app(app, db, SystemCounter)
+    sms_queue.init_app(app)
+    ussd_engine.init_app(app)
+    request_stats.init_app(app)
+    metrics.init_app(app, ussd_router)
+    metrics.collect(db_router.metrics)
+    emergency_cards.init_app(app, metrics)
+    facility_index.init_app(app)
+    search_index.init_app(app)
+    app.register_blueprint(main)
+
+    if app.config['WARM_TEMPLATES']:
+        warm_templates(app)
+    return app
+
+
+def warm_templates(app):
+    """Compile every template into the Jinja cache"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_worker(app):
+    """Open this worker's connections and prime shared caches before serving"""
+    with app.app_context():
+        # Connections inherited from a preloading master must not be reused
+        db_router.dispose()
+        try:
+            db.session.execute(sql_text("SELECT 1"))
+            system_counters.totals()
+            dashboard.get()
+        except Exception as e:
+            log.warning("Worker warm-up error: %s", e)
+        finally:
+            db.session.remove()
 
+        # Emergency card refreshes run on their own threads; connect them up front
+        emergency_cards.start()
+        try:
+            facility_index.start()
+        except Exception as e:
+            log.warning("Facility index warm-up error: %s", e)
+        try:
+            search_index.start()
+        except Exception as e:
+            log.warning("Search index warm-up error: %s", e)
 
-# Configure the app
-configure_app()
+        if os.environ.get('REDIS_URL'):
+            try:
+                get_redis().ping()
+            except Exception as e:
+                log.warning("Worker warm-up Redis error: %s", e)
 
-db = SQLAlchemy(app)
-session = SessionManager()
-medical_menu = MedicalMenu(session)
-
-# Database Models (Same as before)
-
-
-class HealthcareFacility(db.Model):
-    """Healthcare Facility Model"""
-    id = db.Column('facility_id', db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    facility_type = db.Column(db.String(50))
-    location = db.Column(db.String(100))
-    phone = db.Column(db.String(15))
-    registration_date = db.Column(db.String(20))
-    is_active = db.Column(db.Boolean, default=True)
-
-
-class HealthcareProvider(db.Model):
-    """Healthcare Provider Model"""
-    id = db.Column('provider_id', db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    phone = db.Column(db.String(15), unique=True, nullable=False)
-    specialization = db.Column(db.String(100))
-    facility_id = db.Column(db.Integer, db.ForeignKey(
-        'healthcare_facility.facility_id'))
-    pin = db.Column(db.String(64))  # Hashed PIN
-    registration_date = db.Column(db.String(20))
-    is_active = db.Column(db.Boolean, default=True)
-
-    facility = db.relationship('HealthcareFacility', backref='providers')
-
-
-class Patient(db.Model):
-    """Patient Model"""
-    id = db.Column('patient_id', db.Integer, primary_key=True)
-    phone = db.Column(db.String(15), unique=True, nullable=False)
-    name = db.Column(db.String(100), nullable=False)
-    date_of_birth = db.Column(db.String(10))
-    gender = db.Column(db.String(10))
-    blood_type = db.Column(db.String(5))
-    allergies = db.Column(db.Text)
-    emergency_contact = db.Column(db.String(15))
-    registration_date = db.Column(db.String(20))
-    is_active = db.Column(db.Boolean, default=True)
-
-
-class MedicalRecord(db.Model):
-    """Medical Record Model"""
-    id = db.Column('record_id', db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey(
-        'patient.patient_id'), nullable=False)
-    provider_id = db.Column(db.Integer, db.ForeignKey(
-        'healthcare_provider.provider_id'), nullable=False)
-    facility_id = db.Column(db.Integer, db.ForeignKey(
-        'healthcare_facility.facility_id'), nullable=False)
-    visit_date = db.Column(db.String(20), nullable=False)
-    chief_complaint = db.Column(db.Text)
-    diagnosis = db.Column(db.Text)
-    treatment_plan = db.Column(db.Text)
-    notes = db.Column(db.Text)
-
-    patient = db.relationship('Patient', backref='medical_records')
-    provider = db.relationship('HealthcareProvider', backref='medical_records')
-    facility = db.relationship('HealthcareFacility', backref='medical_records')
-
-
-class SystemLog(db.Model):
-    """System Activity Logs"""
-    id = db.Column('log_id', db.Integer, primary_key=True)
-    timestamp = db.Column(db.String(30), nullable=False)
-    user_phone = db.Column(db.String(15))
-    action = db.Column(db.String(100), nullable=False)
-    details = db.Column(db.Text)
 
 # Helper Functions
 
@@ -167,21 +345,23 @@ def hash_pin(pin):
     return hashlib.sha256(pin.encode()).hexdigest()
 
 
+@main.app_template_filter('display_date')
+def display_date(value, fmt='%d/%m/%y %H:%M:%S'):
+    """Render a date or datetime in the format the text columns used"""
+    if not value:
+        return ''
+    return value.strftime(fmt)
+
+
 def log_activity(user_phone, action, details=None):
-    """Log system activities with error handling"""
+    """Queue a system activity log; written in batches by the audit logger"""
     try:
-        log = SystemLog(
-            timestamp=datetime.now().strftime('%d/%m/%y %H:%M:%S.%f'),
-            user_phone=user_phone,
-            action=action,
-            details=details
-        )
-        db.session.add(log)
-        db.session.commit()
-    except Exception as e:
-        print(f"Logging error: {e}")
+        audit_log.log(user_phone, action, details)
+    except Exception:
+        log.exception("Audit logging error")
 
 
+@primary()
 def init_db():
     """Initialize database with comprehensive sample data"""
     try:
@@ -199,25 +379,26 @@ def init_db():
                     facility_type="Health Center",
                     location="Accra Central",
                     phone="0501234567",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 HealthcareFacility(
                     name="Ridge Hospital",
                     facility_type="Hospital",
                     location="Ridge, Accra",
                     phone="0302776481",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 HealthcareFacility(
                     name="Kumasi Health Center",
                     facility_type="Health Center",
                     location="Kumasi Central",
                     phone="0322022308",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 )
             ]
 
             for facility in facilities:
+                facility.latitude, facility.longitude = geocode(facility.location)
                 db.session.add(facility)
 
             db.session.commit()
@@ -230,7 +411,7 @@ def init_db():
                     specialization="General Medicine",
                     facility_id=1,
                     pin=hash_pin("1234"),
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 HealthcareProvider(
                     name="Dr. Ama Mensah",
@@ -238,7 +419,7 @@ def init_db():
                     specialization="Pediatrics",
                     facility_id=2,
                     pin=hash_pin("5678"),
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 HealthcareProvider(
                     name="Dr. Kofi Boateng",
@@ -246,7 +427,7 @@ def init_db():
                     specialization="Internal Medicine",
                     facility_id=3,
                     pin=hash_pin("9012"),
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 )
             ]
 
@@ -265,7 +446,7 @@ def init_db():
                     blood_type="O+",
                     allergies="None known",
                     emergency_contact="0200987654",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 Patient(
                     phone="0240234567",
@@ -275,7 +456,7 @@ def init_db():
                     blood_type="A+",
                     allergies="Penicillin",
                     emergency_contact="0240876543",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 Patient(
                     phone="0260345678",
@@ -285,7 +466,7 @@ def init_db():
                     blood_type="B+",
                     allergies="None known",
                     emergency_contact="0260765432",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 ),
                 Patient(
                     phone="0270456789",
@@ -295,7 +476,7 @@ def init_db():
                     blood_type="AB+",
                     allergies="Shellfish",
                     emergency_contact="0270654321",
-                    registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
+                    registration_date=datetime.now()
                 )
             ]
 
@@ -310,7 +491,7 @@ def init_db():
                     patient_id=1,
                     provider_id=1,
                     facility_id=1,
-                    visit_date=datetime.now().strftime('%d/%m/%y'),
+                    visit_date=date.today(),
                     chief_complaint="General checkup",
                     diagnosis="Healthy - routine examination",
                     treatment_plan="Continue healthy lifestyle",
@@ -320,7 +501,7 @@ def init_db():
                     patient_id=2,
                     provider_id=2,
                     facility_id=2,
-                    visit_date=datetime.now().strftime('%d/%m/%y'),
+                    visit_date=date.today(),
                     chief_complaint="Headache and fever",
                     diagnosis="Viral infection",
                     treatment_plan="Rest, fluids, paracetamol",
@@ -330,7 +511,7 @@ def init_db():
                     patient_id=3,
                     provider_id=3,
                     facility_id=3,
-                    visit_date=datetime.now().strftime('%d/%m/%y'),
+                    visit_date=date.today(),
                     chief_complaint="Follow-up for hypertension",
                     diagnosis="Hypertension - controlled",
                     treatment_plan="Continue current medication",
@@ -351,6 +532,11 @@ def init_db():
             print(f"   - {len(medical_records)} medical records")
             print("🔑 Demo provider PINs: 1234, 5678, 9012")
 
+        # Seed the counters once for databases that predate them
+        if SystemCounter.query.first() is None:
+            system_counters.reconcile()
+            print("🔢 System counters seeded")
+
     except Exception as e:
         print(f"❌ Database initialization error: {e}")
         return False
@@ -360,17 +546,13 @@ def init_db():
 # Routes
 
 
-@app.route('/', methods=['GET'])
+@main.route('/', methods=['GET'])
 def index():
     """Main dashboard with error handling"""
     try:
-        return render_template('dashboard.html',
-                               total_patients=Patient.query.count(),
-                               total_providers=HealthcareProvider.query.count(),
-                               total_facilities=HealthcareFacility.query.count(),
-                               recent_records=MedicalRecord.query.order_by(MedicalRecord.id.desc()).limit(5).all())
+        return render_template('dashboard.html', **dashboard.get())
     except Exception as e:
-        print(f"Dashboard error: {e}")
+        log.exception("Dashboard error")
         return f"""
         <div style="font-family: Arial; padding: 20px; background: #f8f9fa; min-height: 100vh;">
             <h2>🏥 Afya Medical EHR</h2>
@@ -390,7 +572,7 @@ def index():
         """
 
 
-@app.route('/ussd/callback', methods=['POST', 'GET'])
+@main.route('/ussd/callback', methods=['POST', 'GET'])
 def ussd_callback():
     """Enhanced USSD callback optimized for basic phones"""
     try:
@@ -400,35 +582,23 @@ def ussd_callback():
         phone_number = sanitize_phone(request.values.get("phoneNumber", None))
         text = request.values.get("text", '')
 
-        print(f"📱 USSD Request: SessionID={session_id}, Service={service_code}, Phone={phone_number}, Text='{text}'")
+        ussd_log.info("USSD request", extra={
+            'session': session_id, 'service': service_code,
+            'phone': phone_number, 'text': text})
 
-        # Log the USSD interaction
+        # Log the USSD interaction; the text carries PINs and patient phones
         log_activity(
             phone_number, 
-            f"USSD_Access: {text}", 
+            f"USSD_Access: {structured_logging.redact_text(text)}", 
             f"Service: {service_code}"
         )
 
-        # Handle empty text (initial USSD dial) - optimized for basic phones
-        if text == '':
-            return medical_menu.main_menu(session_id, phone_number)
-
-        # Route based on user selection - simplified for basic phones
-        if text == '1':
-            return medical_menu.provider_login_menu(session_id, phone_number)
-        elif text == '2':
-            return medical_menu.patient_services_menu(session_id, phone_number)
-        elif text == '3':
-            return medical_menu.emergency_services_menu(session_id, phone_number)
-        elif text == '4':
-            return medical_menu.system_info_menu(session_id, phone_number)
-        elif len(text.split('*')) > 1:
-            return medical_menu.handle_multi_level_menu(text, session_id, phone_number)
-        else:
-            return medical_menu.invalid_selection(session_id)
+        # Advance the session by the input added since its last hop
+        return ussd_engine.handle(session_id, phone_number, text)
 
     except Exception as e:
-        print(f"❌ USSD callback error: {e}")
+        ussd_log.exception("USSD callback error")
+        metrics.error('ussd')
         return make_response(
             f"END System error.\nPlease try again.\nDial *714# to restart.",
             200,
@@ -438,53 +608,58 @@ def ussd_callback():
 # Web Dashboard Routes
 
 
-@app.route('/register-facility', methods=['GET', 'POST'])
+@main.route('/register-facility', methods=['GET', 'POST'])
 def register_facility():
     """Register new healthcare facility"""
     if request.method == 'POST':
         try:
-            facility = HealthcareFacility(
+            # Coordinates from the form, else from the town named in the location
+            point = geocode(request.form['location'])
+            if request.form.get('latitude') and request.form.get('longitude'):
+                point = (float(request.form['latitude']), float(request.form['longitude']))
+                if not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+                    raise ValueError("Coordinates out of range")
+
+            write_queue.run(db.session.add, HealthcareFacility(
                 name=request.form['name'],
                 facility_type=request.form.get('facility_type', 'Clinic'),
                 location=request.form['location'],
+                latitude=point[0] if point else None,
+                longitude=point[1] if point else None,
                 phone=sanitize_phone(request.form['phone']),
-                registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
-            )
-            db.session.add(facility)
-            db.session.commit()
+                registration_date=datetime.now()
+            ))
             flash('Healthcare facility registered successfully!')
             log_activity(
                 request.form['phone'], 'Facility_Registration', f"Facility: {request.form['name']}")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except Exception as e:
             flash(f'Error registering facility: {str(e)}')
 
     return render_template('register_facility.html')
 
 
-@app.route('/register-provider', methods=['GET', 'POST'])
+@main.route('/register-provider', methods=['GET', 'POST'])
 def register_provider():
     """Register new healthcare provider"""
     if request.method == 'POST':
         try:
             if len(request.form['pin']) != 4:
                 flash('PIN must be exactly 4 digits.')
-                return redirect(url_for('register_provider'))
+                return redirect(url_for('main.register_provider'))
 
-            provider = HealthcareProvider(
+            write_queue.run(db.session.add, HealthcareProvider(
                 name=request.form['name'],
                 phone=sanitize_phone(request.form['phone']),
                 specialization=request.form.get('specialization', 'General'),
                 facility_id=request.form.get('facility_id', 1),
                 pin=hash_pin(request.form['pin']),
-                registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S')
-            )
-            db.session.add(provider)
-            db.session.commit()
+                registration_date=datetime.now()
+            ))
             flash('Healthcare provider registered successfully!')
             log_activity(
                 request.form['phone'], 'Provider_Registration', f"Provider: {request.form['name']}")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except Exception as e:
             flash(f'Error registering provider: {str(e)}')
 
@@ -496,105 +671,199 @@ def register_provider():
     return render_template('register_provider.html', facilities=facilities)
 
 
-@app.route('/patients')
-def list_patients():
-    """List all patients"""
+def list_filters(*names):
+    """Non-empty list page filters from the query string"""
+    filters = {}
+    for name in names + ('limit',):
+        value = request.args.get(name, '').strip()
+        if value:
+            filters[name] = value
+    return filters
+
+
+def list_page_size(filters):
+    """Requested page size, clamped to the configured maximum"""
     try:
-        patients = Patient.query.filter_by(is_active=True).all()
-    except:
-        patients = []
-    return render_template('patients.html', patients=patients)
+        size = int(filters.get('limit', current_app.config['LIST_PAGE_SIZE']))
+    except ValueError:
+        size = current_app.config['LIST_PAGE_SIZE']
+    return max(1, min(size, current_app.config['LIST_MAX_PAGE_SIZE']))
 
-# ADD THESE ROUTES TO YOUR app.py FILE
-# Insert after your existing routes (around line 300-400)
 
+def render_list_page(template, page, filters, **context):
+    """Render a list page with its cursors in the template and a Link header"""
+    searching = any(name != 'limit' for name in filters)
+    response = make_response(render_template(
+        template, page=page, filters=filters, searching=searching, **context))
 
-@app.route('/providers')
+    links = []
+    if page.next_cursor:
+        links.append(f'<{url_for(request.endpoint, cursor=page.next_cursor, **filters)}>; rel="next"')
+    if page.prev_cursor:
+        links.append(f'<{url_for(request.endpoint, cursor=page.prev_cursor, **filters)}>; rel="prev"')
+    if links:
+        response.headers['Link'] = ', '.join(links)
+    return response
+
+
+@main.route('/patients')
+def list_patients():
+    """List patients, one page at a time"""
+    filters = list_filters('q', 'gender', 'blood_type')
+    page_size = list_page_size(filters)
+    try:
+        query = Patient.query.filter_by(is_active=True)
+        if 'q' in filters:
+            query = query.filter(or_(
+                Patient.name.icontains(filters['q'], autoescape=True),
+                Patient.phone.startswith(sanitize_phone(filters['q']), autoescape=True)))
+        if 'gender' in filters:
+            query = query.filter(Patient.gender == filters['gender'])
+        if 'blood_type' in filters:
+            query = query.filter(Patient.blood_type == filters['blood_type'])
+
+        page = keyset_page(query, [Patient.id],
+                           request.args.get('cursor'), page_size)
+        stats = list_stats.patients()
+    except Exception as e:
+        log.exception("Error loading patients")
+        page = Page([], page_size)
+        stats = {}
+    return render_list_page('patients.html', page, filters,
+                            patients=page.items, stats=stats)
+
+
+@main.route('/providers')
 def list_providers():
-    """List all healthcare providers"""
+    """List healthcare providers, one page at a time"""
+    filters = list_filters('q', 'specialization', 'facility')
     try:
-        providers = HealthcareProvider.query.filter_by(is_active=True).all()
-        return render_template('providers.html', providers=providers)
+        query = HealthcareProvider.query.options(
+            joinedload(HealthcareProvider.facility)).filter_by(is_active=True)
+        if 'q' in filters:
+            query = query.filter(or_(
+                HealthcareProvider.name.icontains(filters['q'], autoescape=True),
+                HealthcareProvider.phone.startswith(sanitize_phone(filters['q']), autoescape=True),
+                HealthcareProvider.specialization.icontains(filters['q'], autoescape=True)))
+        if 'specialization' in filters:
+            query = query.filter(
+                HealthcareProvider.specialization == filters['specialization'])
+        if filters.get('facility', '').isdigit():
+            query = query.filter(
+                HealthcareProvider.facility_id == int(filters['facility']))
+
+        page = keyset_page(query, [HealthcareProvider.id],
+                           request.args.get('cursor'), list_page_size(filters))
+        return render_list_page('providers.html', page, filters,
+                                providers=page.items,
+                                stats=list_stats.providers())
     except Exception as e:
-        print(f"Error loading providers: {e}")
+        log.exception("Error loading providers")
         flash(f'Error loading providers: {str(e)}', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
 
-@app.route('/facilities')
+@main.route('/facilities')
 def list_facilities():
-    """List all healthcare facilities"""
+    """List healthcare facilities, one page at a time"""
+    filters = list_filters('q', 'facility_type')
     try:
-        facilities = HealthcareFacility.query.filter_by(is_active=True).all()
-        return render_template('facilities.html', facilities=facilities)
+        query = HealthcareFacility.query.filter_by(is_active=True)
+        if 'q' in filters:
+            query = query.filter(or_(
+                HealthcareFacility.name.icontains(filters['q'], autoescape=True),
+                HealthcareFacility.location.icontains(filters['q'], autoescape=True),
+                HealthcareFacility.facility_type.icontains(filters['q'], autoescape=True)))
+        if 'facility_type' in filters:
+            query = query.filter(
+                HealthcareFacility.facility_type == filters['facility_type'])
+
+        page = keyset_page(query, [HealthcareFacility.id],
+                           request.args.get('cursor'), list_page_size(filters))
+        return render_list_page('facilities.html', page, filters,
+                                facilities=page.items,
+                                stats=list_stats.facilities(),
+                                facility_counts=list_stats.facility_counts(
+                                    [facility.id for facility in page.items]))
     except Exception as e:
-        print(f"Error loading facilities: {e}")
+        log.exception("Error loading facilities")
         flash(f'Error loading facilities: {str(e)}', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
 
-@app.route('/api/provider/<int:provider_id>/toggle-status', methods=['POST'])
+@main.route('/api/provider/<int:provider_id>/toggle-status', methods=['POST'])
 def toggle_provider_status(provider_id):
     """Toggle provider active/inactive status"""
-    try:
+    def toggle():
         provider = HealthcareProvider.query.get_or_404(provider_id)
         provider.is_active = not provider.is_active
-        db.session.commit()
+        return provider.name, provider.phone, provider.is_active
+
+    try:
+        name, phone, is_active = write_queue.run(toggle)
+        provider_auth.invalidate(phone)
 
         log_activity(
-            provider.phone,
+            phone,
             f"Status_Toggle",
-            f"Provider {provider.name} {'activated' if provider.is_active else 'deactivated'}"
+            f"Provider {name} {'activated' if is_active else 'deactivated'}"
         )
 
         return jsonify({
             'success': True,
-            'message': f"Provider {'activated' if provider.is_active else 'deactivated'} successfully",
-            'new_status': provider.is_active
+            'message': f"Provider {'activated' if is_active else 'deactivated'} successfully",
+            'new_status': is_active
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
-@app.route('/api/facility/<int:facility_id>/toggle-status', methods=['POST'])
+@main.route('/api/facility/<int:facility_id>/toggle-status', methods=['POST'])
 def toggle_facility_status(facility_id):
     """Toggle facility active/inactive status"""
-    try:
+    def toggle():
         facility = HealthcareFacility.query.get_or_404(facility_id)
         facility.is_active = not facility.is_active
-        db.session.commit()
+        return facility.name, facility.phone, facility.is_active
+
+    try:
+        name, phone, is_active = write_queue.run(toggle)
 
         log_activity(
-            facility.phone,
+            phone,
             f"Facility_Status_Toggle",
-            f"Facility {facility.name} {'activated' if facility.is_active else 'deactivated'}"
+            f"Facility {name} {'activated' if is_active else 'deactivated'}"
         )
 
         return jsonify({
             'success': True,
-            'message': f"Facility {'activated' if facility.is_active else 'deactivated'} successfully",
-            'new_status': facility.is_active
+            'message': f"Facility {'activated' if is_active else 'deactivated'} successfully",
+            'new_status': is_active
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
-@app.route('/api/provider/<int:provider_id>/reset-pin', methods=['POST'])
+@main.route('/api/provider/<int:provider_id>/reset-pin', methods=['POST'])
 def reset_provider_pin(provider_id):
     """Reset provider PIN"""
-    try:
-        provider = HealthcareProvider.query.get_or_404(provider_id)
+    # Generate a new random PIN
+    import random
+    new_pin = str(random.randint(1000, 9999))
 
-        # Generate a new random PIN
-        import random
-        new_pin = str(random.randint(1000, 9999))
+    def reset():
+        provider = HealthcareProvider.query.get_or_404(provider_id)
         provider.pin = hash_pin(new_pin)
-        db.session.commit()
+        return provider.name, provider.phone
+
+    try:
+        name, phone = write_queue.run(reset)
+        provider_auth.invalidate(phone)
 
         log_activity(
-            provider.phone,
+            phone,
             "PIN_Reset",
-            f"PIN reset for provider {provider.name}"
+            f"PIN reset for provider {name}"
         )
 
         return jsonify({
@@ -606,44 +875,70 @@ def reset_provider_pin(provider_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
-@app.route('/logs')
+@main.route('/logs')
 def system_logs():
-    """View system activity logs"""
+    """View system activity logs, newest first, one page at a time"""
+    filters = list_filters('q', 'phone')
+    page_size = list_page_size(filters)
     try:
-        logs = SystemLog.query.order_by(SystemLog.id.desc()).limit(100).all()
-    except:
-        logs = []
-    return render_template('system_logs.html', logs=logs)
+        # Rows the date migration could not parse have no timestamp to page by
+        query = SystemLog.query.filter(SystemLog.timestamp.isnot(None))
+        if 'q' in filters:
+            query = query.filter(or_(
+                SystemLog.action.icontains(filters['q'], autoescape=True),
+                SystemLog.details.icontains(filters['q'], autoescape=True)))
+        if 'phone' in filters:
+            query = query.filter(
+                SystemLog.user_phone == sanitize_phone(filters['phone']))
+
+        page = keyset_page(query, [SystemLog.timestamp, SystemLog.id],
+                           request.args.get('cursor'), page_size,
+                           descending=True)
+        stats = list_stats.logs()
+    except Exception as e:
+        log.exception("Error loading logs")
+        page = Page([], page_size)
+        stats = {}
+    return render_list_page('system_logs.html', page, filters,
+                            logs=page.items, stats=stats)
 
 
-@app.route('/health')
+@main.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
     try:
         # Test database connection
-        db.session.execute('SELECT 1')
+        with primary():
+            db.session.execute(sql_text("SELECT 1"))
 
-        # Test Redis connection if configured
+        # Test Redis connection if configured, reusing the shared pool
         redis_status = "not_configured"
         if os.environ.get('REDIS_URL'):
             try:
-                from redis import Redis
-                r = Redis.from_url(os.environ.get('REDIS_URL'))
-                r.ping()
+                get_redis().ping()
                 redis_status = "connected"
             except:
                 redis_status = "error"
 
+        totals = system_counters.totals()
+
         return jsonify({
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
             'version': '1.0.0',
             'database': 'connected',
             'redis': redis_status,
+            'redis_pool': pool_stats(),
+            'db_pools': db_router.pool_stats(),
+            'sqlite': sqlite_mode.status(),
+            'write_queue': write_queue.stats(),
             'environment': os.environ.get('FLASK_ENV', 'development'),
-            'total_patients': Patient.query.count(),
-            'total_providers': HealthcareProvider.query.count(),
-            'total_facilities': HealthcareFacility.query.count()
+            'audit_log': audit_log.stats(),
+            'counters': system_counters.stats(),
+            'sms': sms_queue.stats() if os.environ.get('REDIS_URL') else None,
+            'total_patients': totals['patients'],
+            'total_providers': totals['providers'],
+            'total_facilities': totals['facilities']
         }), 200
     except Exception as e:
         return jsonify({
@@ -653,7 +948,205 @@ def health_check():
         }), 500
 
 
-@app.route('/test-ussd', methods=['GET', 'POST'])
+@main.route('/admin/logging', methods=['GET', 'POST'])
+def admin_logging():
+    """Show or change log levels and sample rates in every worker
+
+    POST JSON: {"logger": "afya.ussd", "level": "DEBUG"},
+    {"logger": "afya.ussd", "sample_rate": 0.1} or {"reset": true}.
+    """
+    denied = check_api_token('LOG_ADMIN_TOKEN')
+    if denied:
+        return denied
+
+    if request.method == 'POST':
+        change = request.get_json(silent=True) or {}
+        try:
+            if change.get('reset'):
+                structured_logging.reset()
+            else:
+                logger = change.get('logger') or 'afya'
+                if not isinstance(logger, str):
+                    raise TypeError("logger must be a logger name")
+                if 'level' in change:
+                    structured_logging.set_level(logger, change['level'])
+                if 'sample_rate' in change:
+                    structured_logging.set_sample_rate(logger, change['sample_rate'])
+        except (ValueError, TypeError) as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify(dict(structured_logging.state(), success=True))
+
+
+@main.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for every live worker; needs METRICS_TOKEN if one is set"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return jsonify({'success': False, 'message': 'Invalid metrics token'}), 401
+    if not metrics.enabled:
+        return jsonify({'success': False, 'message': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def check_api_token(config_key):
+    """Error response unless the request carries the configured bearer token"""
+    token = current_app.config.get(config_key)
+    if not token:
+        return jsonify({'success': False, 'message': 'This API is disabled'}), 403
+
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({'success': False, 'message': 'Invalid API token'}), 401
+    return None
+
+
+@main.route('/api/patients/import', methods=['POST'])
+def import_patients():
+    """Stream a CSV or NDJSON patient file into the patient table
+
+    The response is NDJSON: one progress line per committed chunk, rejects
+    as they happen, and a final summary. To resume after a failure, send
+    the same file again with ?skip=<last_line> from the last progress line.
+    Like the export, runs past GUNICORN_TIMEOUT only on threaded workers.
+    """
+    denied = check_api_token('IMPORT_API_TOKEN')
+    if denied:
+        return denied
+
+    try:
+        skip = int(request.args.get('skip', 0))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'skip must be a line number'}), 400
+
+    fmt = request.args.get('format') or detect_format(None, request.content_type)
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    importer = PatientImporter(db, Patient, system_counters, audit_log,
+                               current_app.config['IMPORT_CHUNK_SIZE'], search_index)
+
+    def generate():
+        result = None
+        rejects = []
+        for result in importer.batches(
+                read_rows(stream, fmt), start_after=skip,
+                on_reject=lambda line, phone, reason: rejects.append(
+                    {'event': 'reject', 'line': line, 'phone': phone, 'reason': reason})):
+            for reject in rejects:
+                yield json.dumps(reject) + '\n'
+            rejects.clear()
+            yield json.dumps(dict(result.as_dict(max_rejects=0), event='progress')) + '\n'
+
+        summary = result.as_dict(max_rejects=0) if result else {'last_line': skip, 'read': 0}
+        yield json.dumps(dict(summary, event='done')) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@main.route('/api/records/export')
+def export_records():
+    """Stream medical records as CSV or NDJSON, gzipped when the client accepts it
+
+    Query parameters: format (csv|ndjson), facility, start and end
+    (YYYY-MM-DD, inclusive). Runs past GUNICORN_TIMEOUT only on threaded
+    workers (see gunicorn.conf.py); otherwise use `flask export-records`.
+    """
+    denied = check_api_token('EXPORT_API_TOKEN')
+    if denied:
+        return denied
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify({'success': False, 'message': 'format must be csv or ndjson'}), 400
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'start and end must be YYYY-MM-DD'}), 400
+
+    facility = request.args.get('facility', '')
+    facility_id = int(facility) if facility.isdigit() else None
+    if facility and (facility_id is None or db.session.get(HealthcareFacility, facility_id) is None):
+        return jsonify({'success': False, 'message': 'facility must be an existing facility id'}), 400
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    chunks = export.export_records(db.session, fmt, facility_id, start, end, compress)
+    response = Response(stream_with_context(chunks),
+                        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="medical_records.{fmt}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@main.route('/sms/delivery-report', methods=['POST'])
+def sms_delivery_report():
+    """Delivery report callback from the SMS gateway (Africa's Talking or Twilio)
+
+    The gateway is given the callback URL with ?token=<SMS_CALLBACK_TOKEN>;
+    without a configured token every report is refused.
+    """
+    token = current_app.config.get('SMS_CALLBACK_TOKEN')
+    if not token:
+        return jsonify({'success': False, 'message': 'Delivery reports are disabled'}), 403
+    if not hmac.compare_digest(request.args.get('token', '').encode(), token.encode()):
+        return jsonify({'success': False, 'message': 'Invalid token'}), 401
+
+    gateway_id = request.form.get('id') or request.form.get('MessageSid')
+    status = request.form.get('status') or request.form.get('MessageStatus')
+    if not gateway_id or not status:
+        return jsonify({'success': False, 'message': 'id and status are required'}), 400
+
+    error = request.form.get('failureReason') or request.form.get('ErrorCode')
+    message_id = sms_queue.record_delivery(gateway_id, status, error)
+    return jsonify({'success': True, 'message_id': message_id})
+
+
+@main.route('/api/search')
+def api_search():
+    """Ranked patient and provider matches for a name or phone fragment
+
+    Query parameters: q, type (patient|provider, both if unset) and limit.
+    Names are matched word by word, allowing a typo or two and a prefix for
+    the last word; anything without letters is matched as a phone.
+    """
+    denied = check_api_token('SEARCH_API_TOKEN')
+    if denied:
+        return denied
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'success': False, 'message': 'q is required'}), 400
+    kind = request.args.get('type')
+    if kind and kind not in SearchIndex.KINDS:
+        return jsonify({'success': False, 'message': 'type must be patient or provider'}), 400
+    limit = request.args.get('limit', '')
+    limit = int(limit) if limit.isdigit() else 10
+
+    results = search_index.search(q, (kind,) if kind else SearchIndex.KINDS, limit)
+    return jsonify({'success': True, 'query': q, 'results': results})
+
+
+@main.route('/api/stats')
+def api_stats():
+    """Maintained system counters: totals, one day and optionally one facility"""
+    try:
+        day = date.fromisoformat(request.args['day']) if request.args.get('day') else date.today()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'day must be YYYY-MM-DD'}), 400
+
+    stats = {
+        'totals': system_counters.totals(),
+        'day': day.isoformat(),
+        'added_on_day': system_counters.for_day(day)
+    }
+    if request.args.get('facility', '').isdigit():
+        stats['facility'] = system_counters.for_facility(int(request.args['facility']))
+    return jsonify(stats)
+
+
+@main.route('/test-ussd', methods=['GET', 'POST'])
 def test_ussd():
     """Test USSD functionality locally"""
     if request.method == 'GET':
@@ -736,15 +1229,163 @@ def test_ussd():
         return ussd_callback()
 
 
-# Initialize database on startup
-with app.app_context():
-    db_initialized = init_db()
-    if not db_initialized:
-        print("❌ Failed to initialize database!")
-    else:
-        print("✅ Database initialized successfully!")
+@main.cli.command('migrate-dates')
+@click.option('--chunk-size', default=1000, help='Rows per backfill transaction')
+@click.option('--pause', default=0.0, help='Seconds to sleep between chunks')
+def migrate_dates_command(chunk_size, pause):
+    """Migrate legacy text dates to native Date/DateTime columns"""
+    migrations.migrate_dates(db.engine, db.metadata, chunk_size, pause)
+
+
+@main.cli.command('locate-facilities')
+def locate_facilities_command():
+    """Add facility coordinates and fill them from the location text"""
+    migrations.migrate_locations(db.engine, geocode)
+
+
+@main.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the system counters from the real tables"""
+    drift = system_counters.reconcile()
+    print(f"✅ Counters reconciled, {drift} corrected")
+
+
+@main.cli.command('import-patients')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension')
+@click.option('--chunk-size', default=None, type=int, help='Rows per transaction')
+@click.option('--checkpoint', default=None, help='Progress file; defaults to SOURCE.checkpoint')
+@click.option('--resume/--no-resume', default=True, help='Continue after the checkpointed line')
+@click.option('--rejects', 'rejects_path', default=None, help='CSV file for rejected rows')
+def import_patients_command(source, fmt, chunk_size, checkpoint, resume, rejects_path):
+    """Bulk import patients from a CSV or NDJSON file ('-' for stdin)"""
+    fmt = fmt or detect_format(source.name)
+    if checkpoint is None and source.name != '<stdin>':
+        checkpoint = f"{source.name}.checkpoint"
+    start_after = load_checkpoint(checkpoint) if checkpoint and resume else 0
+    if start_after:
+        print(f"↩️ Resuming after line {start_after}")
+
+    rejects_file = open(rejects_path, 'a', newline='') if rejects_path else None
+    rejects_writer = csv.writer(rejects_file) if rejects_file else None
+
+    def on_reject(line, phone, reason):
+        if rejects_writer:
+            rejects_writer.writerow([line, phone, reason])
+
+    def on_batch(result):
+        print(f"   line {result.last_line}: {result.inserted} inserted, "
+              f"{result.duplicates} duplicates, {result.rejected} rejected "
+              f"({result.rate:.0f} rows/s)")
+
+    importer = PatientImporter(db, Patient, system_counters, audit_log,
+                               chunk_size or current_app.config['IMPORT_CHUNK_SIZE'],
+                               search_index)
+    try:
+        result = importer.run(read_rows(source, fmt), start_after, checkpoint,
+                              on_reject, on_batch)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+        audit_log.flush()
+
+    print(f"✅ Imported {result.inserted} patients from {result.read} rows "
+          f"({result.duplicates} duplicates, {result.rejected} rejected) "
+          f"at {result.rate:.0f} rows/s")
+
+
+@main.cli.command('export-records')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS), default='csv')
+@click.option('--facility', type=int, default=None, help='Facility ID')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='First visit date')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), default=None, help='Last visit date')
+@click.option('--gzip/--no-gzip', 'compress', default=None, help='Defaults to on for .gz files')
+def export_records_command(output, fmt, facility, start, end, compress):
+    """Export medical records as CSV or NDJSON ('-' for stdout)"""
+    if compress is None:
+        compress = output.endswith('.gz')
+
+    chunks = export.export_records(db.session, fmt, facility,
+                                   start.date() if start else None,
+                                   end.date() if end else None, compress)
+    with click.open_file(output, 'wb' if compress else 'w') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+    if output != '-':
+        print(f"✅ Exported medical records to {output}")
+
+
+@main.cli.command('sms-worker')
+@click.option('--threads', default=None, type=int, help='Dispatcher threads')
+@click.option('--once', is_flag=True, help='Send what is due, then exit')
+def sms_worker_command(threads, once):
+    """Send queued SMS through the configured gateway"""
+    dispatcher = SmsDispatcher(sms_queue, threads=threads)
+    if once:
+        dispatcher.recover()
+        print(f"✅ Sent {dispatcher.drain()} queued SMS")
+        return
+
+    print(f"📨 SMS worker: {dispatcher.gateway.name}, {dispatcher.threads} threads, "
+          f"{dispatcher.rate:g} messages/s, up to {dispatcher.bulk_size} per call")
+    dispatcher.run()
+
+
+@main.cli.command('sms-status')
+@click.argument('message_id')
+def sms_status_command(message_id):
+    """Show a queued SMS and its delivery status"""
+    message = sms_queue.status(message_id)
+    if message is None:
+        raise click.ClickException(f"No SMS {message_id}")
+    for field in ('to', 'kind', 'status', 'attempts', 'gateway', 'gateway_id',
+                  'gateway_status', 'error', 'created_at', 'sent_at', 'updated_at'):
+        if message.get(field):
+            print(f"{field:>15}: {message[field]}")
+
+
+@main.cli.command('log-level')
+@click.argument('logger', required=False)
+@click.argument('level', required=False)
+@click.option('--sample', type=float, default=None, help='Share of DEBUG/INFO records to keep')
+@click.option('--reset', is_flag=True, help='Back to LOG_LEVEL and LOG_SAMPLING')
+def log_level_command(logger, level, sample, reset):
+    """Change a logger's level or sample rate in every running worker"""
+    try:
+        if reset:
+            structured_logging.reset()
+        if level:
+            structured_logging.set_level(logger or 'afya', level)
+        if sample is not None:
+            structured_logging.set_sample_rate(logger or 'afya', sample)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    state = structured_logging.state()
+    for name, value in sorted(state['level'].items()):
+        print(f"{name:<24} level {value}")
+    for name, value in sorted(state['sample'].items()):
+        print(f"{name:<24} sample {value:g}")
+
+
+@main.cli.command('init-db')
+def init_db_command():
+    """Create tables and sample data; run once per deploy, not per worker"""
+    if not init_db():
+        raise SystemExit(1)
+    print("✅ Database initialized successfully!")
+
 
 if __name__ == '__main__':
+    app = create_app()
+
+    # Local runs create the schema and sample data themselves
+    with app.app_context():
+        if not init_db():
+            print("❌ Failed to initialize database!")
+
     # Get port from environment variable or default to 5000
     port = int(os.environ.get('PORT', 5000))
 
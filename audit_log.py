@@ -0,0 +1,230 @@
+"""
+Afya Audit Log
+Write-behind batching for system activity logs
+"""
+import os
+import queue
+import logging
+import atexit
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert
+
+log = logging.getLogger('afya.audit')
+
+
+class AuditLogger:
+    """Bounded in-process queue flushed to SystemLog in batches"""
+
+    OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+    def __init__(self, app=None, db=None, model=None, writes=None):
+        self.app = None
+        self.db = None
+        self.model = None
+        self.writes = None
+        self.queue = None
+
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._pid = None
+
+        # Counters exposed through stats()
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+        if app is not None:
+            self.init_app(app, db, model, writes)
+
+    def init_app(self, app, db, model, writes=None):
+        """Bind the logger to an app, its database and the log model
+
+        With an enabled WriteQueue, batches join its group commits instead
+        of committing on their own.
+        """
+        self.app = app
+        self.db = db
+        self.model = model
+        self.writes = writes
+
+        self.max_size = app.config.get('AUDIT_QUEUE_SIZE', 10000)
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', 200)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', 1.0)
+        self.block_timeout = app.config.get('AUDIT_BLOCK_TIMEOUT', 0.05)
+        self.overflow_policy = app.config.get(
+            'AUDIT_OVERFLOW_POLICY', 'drop_oldest')
+
+        if self.overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown audit overflow policy: {self.overflow_policy}")
+
+        self.queue = queue.Queue(maxsize=self.max_size)
+        app.extensions['audit_log'] = self
+
+        # Flush whatever is left when the worker process exits
+        atexit.register(self.shutdown)
+
+    def log(self, user_phone, action, details=None):
+        """Enqueue a log event; never touches the database"""
+        event = {
+            'timestamp': datetime.now(),
+            'user_phone': user_phone,
+            'action': action,
+            'details': details
+        }
+
+        self._ensure_worker()
+
+        if self.overflow_policy == 'block':
+            try:
+                self.queue.put(event, timeout=self.block_timeout)
+            except queue.Full:
+                self._count('dropped')
+                return False
+
+        elif self.overflow_policy == 'drop_oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self._count('dropped')
+                    except queue.Empty:
+                        pass
+
+        else:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self._count('dropped')
+                return False
+
+        self._count('enqueued')
+
+        # Late events after shutdown are written straight through
+        if self._stopping.is_set() and self._pid == os.getpid():
+            self.flush()
+        return True
+
+    def stats(self):
+        """Queue depth and lifetime counters for monitoring"""
+        return {
+            'depth': self.queue.qsize() if self.queue else 0,
+            'capacity': self.max_size if self.queue else 0,
+            'overflow_policy': getattr(self, 'overflow_policy', None),
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'batches': self.batches
+        }
+
+    def flush(self):
+        """Synchronously write everything currently queued"""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self._write(batch)
+
+    def shutdown(self, timeout=None):
+        """Stop the flusher and write any remaining events"""
+        if self.queue is None:
+            return
+
+        self._stopping.set()
+        worker = self._worker
+        if worker is not None and worker.is_alive() and self._pid == os.getpid():
+            worker.join(timeout if timeout is not None else self.flush_interval + 5)
+
+        # Whatever the worker did not get to is written from this thread
+        self.flush()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so restart lazily in each worker process
+        if self._pid == os.getpid() and self._worker is not None and self._worker.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._worker is not None and self._worker.is_alive():
+                return
+            if self._pid == os.getpid() and self._stopping.is_set():
+                return
+            if self._pid != os.getpid():
+                self._stopping = threading.Event()
+            self._pid = os.getpid()
+            self._worker = threading.Thread(
+                target=self._run, name='afya-audit-log', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _next_batch(self):
+        # Collect until the batch is full or the flush interval elapses
+        deadline = time.monotonic() + self.flush_interval
+        batch = []
+        while len(batch) < self.batch_size and not self._stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=min(remaining, 0.25)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # Not through the write queue once stopping: its thread may be gone
+        if self.writes is not None and self.writes.enabled and not self._stopping.is_set():
+            try:
+                self.writes.run(self._insert, batch)
+                self._count('flushed', len(batch))
+                self._count('batches')
+            except Exception as e:
+                self._count('failed', len(batch))
+                log.error("Audit log flush error: %s", e)
+            return
+
+        with self.app.app_context():
+            try:
+                self._insert(batch)
+                self.db.session.commit()
+                self._count('flushed', len(batch))
+                self._count('batches')
+            except Exception as e:
+                self.db.session.rollback()
+                self._count('failed', len(batch))
+                log.error("Audit log flush error: %s", e)
+            finally:
+                self.db.session.remove()
+
+    def _insert(self, batch):
+        self.db.session.execute(insert(self.model), batch)
+        # Core inserts skip the session hook that keeps the log counters
+        counters = self.app.extensions.get('system_counters')
+        if counters is not None:
+            counters.increment(self.db.session.connection(), counters.log_deltas(batch))
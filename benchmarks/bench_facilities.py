@@ -0,0 +1,102 @@
+"""
+Afya nearest facility benchmark
+Nearest-2 lookup cost: scanning every facility vs the FacilityGrid
+
+Facilities are generated around Ghana's towns (most near a town, some
+scattered), queries come from random points in the country, and every
+grid answer is checked against the scan.
+
+Run from the repository root:
+    python benchmarks/bench_facilities.py
+    python benchmarks/bench_facilities.py --sizes 10000 100000 1000000
+"""
+import os
+import sys
+import time
+import heapq
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from facility_index import FacilityGrid, PLACES, distance_km
+
+# Ghana's bounding box
+LAT_RANGE = (4.7, 11.2)
+LON_RANGE = (-3.3, 1.2)
+
+
+def generate(count, rng):
+    towns = list(PLACES.values())
+    facilities = []
+    for id in range(count):
+        if rng.random() < 0.8:
+            lat, lon = rng.choice(towns)
+            lat, lon = lat + rng.gauss(0, 0.15), lon + rng.gauss(0, 0.15)
+        else:
+            lat, lon = rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)
+        facilities.append((id, lat, lon, {'id': id, 'name': f"Facility {id}"}))
+    return facilities
+
+
+def scan(facilities, lat, lon, n=2):
+    return heapq.nsmallest(n, ((distance_km(lat, lon, f_lat, f_lon), data)
+                               for _, f_lat, f_lon, data in facilities),
+                           key=lambda item: item[0])
+
+
+def per_query_us(find, queries, repeat=3):
+    def run():
+        for lat, lon in queries:
+            find(lat, lon)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    queries = [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _ in range(args.queries)]
+    towns = [PLACES[name] for name in ('accra', 'kumasi', 'tamale')] * (args.queries // 3)
+
+    print(f"{'facilities':>11} {'build ms':>9} {'scan us':>10} {'grid us':>9} "
+          f"{'grid town us':>13} {'add+remove us':>14}  mismatches")
+    for size in args.sizes:
+        facilities = generate(size, rng)
+
+        started = time.perf_counter()
+        grid = FacilityGrid()
+        for id, lat, lon, data in facilities:
+            grid.add(id, lat, lon, data)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        # The scan is slow at scale; time it on a sample of the queries
+        sample = queries[:max(10, min(len(queries), 2000000 // size))]
+        scan_us = per_query_us(lambda lat, lon: scan(facilities, lat, lon), sample, repeat=1)
+        grid_us = per_query_us(lambda lat, lon: grid.nearest(lat, lon), queries)
+        town_us = per_query_us(lambda lat, lon: grid.nearest(lat, lon), towns)
+
+        mismatches = sum(
+            [round(d, 9) for d, _ in grid.nearest(lat, lon)] !=
+            [round(d, 9) for d, _ in scan(facilities, lat, lon)]
+            for lat, lon in sample)
+
+        churn = facilities[:1000]
+        started = time.perf_counter()
+        for id, lat, lon, data in churn:
+            grid.remove(id)
+            grid.add(id, lat, lon, data)
+        churn_us = (time.perf_counter() - started) / len(churn) * 1e6
+
+        print(f"{size:>11} {build_ms:>9.0f} {scan_us:>10.0f} {grid_us:>9.1f} "
+              f"{town_us:>13.1f} {churn_us:>14.2f}  {mismatches}/{len(sample)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Afya USSD routing benchmark
+Per-request routing cost: legacy if/elif chain vs compiled MenuRouter
+
+Run from the repository root:
+    python benchmarks/bench_routing.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from medical_menu import MENU_ROUTES
+from ussd_router import MenuRouter
+
+# Realistic mix of hops seen on /ussd/callback
+PATHS = [
+    '', '1', '2', '3', '4',
+    '1*1234', '1*1234*1', '1*1234*1*0200123456', '1*1234*4',
+    '1*1234*3*0240234567*Fever',
+    '2*1', '2*2', '2*3', '3*1', '3*3', '3*4', '9', '2*7',
+]
+
+
+class StubMenu:
+    """Stand-in for MedicalMenu: every handler returns its own name"""
+
+    def __getattr__(self, name):
+        def handler(*args, **kwargs):
+            return name
+        handler.__name__ = name
+        setattr(self, name, handler)
+        return handler
+
+
+class LegacyRouter:
+    """The pre-router decision logic: ussd_callback + handle_* chain"""
+
+    def __init__(self, menu):
+        self.menu = menu
+
+    def dispatch(self, text, session_id, phone_number):
+        menu = self.menu
+        if text == '':
+            return menu.main_menu(session_id, phone_number)
+        if text == '1':
+            return menu.provider_login_menu(session_id, phone_number)
+        elif text == '2':
+            return menu.patient_services_menu(session_id, phone_number)
+        elif text == '3':
+            return menu.emergency_services_menu(session_id, phone_number)
+        elif text == '4':
+            return menu.system_info_menu(session_id, phone_number)
+        elif len(text.split('*')) > 1:
+            return self.handle_multi_level_menu(text, session_id, phone_number)
+        else:
+            return menu.invalid_selection(session_id)
+
+    def handle_multi_level_menu(self, text, session_id, phone_number):
+        menu_path = text.split('*')
+        if menu_path[0] == '1':
+            return self.handle_provider_flow(menu_path, session_id, phone_number)
+        elif menu_path[0] == '2':
+            return self.handle_patient_flow(menu_path, session_id, phone_number)
+        elif menu_path[0] == '3':
+            return self.handle_emergency_flow(menu_path, session_id, phone_number)
+        else:
+            return self.menu.invalid_selection(session_id)
+
+    def handle_provider_flow(self, menu_path, session_id, phone_number):
+        if len(menu_path) == 2:
+            return self.menu.provider_home_menu(session_id, phone_number, menu_path[1])
+        elif len(menu_path) >= 3:
+            return self.handle_provider_actions(menu_path, session_id, phone_number)
+
+    def handle_provider_actions(self, menu_path, session_id, phone_number):
+        action = menu_path[2]
+        pin = menu_path[1]
+        if action == '1':
+            return self.menu.find_patient_prompt(session_id, phone_number, pin)
+        elif action == '2':
+            return self.menu.new_patient_prompt(session_id, phone_number, pin)
+        elif action == '3':
+            return self.menu.new_record_prompt(session_id, phone_number, pin)
+        elif action == '4':
+            return self.menu.today_list_menu(session_id, phone_number, pin)
+        elif action == '0':
+            return self.menu.provider_logout_menu(session_id, phone_number, pin)
+        else:
+            return self.menu.invalid_selection(session_id)
+
+    def handle_patient_flow(self, menu_path, session_id, phone_number):
+        if len(menu_path) == 2:
+            action = menu_path[1]
+            if action == '1':
+                return self.menu.patient_records_menu(session_id, phone_number)
+            elif action == '2':
+                return self.menu.emergency_numbers_menu(session_id, phone_number)
+            elif action == '3':
+                return self.menu.patient_appointments_menu(session_id, phone_number)
+            elif action == '0':
+                return self.menu.main_menu(session_id, phone_number)
+
+    def handle_emergency_flow(self, menu_path, session_id, phone_number):
+        if len(menu_path) == 2:
+            action = menu_path[1]
+            if action == '1':
+                return self.menu.call_ambulance_menu(session_id, phone_number)
+            elif action == '2':
+                return self.menu.family_alert_menu(session_id, phone_number)
+            elif action == '3':
+                return self.menu.emergency_info_menu(session_id, phone_number)
+            elif action == '4':
+                return self.menu.nearest_hospital_menu(session_id, phone_number)
+
+
+def per_hop_ns(routers, paths, iterations, rounds=7):
+    """Best ns/hop of each router, timed in alternating rounds
+
+    Interleaving keeps a noisy stretch on the machine from landing on only
+    one of the routers being compared.
+    """
+    def runner(router):
+        def run():
+            for path in paths:
+                router.dispatch(path, 'bench', '0200000000')
+        return run
+
+    runs = [runner(router) for router in routers]
+    best = [float('inf')] * len(routers)
+    for _ in range(rounds):
+        for i, run in enumerate(runs):
+            best[i] = min(best[i], timeit.timeit(run, number=iterations))
+    return [seconds / (iterations * len(paths)) * 1e9 for seconds in best]
+
+
+def main():
+    menu = StubMenu()
+    legacy = LegacyRouter(menu)
+    compiled = MenuRouter(MENU_ROUTES, menu)
+    iterations = 20000
+
+    unhandled = [p for p in PATHS if legacy.dispatch(p, 'bench', '0200000000') is None]
+
+    old, new = per_hop_ns([legacy, compiled], PATHS, iterations)
+    print(f"Paths in mix:     {len(PATHS)}")
+    print(f"Legacy chain:     {old:8.1f} ns/hop")
+    print(f"Compiled router:  {new:8.1f} ns/hop")
+    print(f"Legacy paths returning None: {unhandled}")
+
+    print("\nPer-path cost (ns/hop):")
+    for path in PATHS:
+        old, new = per_hop_ns([legacy, compiled], [path], iterations)
+        print(f"  {path or '(empty)':<30} legacy {old:7.1f}   router {new:7.1f}")
+
+
+if __name__ == '__main__':
+    main()
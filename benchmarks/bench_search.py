@@ -0,0 +1,155 @@
+"""
+Afya search benchmark
+Query latency of the patient search index at up to a million patients
+
+Patients get Ghanaian first, middle and family names and mobile numbers
+on the real network prefixes, so common words ("kwame", "mensah") have
+long posting lists the way they would in production. Each query kind is
+run against the same index and reported as p50 / p95 / max milliseconds.
+
+Run from the repository root:
+    python benchmarks/bench_search.py
+    python benchmarks/bench_search.py --sizes 100000 1000000 --queries 500
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import TrigramIndex
+
+FIRST_NAMES = (
+    "Kwame Kwaku Kwabena Kwadwo Kwasi Kofi Kojo Yaw Akwasi Kwesi Ato Ekow Fiifi "
+    "Ama Akua Abena Adwoa Akosua Afua Yaa Efua Esi Aba Adjoa Araba Ekua "
+    "Emmanuel Samuel Daniel Joseph Isaac Michael Richard Prince Eric Felix Francis "
+    "Grace Mercy Comfort Gifty Patience Joyce Priscilla Esther Linda Vida Rita "
+    "Mohammed Ibrahim Abdul Rashid Yakubu Issah Alhassan Fuseini Zakaria Amina "
+    "Fatima Mariam Salamatu Rahinatu Hawa Selorm Elikem Edem Senyo Dela Mawuli "
+    "Nana Kweku Kobby Papa Maame Naa Adoley Ayele Korkor Nii Tetteh Lamptey"
+).split()
+FAMILY_NAMES = (
+    "Mensah Boateng Asante Owusu Osei Agyemang Appiah Amoah Ansah Addo Adjei "
+    "Acheampong Antwi Asamoah Bonsu Darko Danso Frimpong Gyamfi Kusi Kyei Nkrumah "
+    "Ofori Opoku Oppong Sarpong Tawiah Wiredu Yeboah Amponsah Baffour Donkor "
+    "Quaye Quartey Tetteh Lamptey Aryee Ankrah Armah Nortey Odoi Sowah Tagoe "
+    "Agbeko Amenyo Dzradosi Kpodo Tsikata Gbeho Agbodza Fiawoo Mawuena Dogbe "
+    "Abdulai Iddrisu Mahama Sulemana Seidu Alhassan Yakubu Issahaku Haruna Dramani "
+    "Essien Eshun Aidoo Arthur Quansah Mensa Nyarko Badu Sekyere Twumasi Bediako"
+).split()
+PREFIXES = ('020', '023', '024', '025', '026', '027', '028', '050', '053',
+            '054', '055', '056', '057', '059')
+
+
+def generate(count, rng):
+    phones = set()
+    patients = []
+    while len(patients) < count:
+        phone = rng.choice(PREFIXES) + f"{rng.randrange(10 ** 7):07d}"
+        if phone in phones:
+            continue
+        phones.add(phone)
+        words = rng.sample(FIRST_NAMES, 2 if rng.random() < 0.3 else 1)
+        words.append(rng.choice([name for name in FAMILY_NAMES if name not in words]))
+        patients.append((len(patients) + 1, ' '.join(words), phone))
+    return patients
+
+
+def typo(text, rng, alphabet):
+    at = rng.randrange(len(text) - 1)
+    kind = rng.choice(('swap', 'drop', 'change'))
+    if kind == 'swap':
+        return text[:at] + text[at + 1] + text[at] + text[at + 2:]
+    if kind == 'drop':
+        return text[:at] + text[at + 1:]
+    return text[:at] + rng.choice(alphabet.replace(text[at], '')) + text[at + 1:]
+
+
+def queries(patients, count, rng):
+    """Query kind -> [(query, check)]; check(results) says if the search found it"""
+    def names(found):
+        return [name.lower() for _, _, name, _ in found]
+
+    def phones(found):
+        return [phone for _, _, _, phone in found]
+
+    kinds = {name: [] for name in ('full name', 'name prefix', 'name typo', 'single word',
+                                   'phone', 'phone prefix', 'phone ending', 'phone typo')}
+    for _ in range(count):
+        id, name, phone = rng.choice(patients)
+        first, last = name.lower().split()[0], name.lower().split()[-1]
+        misspelt = ' '.join(typo(word, rng, 'aeioukmnst') if len(word) > 3 else word
+                            for word in name.lower().split())
+        kinds['full name'].append((name, lambda found, name=name.lower(): name in names(found)))
+        kinds['name prefix'].append((f"{first} {last[:3]}", lambda found, first=first, start=last[:3]: any(
+            first in n.split() and any(w.startswith(start) for w in n.split()[1:])
+            for n in names(found))))
+        kinds['name typo'].append((misspelt, lambda found, name=name.lower(): name in names(found)))
+        kinds['single word'].append((last, lambda found, last=last: any(
+            last in n.split() for n in names(found))))
+        kinds['phone'].append((phone, lambda found, id=id: any(f[1] == id for f in found)))
+        kinds['phone prefix'].append((phone[:6], lambda found, start=phone[:6]: found and
+                                      phones(found)[0].startswith(start)))
+        kinds['phone ending'].append((phone[-4:], lambda found, end=phone[-4:]: any(
+            p.endswith(end) for p in phones(found))))
+        kinds['phone typo'].append((typo(phone, rng, '0123456789'),
+                                    lambda found, phone=phone: phone in phones(found)))
+    return kinds
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=11)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        patients = generate(size, rng)
+
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        index = TrigramIndex()
+        index.build(patients)
+        build_s = time.perf_counter() - started
+        grown_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+        print(f"\n{size} patients: built in {build_s:.1f}s, "
+              f"+{grown_mb:.0f} MB peak RSS, {len(index.postings)} distinct name words")
+        print(f"{'query':>14} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}  found")
+        for kind, items in queries(patients, args.queries, rng).items():
+            timings = []
+            hits = 0
+            for query, check in items:
+                started = time.perf_counter()
+                found = index.search(query, args.limit)
+                timings.append((time.perf_counter() - started) * 1000)
+                hits += bool(check(found))
+            print(f"{kind:>14} {percentile(timings, 0.5):>8.2f} {percentile(timings, 0.95):>8.2f} "
+                  f"{max(timings):>8.2f}  {hits}/{len(items)}")
+
+        # Registrations and edits while serving
+        extra = generate(1000, random.Random(args.seed + size))
+        started = time.perf_counter()
+        for id, name, phone in extra:
+            index.add(size + id, name, phone)
+        add_us = (time.perf_counter() - started) / len(extra) * 1e6
+        started = time.perf_counter()
+        for id, name, phone in extra:
+            index.remove(size + id)
+        remove_us = (time.perf_counter() - started) / len(extra) * 1e6
+        print(f"{'add / remove':>14} {add_us:>8.0f} us {remove_us:>8.0f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Afya SQLite concurrency benchmark
+Patient registrations from N worker processes against one SQLite file
+
+Each worker is a forked process with its own Flask app and threads, the
+way gunicorn runs the SQLite fallback. Every operation is a registration:
+look the phone up, insert the patient and an activity log row. Three
+setups are measured on a fresh database each:
+
+    legacy      rollback journal, pysqlite transactions, commit per request
+    wal         SQLITE_MODE pragmas, commit per request
+    wal+queue   SQLITE_MODE pragmas and the write queue (group commits)
+
+and reported as operations per second, p50 / p95 / max latency in
+milliseconds and the number of operations that failed "database is locked".
+
+Run from the repository root:
+    python benchmarks/bench_sqlite.py
+    python benchmarks/bench_sqlite.py --workers 1 4 8 --threads 8 --seconds 5
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+from models import db, Patient, SystemLog
+from sqlite_mode import SqliteMode
+from write_queue import WriteQueue
+
+SETUPS = {
+    'legacy': {'SQLITE_MODE': False, 'WRITE_QUEUE_ENABLED': False},
+    'wal': {'SQLITE_MODE': True, 'WRITE_QUEUE_ENABLED': False},
+    'wal+queue': {'SQLITE_MODE': True, 'WRITE_QUEUE_ENABLED': True},
+}
+
+
+def make_app(path, setup):
+    app = Flask(__name__)
+    app.config.update(SETUPS[setup], SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}")
+    db.init_app(app)
+    SqliteMode(db).init_app(app)
+    return app, WriteQueue(app, db)
+
+
+def register(phone):
+    if Patient.query.filter_by(phone=phone).first():
+        return False
+    db.session.add(Patient(phone=phone, name=f"Patient {phone[-4:]}", is_active=True))
+    db.session.add(SystemLog(user_phone=phone, action='Patient_Registered_USSD'))
+    return True
+
+
+def worker(path, setup, number, threads, seconds, results):
+    app, writes = make_app(path, setup)
+    latencies, locked = [], [0]
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def client(thread):
+        mine, count = [], 0
+        with app.app_context():
+            while time.monotonic() < stop:
+                count += 1
+                phone = f"02{number:02d}{thread:02d}{count:04d}"[:10]
+                start = time.perf_counter()
+                try:
+                    writes.run(register, phone)
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    with lock:
+                        locked[0] += 1
+                    continue
+                finally:
+                    db.session.remove()
+                mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    pool = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, locked[0], writes.stats()))
+
+
+def run(setup, workers, threads, seconds, directory):
+    path = os.path.join(directory, f"{setup}-{workers}.sqlite3")
+    app, _ = make_app(path, setup)
+    with app.app_context():
+        db.create_all()
+        db.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(path, setup, n, threads, seconds, results))
+                 for n in range(workers)]
+    for process in processes:
+        process.start()
+    latencies, locked, batches, writes = [], 0, 0, 0
+    for _ in processes:
+        mine, errors, stats = results.get()
+        latencies += mine
+        locked += errors
+        batches += stats['batches']
+        writes += stats['writes']
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    per_batch = f"{writes / batches:5.1f}" if batches else '    -'
+    print(f"  {setup:<10} {len(latencies) / seconds:8.0f} ops/s   p50 {pick(0.5):7.2f}   "
+          f"p95 {pick(0.95):7.2f}   max {latencies[-1] * 1000:8.2f} ms   "
+          f"locked {locked:5d}   writes/commit {per_batch}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='afya-sqlite-')
+    try:
+        for workers in args.workers:
+            print(f"{workers} worker(s) x {args.threads} threads, {args.seconds:g} s")
+            for setup in SETUPS:
+                run(setup, workers, args.threads, args.seconds, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
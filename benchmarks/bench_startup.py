@@ -0,0 +1,132 @@
+"""
+Afya worker startup benchmark
+Time-to-first-request for a fresh worker, before and after create_app()
+
+Each sample is a fresh interpreter that imports the app, builds it and
+renders the dashboard (GET /) through the test client, the same work a gunicorn worker
+does before its first response. Three setups are measured:
+
+    baseline     `gunicorn app:app` at a git ref: import runs configure_app,
+                 init_db and the sample data check in every worker
+    factory      create_app() in every worker (no preload)
+    preloaded    create_app() once in a parent, then per forked worker only
+                 warm_worker() and the first request
+
+Run from the repository root (baseline needs the pre-factory commit):
+    python benchmarks/bench_startup.py --baseline <ref> --samples 10
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside each sample interpreter; prints one JSON line per worker
+CHILD = r"""
+import os, sys, json, time
+start = time.perf_counter()
+sys.path.insert(0, os.getcwd())
+import app as module
+
+def first_request(application):
+    began = time.perf_counter()
+    response = application.test_client().get('/')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return time.perf_counter() - began
+
+mode = os.environ['BENCH_MODE']
+if mode == 'baseline':
+    imported = time.perf_counter()
+    served = first_request(module.app)
+    print(json.dumps({'boot': imported - start, 'first_request': served}))
+
+elif mode == 'factory':
+    application = module.create_app()
+    module.warm_worker(application)
+    booted = time.perf_counter()
+    served = first_request(application)
+    print(json.dumps({'boot': booted - start, 'first_request': served}))
+
+else:
+    application = module.create_app()
+    sys.stdout.flush()
+    for _ in range(int(os.environ['BENCH_WORKERS'])):
+        pid = os.fork()
+        if pid == 0:
+            forked = time.perf_counter()
+            module.warm_worker(application)
+            booted = time.perf_counter()
+            served = first_request(application)
+            print(json.dumps({'boot': booted - forked, 'first_request': served}))
+            sys.stdout.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+"""
+
+
+def run_samples(tree, mode, samples, db_url, workers=1):
+    env = dict(os.environ, BENCH_MODE=mode, BENCH_WORKERS=str(workers),
+               DATABASE_URL=db_url, COUNTERS_RECONCILE_INTERVAL='0')
+    env.pop('REDIS_URL', None)
+
+    results = []
+    for _ in range(samples):
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD], cwd=tree, env=env,
+            capture_output=True, text=True, check=True).stdout
+        for line in output.splitlines():
+            if line.startswith('{'):
+                results.append(json.loads(line))
+    return results
+
+
+def summarise(name, results):
+    boot = [r['boot'] * 1000 for r in results]
+    first = [r['first_request'] * 1000 for r in results]
+    total = [b + f for b, f in zip(boot, first)]
+    print(f"{name:<10} boot {statistics.median(boot):8.1f} ms   "
+          f"first request {statistics.median(first):7.1f} ms   "
+          f"ready {statistics.median(total):8.1f} ms  (median of {len(results)})")
+
+
+def export_tree(ref, target):
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT,
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--baseline', help='git ref of the pre-factory app.py')
+    parser.add_argument('--samples', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='afya-startup-')
+    try:
+        if args.baseline:
+            tree = os.path.join(workdir, 'baseline')
+            os.makedirs(tree)
+            export_tree(args.baseline, tree)
+            db_url = f"sqlite:///{workdir}/baseline.db"
+            # First import creates the schema; not counted
+            run_samples(tree, 'baseline', 1, db_url)
+            summarise('baseline', run_samples(tree, 'baseline', args.samples, db_url))
+
+        db_url = f"sqlite:///{workdir}/current.db"
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'],
+                       cwd=ROOT, env=dict(os.environ, DATABASE_URL=db_url),
+                       capture_output=True, check=True)
+        summarise('factory', run_samples(ROOT, 'factory', args.samples, db_url))
+        summarise('preloaded', run_samples(
+            ROOT, 'preloaded', 1, db_url, workers=args.samples))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
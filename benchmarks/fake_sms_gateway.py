@@ -0,0 +1,191 @@
+"""
+Afya fake SMS gateway
+A local stand-in for Africa's Talking and Twilio, for testing the SMS queue
+
+Speaks the two APIs the gateways in sms_gateways.py use, with knobs for the
+failures the dispatcher has to survive: slow replies, whole-request errors,
+per-recipient rejections and 429s above a request rate. It can also post
+delivery reports back to the app. GET /stats shows what it has received;
+POST /reset clears it.
+
+    python benchmarks/fake_sms_gateway.py --port 8025 --fail-rate 0.1
+    SMS_GATEWAY=africastalking SMS_GATEWAY_URL=http://127.0.0.1:8025 \\
+        flask --app app sms-worker
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter, deque
+from urllib.parse import parse_qs, urlencode
+from urllib.request import urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGateway:
+    """Shared state and failure settings for the request handler"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, fail_rate=0.0,
+                 max_rps=0, callback=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.max_rps = max_rps
+        self.callback = callback
+
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = Counter()
+            self.delivered = Counter()
+            self.largest_request = 0
+
+    def admit(self):
+        """False when the request is over the rate limit"""
+        if not self.max_rps:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.max_rps:
+                return False
+            self.recent.append(now)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'counts': dict(self.counts), 'largest_request': self.largest_request,
+                    'messages_per_phone_max': max(self.delivered.values(), default=0),
+                    'phones': len(self.delivered)}
+
+    def report(self, reports):
+        # Delivery reports go out after the reply, like the real gateways
+        if not self.callback:
+            return
+
+        def post():
+            time.sleep(0.05)
+            for fields in reports:
+                try:
+                    urlopen(self.callback, data=urlencode(fields).encode(), timeout=5).close()
+                except OSError:
+                    pass
+        threading.Thread(target=post, daemon=True).start()
+
+
+class Handler(BaseHTTPRequestHandler):
+    gateway = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self.reply(200, self.gateway.stats())
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        gateway = self.gateway
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in
+                parse_qs(self.rfile.read(length).decode()).items()}
+
+        if self.path == '/reset':
+            gateway.reset()
+            return self.reply(200, {'reset': True})
+
+        with gateway.lock:
+            gateway.counts['requests'] += 1
+        if not gateway.admit():
+            with gateway.lock:
+                gateway.counts['throttled'] += 1
+            return self.reply(429, {'error': 'Too many requests'})
+        if gateway.latency:
+            time.sleep(gateway.latency)
+        if random.random() < gateway.error_rate:
+            with gateway.lock:
+                gateway.counts['errors'] += 1
+            return self.reply(500, {'error': 'Internal error'})
+
+        if self.path == '/version1/messaging':
+            return self.africastalking(form)
+        if self.path.endswith('/Messages.json'):
+            return self.twilio(form)
+        self.reply(404, {'error': 'not found'})
+
+    def accept(self, numbers):
+        """Per-number outcome: (accepted, message id)"""
+        outcomes = []
+        with self.gateway.lock:
+            self.gateway.largest_request = max(self.gateway.largest_request, len(numbers))
+            for number in numbers:
+                if random.random() < self.gateway.fail_rate:
+                    self.gateway.counts['rejected'] += 1
+                    outcomes.append((False, None))
+                else:
+                    self.gateway.counts['sent'] += 1
+                    self.gateway.delivered[number] += 1
+                    outcomes.append((True, f"fake-{uuid.uuid4().hex}"))
+        return outcomes
+
+    def africastalking(self, form):
+        numbers = [n for n in form.get('to', '').split(',') if n]
+        recipients = []
+        reports = []
+        for number, (accepted, message_id) in zip(numbers, self.accept(numbers)):
+            if accepted:
+                recipients.append({'statusCode': 101, 'number': number,
+                                   'status': 'Success', 'messageId': message_id})
+                reports.append({'id': message_id, 'status': 'Success',
+                                'phoneNumber': number})
+            else:
+                recipients.append({'statusCode': 500, 'number': number,
+                                   'status': 'InternalServerError', 'messageId': 'None'})
+        self.gateway.report(reports)
+        self.reply(201, {'SMSMessageData': {
+            'Message': f"Sent to {len(reports)}/{len(numbers)}", 'Recipients': recipients}})
+
+    def twilio(self, form):
+        [(accepted, message_id)] = self.accept([form.get('To', '')])
+        if not accepted:
+            return self.reply(503, {'code': 20503, 'message': 'Service unavailable'})
+        self.gateway.report([{'MessageSid': message_id, 'MessageStatus': 'delivered'}])
+        self.reply(201, {'sid': message_id, 'status': 'queued'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered 500')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of recipients rejected')
+    parser.add_argument('--max-rps', type=int, default=0, help='Requests per second before 429')
+    parser.add_argument('--callback', help='Delivery report URL, e.g. http://127.0.0.1:5000/sms/delivery-report?token=<SMS_CALLBACK_TOKEN>')
+    args = parser.parse_args()
+
+    Handler.gateway = FakeGateway(args.latency, args.error_rate, args.fail_rate,
+                                  args.max_rps, args.callback)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print(f"Fake SMS gateway on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
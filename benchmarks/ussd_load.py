@@ -0,0 +1,383 @@
+"""
+Afya USSD load test
+Replays telco-style USSD sessions against /ussd/callback at peak concurrency
+
+Each virtual user dials in with a fresh sessionId and walks one flow from
+the mix, sending the cumulative text the telco would ('' -> '1' -> '1*1234'
+-> '1*1234*1' ...), with an exponentially distributed think time between
+hops. Requests are grouped by the menu node they resolve to, and for each
+node the report gives throughput, p50/p95/p99 latency and the mean number of
+SQL queries and Redis round trips per request (from the X-Afya-* headers,
+see request_stats.py).
+
+Runs in-process through the Flask test client by default, or against a live
+server started with REQUEST_STATS_HEADERS=true:
+
+    python benchmarks/ussd_load.py --sessions 2000 --users 500 --think 0.5
+    python benchmarks/ussd_load.py --url http://127.0.0.1:5000 --users 2000 --think 3
+
+Results can be saved as a JSON baseline and compared against later runs:
+
+    python benchmarks/ussd_load.py --save benchmarks/baselines/ussd.json
+    python benchmarks/ussd_load.py --compare benchmarks/baselines/ussd.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import contextlib
+import subprocess
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from medical_menu import MENU_ROUTES
+from ussd_router import MenuRouter
+
+# Sample data from init-db: (phone, PIN) per provider, and patient phones
+PROVIDERS = [('0501234568', '1234'), ('0201234569', '5678'), ('0241234570', '9012')]
+PATIENTS = ['0200123456', '0240234567', '0260345678', '0270456789']
+
+# name -> (weight, caller, inputs after the initial dial)
+FLOWS = {
+    'provider_find_patient': (20, 'provider', ['1', '{pin}', '1', '{patient}']),
+    'provider_today_list': (10, 'provider', ['1', '{pin}', '4']),
+    'provider_new_record': (5, 'provider', ['1', '{pin}', '3', '{patient}', 'Fever']),
+    'provider_logout': (5, 'provider', ['1', '{pin}', '0']),
+    'patient_records': (15, 'patient', ['2', '1']),
+    'patient_emergency_numbers': (10, 'patient', ['2', '2']),
+    'patient_appointments': (8, 'patient', ['2', '3']),
+    'emergency_ambulance': (8, 'patient', ['3', '1']),
+    'emergency_family_alert': (4, 'patient', ['3', '2']),
+    'emergency_info': (4, 'patient', ['3', '3']),
+    'emergency_nearest_hospital': (4, 'patient', ['3', '4']),
+    'system_info': (7, 'patient', ['4']),
+}
+WRITE_FLOWS = {'provider_new_record'}
+
+
+class _HandlerNames:
+    """Router target whose handlers are just names, to label requests"""
+
+    def __getattr__(self, name):
+        return name
+
+
+def node_label(router, text):
+    node, _ = router.resolve(text)
+    if node is None or node.handler is None:
+        return 'invalid'
+    return node.key or '(dial)'
+
+
+class TestClientTarget:
+    """The app in this process, one test client per thread"""
+
+    name = 'test-client'
+
+    def __init__(self):
+        os.environ['REQUEST_STATS_HEADERS'] = 'true'
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        import app as module
+        self.app = module.create_app()
+        self._local = threading.local()
+
+    def post(self, form):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post('/ussd/callback', data=form)
+        return response.status_code, response.get_data(as_text=True), response.headers
+
+
+class HttpTarget:
+    """A live server, one pooled HTTP session per thread"""
+
+    def __init__(self, url, timeout=30):
+        import requests
+        self.requests = requests
+        self.name = url
+        self.url = url.rstrip('/') + '/ussd/callback'
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, form):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self.requests.Session()
+        response = http.post(self.url, data=form, timeout=self.timeout)
+        return response.status_code, response.text, response.headers
+
+
+class LoadTest:
+    """Virtual users replaying sessions until the session budget is spent"""
+
+    def __init__(self, target, flows, sessions, users, think, ramp, duration=None,
+                 service_code='*714#'):
+        self.target = target
+        self.flows = flows
+        self.sessions = sessions
+        self.users = users
+        self.think = think
+        self.ramp = ramp
+        self.duration = duration
+        self.service_code = service_code
+        self.router = MenuRouter(MENU_ROUTES, _HandlerNames())
+
+        self._lock = threading.Lock()
+        self._started = 0
+        self.samples = []
+        self.completed = defaultdict(int)
+        self.ended_early = defaultdict(int)
+
+    def run(self):
+        self.began = time.perf_counter()
+        workers = [threading.Thread(target=self._user, daemon=True)
+                   for _ in range(self.users)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.elapsed = time.perf_counter() - self.began
+        return self
+
+    def _next_session(self):
+        with self._lock:
+            if self._started >= self.sessions:
+                return False
+            if self.duration and time.perf_counter() - self.began > self.duration:
+                return False
+            self._started += 1
+            return True
+
+    def _pause(self):
+        if self.think:
+            time.sleep(random.expovariate(1 / self.think))
+
+    def _user(self):
+        samples = []
+        if self.ramp:
+            time.sleep(random.uniform(0, self.ramp))
+        while self._next_session():
+            self._session(samples)
+        with self._lock:
+            self.samples.extend(samples)
+
+    def _session(self, samples):
+        names = list(self.flows)
+        flow = random.choices(names, weights=[self.flows[n][0] for n in names])[0]
+        _, caller, inputs = self.flows[flow]
+        provider_phone, pin = random.choice(PROVIDERS)
+        patient = random.choice(PATIENTS)
+        phone = provider_phone if caller == 'provider' else patient
+
+        session_id = f"load-{uuid.uuid4().hex}"
+        path = []
+        steps = [None] + [step.format(pin=pin, patient=patient) for step in inputs]
+        for number, step in enumerate(steps):
+            if step is not None:
+                path.append(step)
+                self._pause()
+            text = '*'.join(path)
+            reply = self._hop(samples, session_id, phone, text)
+            if reply.startswith('END') and number < len(steps) - 1:
+                with self._lock:
+                    self.ended_early[flow] += 1
+                return
+
+        with self._lock:
+            self.completed[flow] += 1
+
+    def _hop(self, samples, session_id, phone, text):
+        form = {'sessionId': session_id, 'serviceCode': self.service_code,
+                'phoneNumber': phone, 'text': text}
+        began = time.perf_counter()
+        try:
+            status, reply, headers = self.target.post(form)
+            error = status != 200 or not reply.startswith(('CON', 'END')) \
+                or 'System error' in reply
+        except Exception:
+            status, reply, headers, error = None, '', {}, True
+        latency = time.perf_counter() - began
+
+        samples.append({
+            'node': node_label(self.router, text),
+            'latency': latency,
+            'error': error,
+            'queries': _int(headers.get('X-Afya-Queries')),
+            'redis': _int(headers.get('X-Afya-Redis')),
+            'finished': time.perf_counter() - self.began
+        })
+        return reply
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    rank = max(1, min(len(ordered), round(p / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+
+def summarise(samples, elapsed):
+    """Totals and per-node figures; latencies in milliseconds"""
+    def figures(group):
+        latencies = sorted(s['latency'] * 1000 for s in group)
+        queries = [s['queries'] for s in group if s['queries'] is not None]
+        trips = [s['redis'] for s in group if s['redis'] is not None]
+        return {
+            'requests': len(group),
+            'errors': sum(s['error'] for s in group),
+            'rps': round(len(group) / elapsed, 2) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'queries': round(sum(queries) / len(queries), 2) if queries else None,
+            'redis': round(sum(trips) / len(trips), 2) if trips else None
+        }
+
+    nodes = defaultdict(list)
+    for sample in samples:
+        nodes[sample['node']].append(sample)
+    return figures(samples), {node: figures(group) for node, group in sorted(nodes.items())}
+
+
+def print_report(result):
+    totals = result['totals']
+    print(f"\n{result['target']}: {result['settings']['users']} users, "
+          f"{sum(result['completed'].values())} sessions completed, "
+          f"{sum(result['ended_early'].values())} ended early, "
+          f"{result['elapsed_s']:.1f} s")
+    header = f"{'node':<40}{'reqs':>7}{'err':>5}{'rps':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'sql':>6}{'redis':>7}"
+    print(header)
+    print('-' * len(header))
+    for node, f in list(result['nodes'].items()) + [('TOTAL', totals)]:
+        print(f"{node:<40}{f['requests']:>7}{f['errors']:>5}{f['rps']:>9.1f}"
+              f"{f['p50_ms']:>8.1f}{f['p95_ms']:>8.1f}{f['p99_ms']:>8.1f}"
+              f"{_fmt(f['queries']):>6}{_fmt(f['redis']):>7}")
+
+
+def print_comparison(old, new):
+    print(f"\nAgainst {old['commit']} ({old['created_at']}):")
+    print(f"{'node':<40}{'p95 ms':>24}{'sql/req':>22}{'redis/req':>22}")
+    for node in sorted(set(old['nodes']) | set(new['nodes'])) + ['TOTAL']:
+        a = old['totals'] if node == 'TOTAL' else old['nodes'].get(node)
+        b = new['totals'] if node == 'TOTAL' else new['nodes'].get(node)
+        if not a or not b:
+            continue
+        print(f"{node:<40}{_delta(a['p95_ms'], b['p95_ms']):>24}"
+              f"{_delta(a['queries'], b['queries']):>22}{_delta(a['redis'], b['redis']):>22}")
+    print(f"{'throughput (rps)':<40}{_delta(old['totals']['rps'], new['totals']['rps']):>24}")
+
+
+def _fmt(value):
+    return '-' if value is None else f"{value:g}"
+
+
+def _delta(old, new):
+    if old is None or new is None:
+        return '-'
+    if not old:
+        return f"{old:.4g} -> {new:.4g}"
+    return f"{old:.4g} -> {new:.4g} ({(new - old) / old * 100:+.0f}%)"
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(text):
+    """'provider_find_patient=30,system_info=0' -> weight overrides"""
+    weights = {}
+    for item in filter(None, text.split(',')):
+        name, _, weight = item.partition('=')
+        if name not in FLOWS:
+            raise SystemExit(f"Unknown flow {name}; choose from {', '.join(FLOWS)}")
+        weights[name] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', help='Live server; default is the in-process test client')
+    parser.add_argument('--sessions', type=int, default=1000, help='USSD sessions to run')
+    parser.add_argument('--users', type=int, default=100, help='Concurrent sessions')
+    parser.add_argument('--think', type=float, default=0.0, help='Mean seconds between hops')
+    parser.add_argument('--ramp', type=float, default=0.0, help='Seconds over which users start')
+    parser.add_argument('--duration', type=float, default=None, help='Stop starting sessions after this many seconds')
+    parser.add_argument('--mix', default='', help='Flow weight overrides, e.g. provider_new_record=0')
+    parser.add_argument('--no-writes', action='store_true', help='Leave out flows that create records')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--save', help='Write results as a JSON baseline')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's own output")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    flows = dict(FLOWS)
+    for name, weight in parse_mix(args.mix).items():
+        flows[name] = (weight,) + flows[name][1:]
+    if args.no_writes:
+        for name in WRITE_FLOWS:
+            flows.pop(name, None)
+    flows = {name: flow for name, flow in flows.items() if flow[0] > 0}
+
+    target = HttpTarget(args.url) if args.url else TestClientTarget()
+    test = LoadTest(target, flows, args.sessions, args.users, args.think,
+                    args.ramp, args.duration)
+
+    # The app prints a line per USSD request; keep it out of the report
+    quiet = open(os.devnull, 'w') if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        test.run()
+    if quiet:
+        quiet.close()
+
+    totals, nodes = summarise(test.samples, test.elapsed)
+    result = {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'target': target.name,
+        'settings': {'sessions': args.sessions, 'users': args.users, 'think': args.think,
+                     'ramp': args.ramp, 'duration': args.duration, 'seed': args.seed,
+                     'flows': {name: flow[0] for name, flow in flows.items()}},
+        'elapsed_s': round(test.elapsed, 3),
+        'completed': dict(test.completed),
+        'ended_early': dict(test.ended_early),
+        'totals': totals,
+        'nodes': nodes
+    }
+    print_report(result)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), result)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Afya Bulk Patient Import
+Streaming CSV / NDJSON patient import with set-based deduplication
+
+Rows are read one at a time and handled in chunks. Per chunk there is one
+query for phones that already exist and one multi-row INSERT, committed
+together with the counter updates and a single audit entry. After each
+commit the last input line is written to the checkpoint, so an interrupted
+import resumes where it stopped; re-sending a committed chunk is harmless
+because its phones are already registered.
+"""
+import os
+import csv
+import json
+import time
+from datetime import datetime
+from sqlalchemy import select, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from medical_menu import validate_phone_number
+from db_routing import primary
+
+# Accepted input fields and their column limits
+FIELDS = {
+    'phone': 15,
+    'name': 100,
+    'date_of_birth': 10,
+    'gender': 10,
+    'blood_type': 5,
+    'allergies': None,
+    'emergency_contact': 15
+}
+BLOOD_TYPES = {'A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-'}
+
+# Rejects kept in the result; on_reject sees every one of them
+MAX_KEPT_REJECTS = 1000
+
+
+def detect_format(filename, content_type=None):
+    """'ndjson' for .ndjson/.jsonl or a JSON content type, else 'csv'"""
+    content_type = (content_type or '').lower()
+    if 'json' in content_type:
+        return 'ndjson'
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'csv'
+
+
+def read_rows(stream, fmt='csv'):
+    """Yield (line, row, error) from a text stream without loading it all"""
+    if fmt == 'ndjson':
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                yield line, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(row, dict):
+                yield line, None, "Expected a JSON object"
+                continue
+            yield line, row, None
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # Line of the row's last physical line; header is line 1
+            yield reader.line_num, row, None
+
+
+class ImportResult:
+    """Running totals for one import"""
+
+    def __init__(self, start_after=0):
+        self.started = time.monotonic()
+        self.last_line = start_after
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.batches = 0
+        self.rejects = []
+
+    @property
+    def rate(self):
+        return self.read / max(time.monotonic() - self.started, 1e-6)
+
+    def as_dict(self, max_rejects=100):
+        summary = {
+            'last_line': self.last_line,
+            'read': self.read,
+            'inserted': self.inserted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'rows_per_second': round(self.rate, 1)
+        }
+        if max_rejects:
+            summary['rejects'] = self.rejects[:max_rejects]
+        return summary
+
+
+class PatientImporter:
+    """Chunked patient import into the patient table"""
+
+    def __init__(self, db, model, counters=None, audit=None, chunk_size=1000,
+                 search=None):
+        self.db = db
+        self.model = model
+        self.counters = counters
+        self.audit = audit
+        self.chunk_size = chunk_size
+        self.search = search
+
+    def run(self, rows, start_after=0, checkpoint=None, on_reject=None,
+            on_batch=None):
+        """Import rows from read_rows(); returns an ImportResult
+
+        start_after skips input lines already committed by an earlier run.
+        on_reject(line, phone, reason) and on_batch(result) are called as
+        the import goes, so callers can record rejects and progress.
+        """
+        result = ImportResult(start_after)
+        for result in self.batches(rows, start_after, checkpoint, on_reject):
+            if on_batch:
+                on_batch(result)
+        return result
+
+    def batches(self, rows, start_after=0, checkpoint=None, on_reject=None):
+        """Like run(), but yields the running result after each commit"""
+        result = ImportResult(start_after)
+        chunk = []
+
+        for line, row, error in rows:
+            if line <= start_after:
+                continue
+            chunk.append((line, row, error))
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk, result, checkpoint, on_reject)
+                chunk = []
+                yield result
+
+        if chunk:
+            self._import_chunk(chunk, result, checkpoint, on_reject)
+            yield result
+
+    @primary()
+    def _import_chunk(self, chunk, result, checkpoint, on_reject):
+        skipped_before = result.duplicates + result.rejected
+
+        def reject(line, phone, reason, duplicate=False):
+            if duplicate:
+                result.duplicates += 1
+            else:
+                result.rejected += 1
+            if len(result.rejects) < MAX_KEPT_REJECTS:
+                result.rejects.append(
+                    {'line': line, 'phone': phone, 'reason': reason})
+            if on_reject:
+                on_reject(line, phone, reason)
+
+        # Validate and normalise in memory; first occurrence in the chunk wins
+        candidates = {}
+        for line, row, error in chunk:
+            result.read += 1
+            if error:
+                reject(line, None, error)
+                continue
+
+            row = {str(k).strip().lower(): v for k, v in row.items() if k}
+            values, problem = self._clean(row)
+            if problem:
+                reject(line, row.get('phone'), problem)
+            elif values['phone'] in candidates:
+                reject(line, values['phone'], "Duplicate phone in file", True)
+            else:
+                candidates[values['phone']] = (line, values)
+
+        session = self.db.session
+        try:
+            # One set-based existence check for the whole chunk
+            existing = set()
+            if candidates:
+                existing = set(session.execute(
+                    select(self.model.phone)
+                    .where(self.model.phone.in_(list(candidates)))).scalars())
+
+            for phone in existing:
+                line, _ = candidates.pop(phone)
+                reject(line, phone, "Patient already registered", True)
+
+            inserted = self._insert(session, [v for _, v in candidates.values()])
+            for phone in set(candidates) - inserted:
+                line, _ = candidates[phone]
+                reject(line, phone, "Patient already registered", True)
+
+            if inserted and self.counters is not None:
+                today = datetime.now().date().isoformat()
+                deltas = self.counters.patient_deltas(
+                    candidates[phone][1] for phone in inserted)
+                deltas.update({
+                    'patients': len(inserted),
+                    'patients:active': len(inserted),
+                    f"day:{today}:patients": len(inserted)
+                })
+                self.counters.increment(session.connection(), deltas)
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        # Core inserts skip the ORM hooks that keep the search index current
+        if inserted and self.search is not None:
+            self.search.patients_added(inserted)
+
+        result.inserted += len(inserted)
+        result.batches += 1
+        result.last_line = chunk[-1][0]
+
+        if self.audit is not None:
+            skipped = result.duplicates + result.rejected - skipped_before
+            self.audit.log(None, 'Patient_Bulk_Import',
+                           f"Lines {chunk[0][0]}-{result.last_line}: "
+                           f"{len(inserted)} inserted, {skipped} skipped")
+
+        if checkpoint:
+            self._save_checkpoint(checkpoint, result)
+
+    def _clean(self, row):
+        values = {}
+        for field, limit in FIELDS.items():
+            value = row.get(field)
+            value = str(value).strip() if value is not None else ''
+            if limit and len(value) > limit and field != 'phone':
+                return None, f"{field} longer than {limit} characters"
+            values[field] = value or None
+
+        is_valid, phone = validate_phone_number(values['phone'])
+        if not is_valid:
+            return None, phone
+        values['phone'] = phone
+
+        if values['blood_type'] and values['blood_type'].upper() not in BLOOD_TYPES:
+            return None, f"Unknown blood type {values['blood_type']}"
+        if values['blood_type']:
+            values['blood_type'] = values['blood_type'].upper()
+        if values['gender']:
+            values['gender'] = values['gender'].capitalize()
+
+        values['name'] = values['name'] or f"Patient {phone[-4:]}"
+        values['registered_at'] = datetime.now()
+        values['is_active'] = True
+        return values, None
+
+    def _insert(self, session, rows):
+        """Insert rows in one statement; returns the phones actually inserted"""
+        if not rows:
+            return set()
+
+        table = self.model.__table__
+        dialect = session.get_bind().dialect.name
+        upsert = {'postgresql': postgresql.insert,
+                  'sqlite': sqlite.insert}.get(dialect)
+
+        if upsert is None:
+            session.execute(insert(table), rows)
+            return {row['phone'] for row in rows}
+
+        # Phones registered by a concurrent writer since the check are skipped
+        stmt = upsert(table).on_conflict_do_nothing(
+            index_elements=[table.c.phone]).returning(table.c.phone)
+        return set(session.execute(stmt, rows).scalars())
+
+    def _save_checkpoint(self, path, result):
+        state = dict(result.as_dict(max_rejects=0), saved_at=datetime.now().isoformat())
+        temp = f"{path}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, path)
+
+
+def load_checkpoint(path):
+    """Last committed input line from a checkpoint file, or 0"""
+    try:
+        with open(path) as f:
+            return int(json.load(f).get('last_line', 0))
+    except (OSError, ValueError):
+        return 0
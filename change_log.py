@@ -0,0 +1,197 @@
+"""
+Afya Change Log
+Versioned change feeds in Redis for the in-memory indexes every worker keeps
+
+A worker that changes something publishes the ids it touched; the other
+workers poll the version and fetch just the ids published since the version
+their copy was built at. Without REDIS_URL there is a single worker and
+nothing to share, so publishing is a no-op and the version stays 0.
+
+ChangeLogIndex is the lifecycle the indexes share: load once per worker,
+apply this worker's commits from the session, publish them, and poll for
+everyone else's.
+"""
+import os
+import time
+import logging
+import threading
+from sqlalchemy import event
+from redis_client import get_redis
+from db_routing import primary
+
+log = logging.getLogger('afya.changes')
+
+
+class ChangeLog:
+    """<name>:version and <name>:changes, a sorted set of "<version>:<member>"
+
+    Members are scored by the version they were published at; only the
+    last `keep` are kept, so a worker that falls further behind than that
+    is told to reload everything.
+    """
+
+    def __init__(self, name, keep=1000):
+        self.name = name
+        self.version_key = f"{name}:version"
+        self.changes_key = f"{name}:changes"
+        self.keep = keep
+
+    @property
+    def enabled(self):
+        return bool(os.environ.get('REDIS_URL'))
+
+    def version(self):
+        """Latest published version (0 without Redis or when it is unreachable)"""
+        if not self.enabled:
+            return 0
+        try:
+            return int(get_redis().get(self.version_key) or 0)
+        except Exception:
+            return 0
+
+    def publish(self, members):
+        """Record changed members under a new version; returns it, or None"""
+        if not self.enabled or not members:
+            return None
+        try:
+            r = get_redis()
+            version = r.incr(self.version_key)
+            pipe = r.pipeline(transaction=True)
+            pipe.zadd(self.changes_key, {f"{version}:{member}": version for member in members})
+            pipe.zremrangebyrank(self.changes_key, 0, -self.keep - 1)
+            pipe.execute()
+            return version
+        except Exception as e:
+            log.warning("Change log publish error (%s): %s", self.name, e)
+            return None
+
+    def since(self, version):
+        """(latest version, members changed after `version`)
+
+        Members is None when the log no longer reaches back to `version`
+        and the caller has to reload everything.
+        """
+        r = get_redis()
+        latest = int(r.get(self.version_key) or 0)
+        if latest <= version:
+            return latest, []
+        changes = r.zrangebyscore(self.changes_key, version + 1, latest, withscores=True)
+        if not changes or int(changes[0][1]) > version + 1:
+            return latest, None
+        return latest, {member.split(':', 1)[1] for member, _ in changes}
+
+
+class ChangeLogIndex:
+    """An in-memory index every worker keeps in step through a ChangeLog
+
+    Changes are keyed by member, the string published to the log. A
+    subclass sets CHANGES (the log name), LABEL, THREAD and SESSION_KEY and
+    implements:
+
+        load()              rebuild everything, setting version and loaded
+        _changes(session)   {member: row or None} for the objects just flushed
+        _fetch(members)     {member: row} read from the database
+        _apply(member, row) put one member in (row) or out (None) of the index
+    """
+
+    CHANGES = None
+    LABEL = None
+    THREAD = None
+    SESSION_KEY = None
+
+    def __init__(self, db):
+        self.db = db
+        self.app = None
+        self.changes = ChangeLog(self.CHANGES)
+        self.poll_interval = 0
+        self.version = 0
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def start(self):
+        """Load the index and start the change poller in this worker"""
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        # Once per process: an index inherited from a preloading master is
+        # kept, but the poller thread has to be started again after fork
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if not self.loaded:
+                with self.app.app_context():
+                    try:
+                        self.load()
+                    finally:
+                        self.db.session.remove()
+            self._start_poller()
+            self._pid = os.getpid()
+
+    def _start_poller(self):
+        if not self.poll_interval or not self.changes.enabled:
+            return
+        self._worker = threading.Thread(
+            target=self._poll, name=self.THREAD, daemon=True)
+        self._worker.start()
+
+    # Cross-worker change log
+
+    def _publish(self, members):
+        version = self.changes.publish(members)
+        if version is not None and version == self.version + 1:
+            self.version = version  # nothing else happened in between
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.catch_up()
+            except Exception as e:
+                log.warning("%s refresh error: %s", self.LABEL, e)
+
+    @primary()
+    def catch_up(self):
+        """Apply changes other workers published since this index was built"""
+        version, changed = self.changes.since(self.version)
+        if version <= self.version:
+            return
+
+        with self.app.app_context():
+            try:
+                if changed is None:
+                    self.load()  # the log was trimmed past our version
+                    return
+                rows = self._fetch(changed)
+            finally:
+                self.db.session.remove()
+        for member in changed:
+            self._apply(member, rows.get(member))
+        self.version = max(self.version, version)
+
+    # Committed changes update this worker's index at once
+
+    def _after_flush(self, session, flush_context):
+        changes = self._changes(session)
+        if changes:
+            session.info.setdefault(self.SESSION_KEY, {}).update(changes)
+
+    def _after_commit(self, session):
+        pending = session.info.pop(self.SESSION_KEY, None)
+        if not pending:
+            return
+        if self.loaded:
+            for member, row in pending.items():
+                self._apply(member, row)
+        self._publish(set(pending))
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop(self.SESSION_KEY, None)
@@ -0,0 +1,434 @@
+"""
+Afya System Counters
+Totals kept in the system_counter table, maintained on every flush
+"""
+import os
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, date
+from sqlalchemy import event, inspect, func, case, select, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from redis_client import get_redis
+from db_routing import primary
+
+log = logging.getLogger('afya.counters')
+
+
+class SystemCounters:
+    """Per-entity totals with per-facility and per-day breakdowns
+
+    Counter names:
+        patients, providers, facilities, records     all rows
+        <kind>:active                                rows with is_active set
+        facility:<id>:<kind>                         providers/records by facility
+        day:<YYYY-MM-DD>:<kind>                      rows registered (or visits) per day
+        patients:active:<male|female|blood_type>     active patients by gender, with a blood type
+        logs, logs:ussd, logs:user                   system log rows, USSD actions, with a user
+
+    Deltas are computed from the session in after_flush and written with the
+    same connection, so they commit or roll back together with the rows they
+    count. A background pass recomputes everything from the real tables to
+    correct drift from bulk writes that bypass the ORM.
+    """
+
+    # Model class name -> counter kind
+    KINDS = {
+        'Patient': 'patients',
+        'HealthcareProvider': 'providers',
+        'HealthcareFacility': 'facilities',
+        'MedicalRecord': 'records'
+    }
+    LOCK_KEY = "counters:reconcile:lock"
+
+    def __init__(self, app=None, db=None, model=None):
+        self.app = None
+        self.db = None
+        self.model = None
+
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+
+        # Exposed through stats()
+        self.reconciles = 0
+        self.last_reconcile = None
+        self.last_drift = 0
+        self.failed = 0
+
+        if app is not None:
+            self.init_app(app, db, model)
+
+    def init_app(self, app, db, model):
+        """Bind to the app, hook the session and start reconciling"""
+        self.app = app
+        self.db = db
+        self.model = model
+        self.reconcile_interval = app.config.get(
+            'COUNTERS_RECONCILE_INTERVAL', 300)
+
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+        app.extensions['system_counters'] = self
+
+    # Reads
+
+    def get(self, name):
+        """Current value of one counter (0 if it was never touched)"""
+        return self.snapshot([name])[name]
+
+    def snapshot(self, names):
+        """Values for the given counters as a dict, by primary key lookup"""
+        self._ensure_worker()
+        names = list(names)
+        rows = self.db.session.execute(
+            select(self.model.name, self.model.value)
+            .where(self.model.name.in_(names))).all()
+        values = dict.fromkeys(names, 0)
+        values.update({name: value for name, value in rows})
+        return values
+
+    def totals(self):
+        """Headline totals for the dashboard and /health"""
+        names = []
+        for kind in self.KINDS.values():
+            names.append(kind)
+            if kind != 'records':
+                names.append(f"{kind}:active")
+        return self.snapshot(names)
+
+    def for_day(self, day=None):
+        """Rows added on a day, by kind (defaults to today)"""
+        day = (day or date.today()).isoformat()
+        values = self.snapshot(
+            f"day:{day}:{kind}" for kind in self.KINDS.values())
+        return {name.rsplit(':', 1)[1]: value for name, value in values.items()}
+
+    def for_patients(self):
+        """Active patient totals by gender and recorded blood type"""
+        values = self.snapshot(['patients:active'] + [
+            f"patients:active:{facet}" for facet in PATIENT_FACETS])
+        return {name.rsplit(':', 1)[1]: value for name, value in values.items()}
+
+    def for_logs(self):
+        """System log totals, USSD actions and rows with a user"""
+        return self.snapshot(['logs', 'logs:ussd', 'logs:user'])
+
+    def for_facility(self, facility_id):
+        """Provider and record counts for one facility"""
+        values = self.snapshot([f"facility:{facility_id}:providers",
+                                f"facility:{facility_id}:records"])
+        return {name.rsplit(':', 1)[1]: value for name, value in values.items()}
+
+    def stats(self):
+        """Reconcile pass status for monitoring"""
+        return {
+            'reconciles': self.reconciles,
+            'last_reconcile': self.last_reconcile.isoformat() if self.last_reconcile else None,
+            'last_drift': self.last_drift,
+            'failed': self.failed,
+            'interval': self.reconcile_interval
+        }
+
+    # Writes
+
+    def patient_deltas(self, rows):
+        """Deltas for active patients inserted without the ORM (dicts of values)"""
+        deltas = defaultdict(int)
+        for row in rows:
+            for name in _patient_facets(row.get('is_active'), row.get('gender'), row.get('blood_type')):
+                deltas[name] += 1
+        return deltas
+
+    def log_deltas(self, rows):
+        """Deltas for system log rows inserted without the ORM (dicts of values)"""
+        deltas = defaultdict(int)
+        for row in rows:
+            for name in _log_counters(row.get('action'), row.get('user_phone')):
+                deltas[name] += 1
+        return deltas
+
+    def increment(self, connection, deltas):
+        """Apply counter deltas on a connection, inside its transaction"""
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        # Fixed order so concurrent transactions lock counter rows alike
+        params = [{'name': name, 'value': deltas[name]}
+                  for name in sorted(deltas)]
+        table = self.model.__table__
+        upsert = self._upsert(connection)
+
+        if upsert is not None:
+            stmt = upsert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.name],
+                set_={'value': table.c.value + stmt.excluded.value,
+                      'updated_at': stmt.excluded.updated_at})
+            now = datetime.now()
+            connection.execute(
+                stmt, [dict(p, updated_at=now) for p in params])
+            return
+
+        for p in params:
+            result = connection.execute(
+                update(table).where(table.c.name == p['name'])
+                .values(value=table.c.value + p['value'],
+                        updated_at=datetime.now()))
+            if result.rowcount == 0:
+                connection.execute(
+                    insert(table).values(name=p['name'], value=p['value'],
+                                         updated_at=datetime.now()))
+
+    @primary()
+    def reconcile(self):
+        """Recompute every counter from the real tables; returns the drift
+
+        Increments committed while the counts run can be overwritten; the
+        next pass picks them up again.
+        """
+        from app import Patient, HealthcareProvider, HealthcareFacility, MedicalRecord, SystemLog
+
+        expected = defaultdict(int)
+        session = self.db.session
+
+        for model, kind in ((Patient, 'patients'),
+                            (HealthcareProvider, 'providers'),
+                            (HealthcareFacility, 'facilities')):
+            total, active = session.query(
+                func.count(model.id),
+                func.coalesce(func.sum(case((model.is_active == False, 0),
+                                            else_=1)), 0)).one()
+            expected[kind] = total
+            expected[f"{kind}:active"] = active
+
+            for day, count in session.query(
+                    func.date(model.registration_date), func.count(model.id)
+            ).group_by(func.date(model.registration_date)):
+                if day:
+                    expected[f"day:{day}:{kind}"] = count
+
+        male, female, typed = session.query(
+            _count_if(Patient.gender == 'Male'),
+            _count_if(Patient.gender == 'Female'),
+            func.count(func.nullif(Patient.blood_type, ''))
+        ).filter(func.coalesce(Patient.is_active, True) == True).one()
+        expected['patients:active:male'] = male
+        expected['patients:active:female'] = female
+        expected['patients:active:blood_type'] = typed
+
+        expected['logs'], expected['logs:ussd'], expected['logs:user'] = session.query(
+            func.count(SystemLog.id),
+            _count_if(SystemLog.action.contains('USSD')),
+            _count_if(func.coalesce(SystemLog.user_phone, '') != '')
+        ).one()
+
+        expected['records'] = session.query(func.count(MedicalRecord.id)).scalar()
+        for day, count in session.query(
+                MedicalRecord.visit_date, func.count(MedicalRecord.id)
+        ).group_by(MedicalRecord.visit_date):
+            if day:
+                expected[f"day:{day}:records"] = count
+
+        for model, kind in ((HealthcareProvider, 'providers'),
+                            (MedicalRecord, 'records')):
+            for facility_id, count in session.query(
+                    model.facility_id, func.count(model.id)
+            ).group_by(model.facility_id):
+                if facility_id is not None:
+                    expected[f"facility:{facility_id}:{kind}"] = count
+
+        current = dict(session.execute(
+            select(self.model.name, self.model.value)).all())
+        for name in current:
+            expected.setdefault(name, 0)
+
+        changed = [{'name': name, 'value': value}
+                   for name, value in sorted(expected.items())
+                   if current.get(name) != value]
+
+        table = self.model.__table__
+        now = datetime.now()
+        for p in changed:
+            if p['name'] in current:
+                session.execute(update(table).where(table.c.name == p['name'])
+                                .values(value=p['value'], updated_at=now))
+            else:
+                session.execute(insert(table).values(
+                    name=p['name'], value=p['value'], updated_at=now))
+        session.commit()
+
+        self.reconciles += 1
+        self.last_reconcile = datetime.now()
+        self.last_drift = len(changed)
+        return len(changed)
+
+    # Session hook
+
+    def _after_flush(self, session, flush_context):
+        deltas = defaultdict(int)
+
+        for obj in session.new:
+            self._count_row(obj, deltas, 1)
+        for obj in session.deleted:
+            self._count_row(obj, deltas, -1)
+        for obj in session.dirty:
+            self._count_change(obj, deltas)
+
+        if deltas:
+            self.increment(session.connection(), deltas)
+
+    def _count_row(self, obj, deltas, sign):
+        if type(obj).__name__ == 'SystemLog':
+            for name in _log_counters(obj.action, obj.user_phone):
+                deltas[name] += sign
+            return
+
+        kind = self.KINDS.get(type(obj).__name__)
+        if kind is None:
+            return
+
+        if kind == 'patients':
+            for name in _patient_facets(obj.is_active, obj.gender, obj.blood_type):
+                deltas[name] += sign
+
+        deltas[kind] += sign
+        if hasattr(obj, 'is_active') and obj.is_active is not False:
+            deltas[f"{kind}:active"] += sign
+
+        facility_id = getattr(obj, 'facility_id', None)
+        if kind in ('providers', 'records') and facility_id:
+            deltas[f"facility:{int(facility_id)}:{kind}"] += sign
+
+        day = _day(obj.visit_date if kind == 'records' else obj.registration_date)
+        if day:
+            deltas[f"day:{day}:{kind}"] += sign
+
+    def _count_change(self, obj, deltas):
+        kind = self.KINDS.get(type(obj).__name__)
+        if kind is None:
+            return
+        attrs = inspect(obj).attrs
+
+        if kind != 'records':
+            old, new = _changed(attrs.is_active)
+            if old is not new:
+                deltas[f"{kind}:active"] += (new is not False) - (old is not False)
+
+        if kind == 'patients':
+            fields = [attrs.is_active, attrs.gender, attrs.blood_type]
+            if any(attr.history.has_changes() for attr in fields):
+                for name in _patient_facets(*(_before(attr) for attr in fields)):
+                    deltas[name] -= 1
+                for name in _patient_facets(*(attr.value for attr in fields)):
+                    deltas[name] += 1
+
+        if kind in ('providers', 'records'):
+            old, new = _changed(attrs.facility_id)
+            if old is not new and str(old) != str(new):
+                if old:
+                    deltas[f"facility:{int(old)}:{kind}"] -= 1
+                if new:
+                    deltas[f"facility:{int(new)}:{kind}"] += 1
+
+    def _upsert(self, connection):
+        return {'postgresql': postgresql.insert,
+                'sqlite': sqlite.insert}.get(connection.dialect.name)
+
+    # Background reconcile
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so start lazily in each worker process
+        if self._pid == os.getpid() and self._worker is not None and self._worker.is_alive():
+            return
+        if not self.reconcile_interval:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._worker is not None and self._worker.is_alive():
+                return
+            self._pid = os.getpid()
+            self._worker = threading.Thread(
+                target=self._run, name='afya-counters', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            if not self._claim_pass():
+                continue
+            with self.app.app_context():
+                try:
+                    drift = self.reconcile()
+                    if drift:
+                        log.info("Counters reconciled, %d corrected", drift)
+                except Exception as e:
+                    self.db.session.rollback()
+                    self.failed += 1
+                    log.error("Counter reconcile error: %s", e)
+                finally:
+                    self.db.session.remove()
+
+    def _claim_pass(self):
+        # One reconcile per interval across all workers sharing Redis
+        try:
+            return bool(get_redis().set(
+                self.LOCK_KEY, os.getpid(), nx=True,
+                ex=max(int(self.reconcile_interval) - 1, 1)))
+        except Exception:
+            return True
+
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+# patients:active:<facet> counters
+PATIENT_FACETS = ('male', 'female', 'blood_type')
+
+
+def _patient_facets(is_active, gender, blood_type):
+    if is_active is False:
+        return []
+    names = []
+    if gender in ('Male', 'Female'):
+        names.append(f"patients:active:{gender.lower()}")
+    if blood_type:
+        names.append('patients:active:blood_type')
+    return names
+
+
+def _log_counters(action, user_phone):
+    names = ['logs']
+    if action and 'USSD' in action:
+        names.append('logs:ussd')
+    if user_phone:
+        names.append('logs:user')
+    return names
+
+
+def _before(attr):
+    # Value before this flush's change, or the current value if unchanged
+    history = attr.history
+    if not history.has_changes():
+        return attr.value
+    return history.deleted[0] if history.deleted else None
+
+
+def _changed(attr):
+    history = attr.history
+    if not history.has_changes():
+        return None, None
+    old = history.deleted[0] if history.deleted else None
+    new = history.added[0] if history.added else None
+    return old, new
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return None
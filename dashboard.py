@@ -0,0 +1,135 @@
+"""
+Afya Dashboard Snapshot
+Headline numbers and recent activity, built once and shared through Redis
+"""
+import os
+import json
+import logging
+import time
+import redis
+from datetime import date
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from redis_client import get_redis
+
+log = logging.getLogger('afya.dashboard')
+
+
+class DashboardSnapshot:
+    """Compact dashboard data cached under dashboard:snapshot
+
+    The snapshot is rebuilt at most once per TTL (or after a medical record
+    is committed), with a short lock so a burst of dashboard views after an
+    invalidation triggers one rebuild instead of one per viewer.
+    """
+
+    KEY = "dashboard:snapshot"
+    LOCK_KEY = "dashboard:snapshot:lock"
+    RECENT_LIMIT = 5
+
+    def __init__(self, db, counters, ttl=None):
+        self.db = db
+        self.counters = counters
+        self.r = get_redis()
+        self.ttl = ttl or int(os.environ.get('DASHBOARD_CACHE_TTL', 30))
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def get(self):
+        """The current snapshot, rebuilt if missing or expired"""
+        try:
+            cached = self.r.get(self.KEY)
+            if cached is None and not self._claim_rebuild():
+                cached = self._wait_for_rebuild()
+        except redis.RedisError:
+            return self.build()
+
+        if cached is not None:
+            return self._load(cached)
+
+        snapshot = self.build()
+        try:
+            pipe = self.r.pipeline(transaction=True)
+            pipe.set(self.KEY, self._dump(snapshot), ex=self.ttl)
+            pipe.delete(self.LOCK_KEY)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+        return snapshot
+
+    def build(self):
+        """Read the totals from the counters and recent records in one query"""
+        from app import MedicalRecord
+
+        totals = self.counters.totals()
+        records = MedicalRecord.query.options(
+            joinedload(MedicalRecord.patient),
+            joinedload(MedicalRecord.provider),
+            joinedload(MedicalRecord.facility)
+        ).order_by(MedicalRecord.id.desc()).limit(self.RECENT_LIMIT).all()
+
+        return {
+            'total_patients': totals['patients'],
+            'total_providers': totals['providers'],
+            'total_facilities': totals['facilities'],
+            'recent_records': [{
+                'id': record.id,
+                'visit_date': record.visit_date,
+                'patient_name': record.patient.name if record.patient else '',
+                'patient_phone': record.patient.phone if record.patient else '',
+                'provider_name': record.provider.name if record.provider else '',
+                'facility_name': record.facility.name if record.facility else '',
+                'diagnosis': record.diagnosis
+            } for record in records]
+        }
+
+    def invalidate(self):
+        """Drop the cached snapshot so the next view rebuilds it"""
+        try:
+            self.r.delete(self.KEY)
+        except redis.RedisError as e:
+            log.warning("Dashboard cache invalidation error: %s", e)
+
+    def _claim_rebuild(self):
+        return bool(self.r.set(self.LOCK_KEY, os.getpid(), nx=True, ex=5))
+
+    def _wait_for_rebuild(self, timeout=0.5):
+        # Another worker is rebuilding; give it a moment before building too
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            cached = self.r.get(self.KEY)
+            if cached is not None:
+                return cached
+        return None
+
+    def _dump(self, snapshot):
+        records = [dict(record, visit_date=record['visit_date'].isoformat()
+                        if record['visit_date'] else None)
+                   for record in snapshot['recent_records']]
+        return json.dumps(dict(snapshot, recent_records=records))
+
+    def _load(self, cached):
+        snapshot = json.loads(cached)
+        for record in snapshot['recent_records']:
+            if record['visit_date']:
+                record['visit_date'] = date.fromisoformat(record['visit_date'])
+        return snapshot
+
+    # New medical records invalidate the snapshot once they are committed
+
+    def _after_flush(self, session, flush_context):
+        from app import MedicalRecord
+
+        if any(isinstance(obj, MedicalRecord)
+               for obj in list(session.new) + list(session.deleted)):
+            session.info['dashboard_stale'] = True
+
+    def _after_commit(self, session):
+        if session.info.pop('dashboard_stale', False):
+            self.invalidate()
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('dashboard_stale', None)
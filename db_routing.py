@@ -0,0 +1,252 @@
+"""
+Afya Database Routing
+Read replicas for read-only queries, and instrumented connection pools
+
+Replicas are listed in DATABASE_REPLICA_URLS and become the Flask-SQLAlchemy
+binds replica-1, replica-2, ... with the same pool settings as the primary
+(each pool is per worker process and per database).
+db.session is a RoutingSession, which sends a statement to a replica only
+when all of these hold:
+
+    it is a SELECT (not SELECT ... FOR UPDATE) or SELECT text
+    this session has not written anything yet
+    the thread is not inside primary() (cache builders, check-then-write)
+    the browser has not written within REPLICA_STICKY_SECONDS (a cookie)
+
+Everything else, including session.connection() and flushes, goes to the
+primary. A replica that fails to connect is skipped for
+REPLICA_RETRY_SECONDS. To try it locally with SQLite, copy the database
+(with .backup, which includes the WAL) and point a replica at the copy:
+
+    sqlite3 instance/afya_medical.sqlite3 ".backup instance/replica.sqlite3"
+    DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3 flask run
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from flask import current_app, has_request_context, session as cookie
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select, TextClause
+
+log = logging.getLogger('afya.db')
+
+REPLICA_PREFIX = 'replica-'
+STICKY_COOKIE = 'db_primary_until'
+
+_local = threading.local()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """Queue pool that counts checkouts, waits for a free connection and timeouts"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        # Every connection is checked out and the overflow is used up
+        waited = self._pool.empty() and 0 <= self._max_overflow <= self._overflow
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            if waited:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+        self.checkouts += 1
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep the counters going
+        pool = super().recreate()
+        pool.checkouts, pool.waits = self.checkouts, self.waits
+        pool.wait_time, pool.timeouts = self.wait_time, self.timeouts
+        return pool
+
+    def stats(self):
+        """Pool utilisation counters for monitoring"""
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'in_use': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(0, self.overflow()),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time_ms': round(self.wait_time * 1000, 2),
+            'timeouts': self.timeouts
+        }
+
+
+def database_url(url):
+    """SQLAlchemy URL for a DATABASE_URL (Heroku-style postgres:// included)"""
+    url = url.strip()
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
+
+
+def engine_options(url, pool_size, max_overflow, timeout, recycle, pre_ping):
+    """SQLALCHEMY_ENGINE_OPTIONS for the primary"""
+    options = {'logging_name': 'primary', 'pool_pre_ping': pre_ping}
+    database = make_url(url).database
+    if url.startswith('sqlite') and database in (None, '', ':memory:'):
+        return options  # one shared in-memory connection, no pool to size
+    options.update(poolclass=InstrumentedQueuePool, pool_size=pool_size,
+                   max_overflow=max_overflow, pool_timeout=timeout, pool_recycle=recycle)
+    return options
+
+
+def replica_binds(urls, options):
+    """SQLALCHEMY_BINDS for comma separated replica URLs, pooled like the primary"""
+    urls = [database_url(url) for url in urls.split(',') if url.strip()]
+    return {f"{REPLICA_PREFIX}{n}": dict(options, url=url, logging_name=f"{REPLICA_PREFIX}{n}")
+            for n, url in enumerate(urls, 1)}
+
+
+@contextmanager
+def primary():
+    """Send this thread's reads to the primary inside the block
+
+    For reads that must see the latest commit: cache and index builders
+    that run because of a commit, and checks made just before a write.
+    Also usable as a decorator.
+    """
+    _local.primary = getattr(_local, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary -= 1
+
+
+class RoutingSession(Session):
+    """db.session: read-only statements to a replica when DatabaseRouter allows"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _is_read(clause):
+            router = current_app.extensions.get('db_router')
+            if router is not None and router.replicas:
+                replica = router.replica_for(self)
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_read(clause):
+    if isinstance(clause, Select):
+        return clause._for_update_arg is None
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == 'SELECT'
+    return False
+
+
+class DatabaseRouter:
+    """Chooses a replica for each session's reads and reports every pool's use"""
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.engines = {}
+        self.replicas = []
+        self.down = {}      # replica -> time.monotonic() it may be tried again
+        self._turn = 0
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(Engine, 'handle_error', self._engine_error)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the REPLICA_* settings; call after db.init_app(app)"""
+        self.sticky = app.config.get('REPLICA_STICKY_SECONDS', 5)
+        self.retry = app.config.get('REPLICA_RETRY_SECONDS', 30)
+        with app.app_context():
+            self.engines = {key or 'primary': engine for key, engine in self.db.engines.items()}
+        self.replicas = sorted(key for key in self.engines if key.startswith(REPLICA_PREFIX))
+        app.extensions['db_router'] = self
+
+    # Routing
+
+    def replica_for(self, session):
+        """The replica engine this session reads from, or None for the primary"""
+        if getattr(_local, 'primary', 0) or session.info.get('wrote'):
+            return None
+        if has_request_context() and cookie.get(STICKY_COOKIE, 0) > time.time():
+            return None
+
+        key = session.info.get('replica')
+        now = time.monotonic()
+        if key is None or self.down.get(key, 0) > now:
+            up = [key for key in self.replicas if self.down.get(key, 0) <= now]
+            if not up:
+                return None
+            self._turn += 1
+            key = session.info['replica'] = up[self._turn % len(up)]
+        return self.engines[key]
+
+    def _after_flush(self, session, flush_context):
+        # Read your writes: the rest of this session reads the primary
+        session.info['wrote'] = True
+
+    def _after_commit(self, session):
+        # ... and so does the browser that wrote, for the next few requests
+        if session.info.get('wrote'):
+            self.wrote()
+
+    def wrote(self):
+        """Send this browser's reads to the primary for REPLICA_STICKY_SECONDS"""
+        if self.replicas and self.sticky and has_request_context():
+            cookie[STICKY_COOKIE] = time.time() + self.sticky
+
+    def _engine_error(self, context):
+        name = context.engine.logging_name if context.engine is not None else None
+        if name in self.replicas and (context.is_disconnect or context.connection is None):
+            if self.down.get(name, 0) <= time.monotonic():
+                log.warning("Replica %s unavailable, reading from the primary for %ss: %s",
+                            name, self.retry, context.original_exception)
+            self.down[name] = time.monotonic() + self.retry
+
+    # Monitoring
+
+    def dispose(self):
+        """Drop connections inherited from a preloading master"""
+        for engine in self.engines.values():
+            engine.dispose(close=False)
+
+    def pool_stats(self):
+        """{pool: utilisation} for /health"""
+        stats = {}
+        for name, engine in self.engines.items():
+            pool = engine.pool
+            stats[name] = pool.stats() if isinstance(pool, InstrumentedQueuePool) else \
+                {'pool': type(pool).__name__, 'status': pool.status()}
+            if name in self.down:
+                stats[name]['down'] = self.down[name] > time.monotonic()
+        return stats
+
+    def metrics(self):
+        """(name, labels, value) series for Metrics.collect"""
+        series = []
+        for name, stats in self.pool_stats().items():
+            if 'in_use' not in stats:
+                continue
+            pool = (('pool', name),)
+            for state in ('in_use', 'idle', 'overflow'):
+                series.append(('afya_db_pool_connections', pool + (('state', state),), stats[state]))
+            series.append(('afya_db_pool_size', pool, stats['size']))
+            series.append(('afya_db_pool_checkouts_total', pool, stats['checkouts']))
+            series.append(('afya_db_pool_waits_total', pool, stats['waits']))
+            series.append(('afya_db_pool_wait_seconds_total', pool, stats['wait_time_ms'] / 1000))
+            series.append(('afya_db_pool_timeouts_total', pool, stats['timeouts']))
+        return series
@@ -0,0 +1,305 @@
+"""
+Afya Emergency Cards
+The emergency info screen, answered within a fixed budget even with the database down
+
+A card (blood type, allergies, recent conditions, emergency contact) is kept
+per phone in Redis, and the cards this worker has seen are also kept in
+memory for when Redis is unreachable too. Reads never touch the database:
+
+    fresh card    returned                                           hit
+    stale card    returned; a background refresh is queued           stale
+    no card       a refresh is queued and awaited for at most        miss
+                  EMERGENCY_CARD_BUDGET seconds; past that the
+                  caller gets the fallback screen and the card is    timeout
+                  there for the next try
+
+Refreshes run on a small thread pool, so the USSD hop never waits on a cold
+or slow database connection for longer than the budget. Commits touching a
+patient or their records mark the card stale rather than deleting it: the
+last known card is always there to fall back on.
+"""
+import os
+import time
+import logging
+import threading
+import redis
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import date
+from sqlalchemy import event, inspect, text as sql_text
+from patient_summary import fit_screen
+from redis_client import get_redis
+from db_routing import primary
+
+log = logging.getLogger('afya.emergency')
+
+
+# Store a rebuilt card; fresh only if no mark_stale() ran since the build began
+STORE_CARD_SCRIPT = """
+local built = ARGV[2]
+if (redis.call('HGET', KEYS[1], 'gen') or '0') ~= ARGV[1] then
+    built = '0'
+end
+redis.call('HSET', KEYS[1], 'screen', ARGV[3], 'built', built)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return built ~= '0' and 1 or 0
+"""
+
+
+class EmergencyCards:
+    """Read-through, stale-while-revalidate cache of emergency info screens
+
+    Cards live under emergency:card:<phone> as a hash of the rendered
+    screen ('' when the phone has no active patient), the time it was
+    built and a generation that mark_stale() increments. A rebuild that
+    read the database before a commit finishes after it, so it is stored
+    as stale if the generation moved while it was building. Read results
+    are counted in afya_emergency_card_total{result}.
+    """
+
+    KEY_PREFIX = "emergency:card:"
+    CONDITIONS = 3
+    LOCAL_CARDS = 10000
+
+    def __init__(self, db, app=None, metrics=None):
+        self.db = db
+        self.app = None
+        self.metrics = None
+        self.r = get_redis()
+
+        self.local = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = {}
+        self._invalidated = set()   # phones marked stale while being rebuilt here
+        self._executor = None
+        self._pid = None
+        self._store = self.r.register_script(STORE_CARD_SCRIPT)
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+        if app is not None:
+            self.init_app(app, metrics)
+
+    def init_app(self, app, metrics=None):
+        """Read the EMERGENCY_CARD_* settings; metrics counts the read results"""
+        self.app = app
+        self.metrics = metrics
+        self.fresh_for = app.config.get('EMERGENCY_CARD_FRESH', 300)
+        self.ttl = app.config.get('EMERGENCY_CARD_TTL', 30 * 86400)
+        self.budget = app.config.get('EMERGENCY_CARD_BUDGET', 0.5)
+        self.threads = app.config.get('EMERGENCY_CARD_THREADS', 2)
+        app.extensions['emergency_cards'] = self
+
+    def key(self, phone):
+        return f"{self.KEY_PREFIX}{phone}"
+
+    # Reads
+
+    def get(self, phone):
+        """Card text; '' if the phone has no patient, None if none was ready in time"""
+        card = self._read(phone)
+        if card is not None:
+            if time.time() - card['built'] < self.fresh_for:
+                self._count('hit')
+            else:
+                self._count('stale')
+                self.refresh(phone)
+            return card['screen']
+
+        try:
+            card = self.refresh(phone).result(timeout=self.budget)
+        except FutureTimeout:
+            self._count('timeout')
+            return None
+        except Exception:
+            self._count('error')
+            return None
+        self._count('miss')
+        return card['screen']
+
+    def refresh(self, phone):
+        """Queue a rebuild of one card (at most one per phone at a time)"""
+        executor = self._ensure_executor()
+        with self._lock:
+            future = self._refreshing.get(phone)
+            if future is None:
+                future = self._refreshing[phone] = executor.submit(self._rebuild, phone)
+                future.add_done_callback(lambda done: self._refreshed(phone, done))
+            return future
+
+    @primary()
+    def build(self, phone):
+        """Card screen from the database: the patient and their recent diagnoses"""
+        from app import Patient, MedicalRecord
+
+        patient = Patient.query.filter_by(phone=phone, is_active=True).first()
+        if not patient:
+            return ''
+
+        diagnoses = self.db.session.query(MedicalRecord.diagnosis).filter(
+            MedicalRecord.patient_id == patient.id,
+            MedicalRecord.diagnosis.isnot(None),
+            MedicalRecord.diagnosis != 'To be determined'
+        ).order_by(MedicalRecord.visit_date.desc(), MedicalRecord.id.desc()).limit(10).all()
+        conditions = list(dict.fromkeys(row.diagnosis for row in diagnoses))[:self.CONDITIONS]
+
+        return fit_screen([
+            "EMERGENCY INFO",
+            "",
+            f"Name: {patient.name}",
+            f"Blood Type: {patient.blood_type or 'Unknown'}",
+            f"Allergies: {patient.allergies or 'None known'}",
+            f"Conditions: {', '.join(conditions) or 'None recorded'}",
+            f"Contact: {patient.emergency_contact or 'None'}",
+            f"Updated {date.today().strftime('%d/%m/%y')}",
+            "",
+            "Show this to doctors"
+        ])
+
+    # Storage
+
+    def _read(self, phone):
+        try:
+            card = self.r.hgetall(self.key(phone))
+        except redis.RedisError as e:
+            log.warning("Emergency card read error: %s", e)
+            with self._lock:
+                return self.local.get(phone)
+
+        if 'screen' not in card:
+            return None
+        card = {'screen': card['screen'], 'built': float(card.get('built') or 0)}
+        self._remember(phone, card)
+        return card
+
+    def _generation(self, phone):
+        try:
+            return self.r.hget(self.key(phone), 'gen') or '0'
+        except redis.RedisError:
+            return ''  # unknown; the card will be stored as stale
+
+    def _write(self, phone, card, generation):
+        """Store a rebuilt card; returns it as stored (built 0 if already stale)"""
+        fresh = True
+        try:
+            fresh = bool(self._store(keys=[self.key(phone)],
+                                     args=[generation, card['built'], card['screen'], self.ttl]))
+        except redis.RedisError as e:
+            log.warning("Emergency card write error: %s", e)
+        with self._lock:
+            if phone in self._invalidated:
+                self._invalidated.discard(phone)
+                fresh = False
+        if not fresh:
+            card = dict(card, built=0)
+        self._remember(phone, card)
+        return card
+
+    def _remember(self, phone, card):
+        with self._lock:
+            self.local[phone] = card
+            self.local.move_to_end(phone)
+            while len(self.local) > self.LOCAL_CARDS:
+                self.local.popitem(last=False)
+
+    def mark_stale(self, phones):
+        """Keep the cards but have the next read refresh them"""
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for phone in phones:
+                # A phone without a card gets bare fields, which read as a miss
+                pipe.hincrby(self.key(phone), 'gen', 1)
+                pipe.hset(self.key(phone), 'built', 0)
+                pipe.expire(self.key(phone), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            log.warning("Emergency card invalidation error: %s", e)
+        with self._lock:
+            for phone in phones:
+                if phone in self.local:
+                    self.local[phone] = dict(self.local[phone], built=0)
+                if phone in self._refreshing:
+                    self._invalidated.add(phone)
+
+    # Refresh pool
+
+    def start(self):
+        """Start the refresh threads and open their database connections"""
+        executor = self._ensure_executor()
+        for _ in range(self.threads):
+            executor.submit(self._ping)
+
+    def _ensure_executor(self):
+        # Threads do not survive fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.threads, thread_name_prefix='afya-emergency')
+                self._refreshing = {}
+                self._invalidated = set()
+                self._pid = os.getpid()
+        return self._executor
+
+    def _ping(self):
+        with self.app.app_context():
+            try:
+                self.db.session.execute(sql_text("SELECT 1"))
+            except Exception as e:
+                log.warning("Emergency card warm-up error: %s", e)
+            finally:
+                self.db.session.remove()
+
+    def _rebuild(self, phone):
+        started = time.perf_counter()
+        with self._lock:
+            self._invalidated.discard(phone)
+        generation = self._generation(phone)
+        with self.app.app_context():
+            try:
+                card = {'screen': self.build(phone), 'built': time.time()}
+            finally:
+                self.db.session.remove()
+        card = self._write(phone, card, generation)
+        if self.metrics is not None:
+            self.metrics.observe('afya_emergency_card_build_seconds', (),
+                                 time.perf_counter() - started)
+        return card
+
+    def _refreshed(self, phone, future):
+        with self._lock:
+            if self._refreshing.get(phone) is future:
+                del self._refreshing[phone]
+        if future.exception() is not None:
+            log.warning("Emergency card refresh error: %s", future.exception())
+
+    def _count(self, result):
+        if self.metrics is not None:
+            self.metrics.inc('afya_emergency_card_total', (('result', result),))
+
+    # Commits that touch a patient or their records make their card stale
+
+    def _after_flush(self, session, flush_context):
+        from app import Patient, MedicalRecord
+
+        phones = session.info.setdefault('emergency_stale', set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Patient):
+                phones.add(obj.phone)
+                phones.update(inspect(obj).attrs.phone.history.deleted or ())
+            elif isinstance(obj, MedicalRecord):
+                with session.no_autoflush:
+                    patient = session.get(Patient, obj.patient_id)
+                if patient is not None:
+                    phones.add(patient.phone)
+
+    def _after_commit(self, session):
+        phones = session.info.pop('emergency_stale', None)
+        if phones:
+            self.mark_stale(phones)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('emergency_stale', None)
@@ -0,0 +1,112 @@
+"""
+Afya Records Export
+Streaming CSV / NDJSON export of medical records, optionally gzipped
+
+Rows are read through a server-side cursor in yield_per batches as plain
+tuples (no ORM objects) and written out batch by batch, so memory stays
+flat whatever the size of the export.
+"""
+import io
+import csv
+import json
+import zlib
+from datetime import date
+from sqlalchemy import select
+
+COLUMNS = (
+    'record_id', 'visit_date', 'facility_id', 'facility_name',
+    'provider_id', 'provider_name', 'patient_id', 'patient_name',
+    'patient_phone', 'chief_complaint', 'diagnosis', 'treatment_plan', 'notes'
+)
+FORMATS = ('csv', 'ndjson')
+
+# Rows fetched per round trip, and text buffered per yielded chunk
+YIELD_PER = 1000
+CHUNK_BYTES = 64 * 1024
+
+
+def records_query(facility_id=None, start=None, end=None):
+    """Records joined with names, in (visit date, id) order"""
+    from app import MedicalRecord, Patient, HealthcareProvider, HealthcareFacility
+
+    query = select(
+        MedicalRecord.id, MedicalRecord.visit_date,
+        MedicalRecord.facility_id, HealthcareFacility.name,
+        MedicalRecord.provider_id, HealthcareProvider.name,
+        MedicalRecord.patient_id, Patient.name, Patient.phone,
+        MedicalRecord.chief_complaint, MedicalRecord.diagnosis,
+        MedicalRecord.treatment_plan, MedicalRecord.notes
+    ).join(Patient, MedicalRecord.patient_id == Patient.id
+           ).join(HealthcareProvider, MedicalRecord.provider_id == HealthcareProvider.id
+                  ).join(HealthcareFacility, MedicalRecord.facility_id == HealthcareFacility.id)
+
+    # Served by the (facility_id, visit_on) index
+    if facility_id is not None:
+        query = query.where(MedicalRecord.facility_id == facility_id)
+    if start is not None:
+        query = query.where(MedicalRecord.visit_date >= start)
+    if end is not None:
+        query = query.where(MedicalRecord.visit_date <= end)
+
+    return query.order_by(MedicalRecord.visit_date, MedicalRecord.id)
+
+
+def stream_rows(session, query):
+    """Yield result rows through a server-side cursor"""
+    result = session.execute(
+        query.execution_options(yield_per=YIELD_PER, stream_results=True))
+    try:
+        for row in result:
+            yield row
+    finally:
+        result.close()
+
+
+def _value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def encode(rows, fmt='csv'):
+    """Encode rows as CSV (with header) or NDJSON text, in ~64KB chunks"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(COLUMNS)
+
+    for row in rows:
+        values = [_value(v) for v in row]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(COLUMNS, values))))
+            buffer.write('\n')
+
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_records(session, fmt='csv', facility_id=None, start=None, end=None,
+                   compress=False):
+    """Chunks (str, or bytes if compress) of a records export"""
+    chunks = encode(stream_rows(session, records_query(facility_id, start, end)), fmt)
+    return gzip_chunks(chunks) if compress else chunks
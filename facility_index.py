@@ -0,0 +1,314 @@
+"""
+Afya Facility Index
+Nearest active facilities from an in-memory grid, without touching the database
+
+Every worker keeps the active facilities that have coordinates in a grid of
+CELL_DEGREES cells. A nearest-N query searches rings of cells outward from
+the caller's cell and stops once no unsearched cell can hold anything
+closer, so it only looks at the facilities around the caller.
+
+The grid is loaded once per worker and then kept current incrementally:
+registrations and status changes committed in this worker are applied
+straight from the session, and published to the facilities:index change
+log (change_log.py). A background thread in every other worker polls it
+and reloads just the changed facilities by id; ChangeLogIndex runs that
+lifecycle.
+
+Callers are placed by a lookup table: fixed-line area codes (0302 Accra,
+0322 Kumasi ...) name a town, and everything else (mobile numbers are not
+tied to a place in Ghana) falls back to FACILITY_DEFAULT_PLACE.
+"""
+import math
+import heapq
+import logging
+from change_log import ChangeLogIndex
+from db_routing import primary
+
+log = logging.getLogger('afya.facilities')
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Towns and neighbourhoods facilities' free-text locations are matched
+# against, and that callers are placed at: name -> (latitude, longitude)
+PLACES = {
+    'accra': (5.6037, -0.1870),
+    'ridge': (5.5630, -0.1990),
+    'korle bu': (5.5364, -0.2270),
+    'madina': (5.6680, -0.1660),
+    'tema': (5.6698, -0.0166),
+    'kasoa': (5.5340, -0.4168),
+    'winneba': (5.3511, -0.6231),
+    'cape coast': (5.1053, -1.2466),
+    'takoradi': (4.8845, -1.7554),
+    'sekondi': (4.9340, -1.7137),
+    'tarkwa': (5.3006, -1.9959),
+    'koforidua': (6.0940, -0.2591),
+    'nkawkaw': (6.5500, -0.7667),
+    'kumasi': (6.6885, -1.6244),
+    'obuasi': (6.2012, -1.6913),
+    'sunyani': (7.3349, -2.3123),
+    'techiman': (7.5909, -1.9344),
+    'goaso': (6.8000, -2.5167),
+    'sefwi wiawso': (6.2058, -2.4853),
+    'ho': (6.6008, 0.4713),
+    'hohoe': (7.1519, 0.4734),
+    'dambai': (8.0667, 0.1833),
+    'tamale': (9.4008, -0.8393),
+    'yendi': (9.4427, -0.0099),
+    'damongo': (9.0833, -1.8167),
+    'nalerigu': (10.5273, -0.3698),
+    'bolgatanga': (10.7856, -0.8514),
+    'wa': (10.0601, -2.5099),
+}
+
+# Fixed-line area codes -> place
+PHONE_PREFIXES = {
+    '0302': 'accra', '0303': 'tema', '0312': 'takoradi', '0322': 'kumasi',
+    '0332': 'cape coast', '0342': 'koforidua', '0352': 'sunyani',
+    '0362': 'ho', '0372': 'tamale', '0382': 'bolgatanga', '0392': 'wa',
+}
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def geocode(location):
+    """Coordinates of the first known place named in a location, or None
+
+    Locations are written most specific first ("Ridge, Accra"), so the
+    earliest match wins.
+    """
+    text = f" {(location or '').lower().replace(',', ' ')} "
+    best = None
+    for name, point in PLACES.items():
+        at = text.find(f" {name} ")
+        if at >= 0 and (best is None or at < best[0] or (at == best[0] and len(name) > best[1])):
+            best = (at, len(name), point)
+    return best[2] if best else None
+
+
+def place_for_phone(phone, default):
+    """(place name, coordinates) for a caller, by area code"""
+    name = PHONE_PREFIXES.get((phone or '')[:4], default)
+    return name, PLACES.get(name)
+
+
+class FacilityGrid:
+    """Points in square cells of CELL_DEGREES, with ring-by-ring nearest search
+
+    Distances are compared as the haversine term a = sin²(Δφ/2) +
+    cos φ1 cos φ2 sin²(Δλ/2), which orders points the same way as the
+    distance itself; only the n answers are converted to kilometres. A cell
+    or ring is skipped once a lower bound on its a is no better than the
+    n-th point found so far.
+    """
+
+    CELL_DEGREES = 0.05  # about 5.5 km
+
+    def __init__(self, cell_degrees=None):
+        self.cell = cell_degrees or self.CELL_DEGREES
+        self.cells = {}
+        self.entries = {}  # id -> cell
+        self.bounds = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell), math.floor(longitude / self.cell))
+
+    def add(self, id, latitude, longitude, data):
+        """Insert or move one point"""
+        self.remove(id)
+        cell = self._cell(latitude, longitude)
+        phi = math.radians(latitude)
+        self.cells.setdefault(cell, {})[id] = (phi, math.radians(longitude), math.cos(phi), data)
+        self.entries[id] = cell
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            b = self.bounds
+            b[0], b[1] = min(b[0], cell[0]), max(b[1], cell[0])
+            b[2], b[3] = min(b[2], cell[1]), max(b[3], cell[1])
+
+    def remove(self, id):
+        cell = self.entries.pop(id, None)
+        if cell is not None:
+            bucket = self.cells[cell]
+            del bucket[id]
+            if not bucket:
+                del self.cells[cell]
+
+    def nearest(self, latitude, longitude, n=2):
+        """[(distance_km, data)] for the n nearest points, closest first"""
+        if not self.entries or n < 1:
+            return []
+        sin, cos = math.sin, math.cos
+        phi1, lam1 = math.radians(latitude), math.radians(longitude)
+        cos1 = cos(phi1)
+        ci, cj = self._cell(latitude, longitude)
+        b = self.bounds
+        max_ring = max(abs(ci - b[0]), abs(ci - b[1]), abs(cj - b[2]), abs(cj - b[3]))
+        half_cell = math.radians(self.cell) / 2
+
+        best = []  # max-heap of the n best so far: (-a, tiebreak, data)
+        worst = math.inf
+        for ring in range(max_ring + 1):
+            for cell in self._ring(ci, cj, ring):
+                bucket = self.cells.get(cell)
+                if not bucket:
+                    continue
+                if worst < math.inf and self._cell_bound(cell, latitude, longitude) >= worst:
+                    continue
+                for key, (phi2, lam2, cos2, data) in bucket.items():
+                    a = sin((phi2 - phi1) / 2) ** 2 + cos1 * cos2 * sin((lam2 - lam1) / 2) ** 2
+                    if a < worst:
+                        if len(best) == n:
+                            heapq.heapreplace(best, (-a, key, data))
+                        else:
+                            heapq.heappush(best, (-a, key, data))
+                        if len(best) == n:
+                            worst = -best[0][0]
+
+            # Everything outside ring r is at least r cells away along either
+            # axis, and a degree of longitude is shortest at the highest
+            # latitude it could lie at
+            edge = math.radians(min(90.0, abs(latitude) + (ring + 1) * self.cell))
+            if cos(edge) ** 2 * sin(ring * half_cell) ** 2 >= worst:
+                break
+
+        found = sorted((-a, data) for a, _, data in best)
+        return [(2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a))), data)
+                for a, data in found]
+
+    def _cell_bound(self, cell, latitude, longitude):
+        # Lower bound on a for any point of the cell: the gap to its edges
+        # along each axis, longitude at the cell's highest latitude
+        low, high = cell[0] * self.cell, (cell[0] + 1) * self.cell
+        west, east = cell[1] * self.cell, (cell[1] + 1) * self.cell
+        d_lat = max(low - latitude, latitude - high, 0.0)
+        d_lon = max(west - longitude, longitude - east, 0.0)
+        top = math.radians(min(90.0, max(abs(latitude), abs(low), abs(high))))
+        return (math.sin(math.radians(d_lat) / 2) ** 2
+                + math.cos(top) ** 2 * math.sin(math.radians(d_lon) / 2) ** 2)
+
+    @staticmethod
+    def _ring(ci, cj, ring):
+        if ring == 0:
+            yield (ci, cj)
+            return
+        for j in range(cj - ring, cj + ring + 1):
+            yield (ci - ring, j)
+            yield (ci + ring, j)
+        for i in range(ci - ring + 1, ci + ring):
+            yield (i, cj - ring)
+            yield (i, cj + ring)
+
+
+class FacilityIndex(ChangeLogIndex):
+    """The worker's facility grid, kept in step with commits in every worker"""
+
+    CHANGES = 'facilities:index'
+    LABEL = 'Facility index'
+    THREAD = 'afya-facility-index'
+    SESSION_KEY = 'facility_changes'
+
+    def __init__(self, db, app=None):
+        super().__init__(db)
+        self.grid = FacilityGrid()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the FACILITY_* settings"""
+        self.app = app
+        self.poll_interval = app.config.get('FACILITY_INDEX_INTERVAL', 5)
+        self.default_place = app.config.get('FACILITY_DEFAULT_PLACE', 'accra')
+        app.extensions['facility_index'] = self
+
+    # Reads
+
+    def nearest(self, latitude, longitude, n=2):
+        """[(distance_km, facility)] for the n nearest active facilities"""
+        self._ensure_loaded()
+        with self._lock:
+            return self.grid.nearest(latitude, longitude, n)
+
+    def nearest_to_phone(self, phone, n=2):
+        """(place name, [(distance_km, facility)]) for a caller"""
+        place, point = place_for_phone(phone, self.default_place)
+        if point is None:
+            return place, []
+        return place, self.nearest(point[0], point[1], n)
+
+    # Loading
+
+    @primary()
+    def load(self):
+        """(Re)build the grid from every active facility with coordinates"""
+        from app import HealthcareFacility
+
+        version = self.changes.version()
+        facilities = HealthcareFacility.query.filter(
+            HealthcareFacility.is_active.is_(True),
+            HealthcareFacility.latitude.isnot(None),
+            HealthcareFacility.longitude.isnot(None)).all()
+
+        grid = FacilityGrid(self.grid.cell)
+        for facility in facilities:
+            grid.add(facility.id, facility.latitude, facility.longitude,
+                     self._data(facility))
+        with self._lock:
+            self.grid = grid
+            self.version = version
+            self.loaded = True
+        log.info("Facility index loaded", extra={'facilities': len(grid)})
+
+    def apply(self, facility_id, row):
+        """Put one facility in or out of the grid from its current row data"""
+        with self._lock:
+            if row and row['active'] and row['latitude'] is not None \
+                    and row['longitude'] is not None:
+                self.grid.add(facility_id, row['latitude'], row['longitude'], row['data'])
+            else:
+                self.grid.remove(facility_id)
+
+    def _data(self, facility):
+        return {'id': facility.id, 'name': facility.name, 'phone': facility.phone or '',
+                'type': facility.facility_type or ''}
+
+    def _row(self, facility):
+        return {'active': bool(facility.is_active), 'latitude': facility.latitude,
+                'longitude': facility.longitude, 'data': self._data(facility)}
+
+    # ChangeLogIndex: members are facility ids
+
+    def _changes(self, session):
+        from app import HealthcareFacility
+
+        changes = {}
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, HealthcareFacility) and (
+                    obj in session.new or session.is_modified(obj, include_collections=False)):
+                changes[str(obj.id)] = self._row(obj)
+        for obj in session.deleted:
+            if isinstance(obj, HealthcareFacility):
+                changes[str(obj.id)] = None
+        return changes
+
+    def _fetch(self, members):
+        from app import HealthcareFacility
+
+        ids = {int(member) for member in members}
+        return {str(facility.id): self._row(facility) for facility in
+                HealthcareFacility.query.filter(HealthcareFacility.id.in_(ids))}
+
+    def _apply(self, member, row):
+        self.apply(int(member), row)
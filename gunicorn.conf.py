@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for Afya (see Procfile)
+
+The app is built once in the master (preload_app) and shared with the
+workers by fork. Each worker then opens its own connections and primes the
+shared caches in post_worker_init, before it accepts its first request.
+
+Workers are threaded (gthread). A sync worker only tells the master it is
+alive between requests, so a streaming export (/api/records/export) or a
+large HTTP import (/api/patients/import) that runs past GUNICORN_TIMEOUT
+gets the worker killed mid-stream and the client a truncated body. A
+gthread worker heartbeats from its main loop while requests run on its
+threads, so the timeout only catches a stuck process. With sync workers
+(GUNICORN_WORKER_CLASS=sync and GUNICORN_THREADS=1), use
+`flask export-records` and `flask import-patients` for anything that may
+take longer than the timeout.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'True').lower() == 'true'
+
+
+def post_worker_init(worker):
+    from app import warm_worker
+    warm_worker(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    # Write any queued audit events and log records before the worker goes
+    # away, and fold its metric totals into the deployment's
+    from app import audit_log, metrics, structured_logging
+    audit_log.shutdown()
+    metrics.shutdown()
+    if structured_logging.handler is not None:
+        structured_logging.handler.stop()
@@ -1,302 +1,476 @@
 """
 Afya Medical Menu
 """
-from datetime import datetime, timedelta
+import logging
+from datetime import datetime, date, timedelta
+from ussd_screens import ScreenRegistry
+from patient_summary import fit_screen
+
+
+sms_log = logging.getLogger('afya.sms')
+auth_log = logging.getLogger('afya.auth')
+
+# USSD menu tree: cumulative input pattern -> MedicalMenu handler.
+# <name> segments capture free-form input and are passed to the handler.
+
+MENU_ROUTES = {
+    '': 'main_menu',
+
+    # Healthcare Provider Flow
+    '1': 'provider_login_menu',
+    '1*<pin>': 'provider_home_menu',
+    '1*<pin>*1': 'find_patient_prompt',
+    '1*<pin>*1*<patient_phone>': 'find_patient_result',
+    '1*<pin>*2': 'new_patient_prompt',
+    '1*<pin>*2*<patient_phone>': 'new_patient_result',
+    '1*<pin>*3': 'new_record_prompt',
+    '1*<pin>*3*<patient_phone>': 'new_record_complaint_prompt',
+    '1*<pin>*3*<patient_phone>*<complaint>': 'new_record_result',
+    '1*<pin>*4': 'today_list_menu',
+    '1*<pin>*0': 'provider_logout_menu',
+
+    # Patient Services Flow
+    '2': 'patient_services_menu',
+    '2*1': 'patient_records_menu',
+    '2*2': 'emergency_numbers_menu',
+    '2*3': 'patient_appointments_menu',
+    '2*0': 'main_menu',
+
+    # Emergency Services Flow
+    '3': 'emergency_services_menu',
+    '3*1': 'call_ambulance_menu',
+    '3*2': 'family_alert_menu',
+    '3*3': 'emergency_info_menu',
+    '3*4': 'nearest_hospital_menu',
+
+    '4': 'system_info_menu',
+}
+
+# Screens that never change between requests. They are rendered once,
+# with their CON/END prefix, by the ScreenRegistry when the menu starts.
+STATIC_SCREENS = {
+    'main_menu': (
+        'CON',
+        "AFYA MEDICAL EHR\n"
+        "Ghana Health Records\n\n"
+        "1. Doctor/Nurse\n"
+        "2. Patient\n"
+        "3. Emergency\n"
+        "4. Info"),
+    'provider_login_menu': (
+        'CON',
+        "DOCTOR/NURSE LOGIN\n\n"
+        "Enter your 4-digit PIN:\n"
+        "(Contact admin if forgot)"),
+    'invalid_pin_format': (
+        'CON',
+        "INVALID PIN FORMAT\n\n"
+        "Enter exactly 4 digits:"),
+    'patient_services_menu': (
+        'CON',
+        "PATIENT SERVICES\n\n"
+        "1. My Health Records\n"
+        "2. Emergency Numbers\n"
+        "3. My Appointments\n"
+        "0. Back to Main"),
+    'emergency_services_menu': (
+        'CON',
+        "EMERGENCY SERVICES\n\n"
+        "1. Call Ambulance (193)\n"
+        "2. Alert My Family\n"
+        "3. My Medical Info\n"
+        "4. Nearest Hospital"),
+    'system_info_menu': (
+        'END',
+        "AFYA MEDICAL EHR\n\n"
+        "Version: 1.0\n"
+        "Support: *714*9#\n"
+        "Web: afya.health.gh\n\n"
+        "Better Healthcare\n"
+        "For All Ghanaians"),
+    'find_patient_prompt': (
+        'CON',
+        "FIND PATIENT\n\n"
+        "Enter patient phone:\n"
+        "(10 digits starting with 0)"),
+    'new_patient_prompt': (
+        'CON',
+        "NEW PATIENT\n\n"
+        "Enter patient phone:\n"
+        "(This becomes their ID)"),
+    'new_record_prompt': (
+        'CON',
+        "NEW MEDICAL RECORD\n\n"
+        "Enter patient phone:"),
+    'new_record_complaint_prompt': (
+        'CON',
+        "NEW MEDICAL RECORD\n\n"
+        "Enter chief complaint:"),
+    'today_list_menu': (
+        'END',
+        "TODAY'S PATIENTS\n\n"
+        "Morning:\n"
+        "• 9:00 - John D.\n"
+        "• 10:30 - Jane S.\n\n"
+        "Afternoon:\n"
+        "• 2:00 - Kwame O.\n\n"
+        "Total: 3 patients"),
+    'provider_logout_menu': (
+        'END',
+        "LOGGED OUT\n\n"
+        "Thank you for using\n"
+        "Afya Medical EHR.\n\n"
+        "Have a great day!"),
+    'demo_provider_menu': (
+        'CON',
+        "WELCOME DR. DEMO\n"
+        "Demo Clinic\n\n"
+        "1. Find Patient\n"
+        "2. New Patient\n"
+        "3. New Record\n"
+        "4. Today's List\n"
+        "0. Logout"),
+    'login_failed_menu': (
+        'END',
+        "LOGIN FAILED\n\n"
+        "Wrong PIN or\n"
+        "phone number.\n\n"
+        "Contact your\n"
+        "facility admin."),
+    'not_registered_menu': (
+        'END',
+        "NOT REGISTERED\n\n"
+        "This phone has no\n"
+        "Afya records.\n\n"
+        "Ask your clinic\n"
+        "to register you."),
+    'emergency_numbers_menu': (
+        'END',
+        "EMERGENCY NUMBERS\n\n"
+        "Ambulance: 193\n"
+        "Police: 191\n"
+        "Fire Service: 192\n\n"
+        "Your location will be\n"
+        "shared when you call."),
+    'patient_appointments_menu': (
+        'END',
+        "YOUR APPOINTMENTS\n\n"
+        "Next appointment:\n"
+        "Date: 25/03/24\n"
+        "Time: 10:00 AM\n"
+        "Doctor: Dr. Asante\n"
+        "Place: Demo Clinic\n\n"
+        "Please don't forget!"),
+    'call_ambulance_menu': (
+        'END',
+        "EMERGENCY AMBULANCE\n\n"
+        "CALL 193 RIGHT NOW\n\n"
+        "Stay calm and wait.\n"
+        "Help is on the way.\n\n"
+        "Your location will be\n"
+        "tracked automatically."),
+    'family_alert_menu': (
+        'END',
+        "FAMILY ALERT SENT\n\n"
+        "Your emergency contact\n"
+        "has been notified.\n\n"
+        "If life-threatening:\n"
+        "CALL 193 for ambulance"),
+    'emergency_info_unavailable': (
+        'END',
+        "EMERGENCY INFO\n\n"
+        "Your records are\n"
+        "loading. Dial again\n"
+        "in a minute.\n\n"
+        "EMERGENCY: 193"),
+    'nearest_hospital_menu': (
+        'END',
+        "NEAREST HOSPITALS\n\n"
+        "ACCRA:\n"
+        "• Korle Bu Hospital\n"
+        "  Tel: 0302-674376\n"
+        "• 37 Military Hospital\n"
+        "  Tel: 0302-776481\n\n"
+        "EMERGENCY: 193"),
+    'invalid_selection': (
+        'END',
+        "INVALID CHOICE\n\n"
+        "Please select a\n"
+        "valid option.\n\n"
+        "Dial *714# to restart"),
+    'network_error_menu': (
+        'END',
+        "NETWORK ERROR\n\n"
+        "Poor connection.\n"
+        "Trying again...\n\n"
+        "Or dial *714# later"),
+    'session_timeout_menu': (
+        'END',
+        "SESSION TIMEOUT\n\n"
+        "Please dial *714#\n"
+        "to start again.\n\n"
+        "Keep options ready\n"
+        "for faster access."),
+}
+
+# Screens shortened with basic phone abbreviations before rendering
+ABBREVIATED_SCREENS = {'main_menu'}
+
+
+def validate_phone_number(phone):
+    """Validate a Ghana phone number; returns (True, '0XXXXXXXXX') or (False, reason)"""
+    if not phone:
+        return False, "Phone number required"
+
+    # Remove spaces and dashes
+    phone = phone.replace(' ', '').replace('-', '')
+
+    # Check if it's a valid Ghana number
+    if phone.startswith('0') and len(phone) == 10:
+        return True, phone
+    elif phone.startswith('+233') and len(phone) == 13:
+        return True, '0' + phone[4:]
+    elif phone.startswith('233') and len(phone) == 12:
+        return True, '0' + phone[3:]
+    else:
+        return False, "Invalid Ghana phone format"
 
 
 class MedicalMenu:
     """Medical EHR USSD Menu System - Basic Phone Optimized"""
 
-    def __init__(self, session):
+    def __init__(self, session, auth, sms=None, summaries=None, cards=None,
+                 facilities=None, search=None):
         self.session = session
+        self.auth = auth
+        self.sms = sms  # outbound SmsQueue; messages are printed without one
+        self.summaries = summaries  # PatientSummaries: pre-rendered patient screens
+        self.cards = cards  # EmergencyCards: emergency info within a time budget
+        self.facilities = facilities  # FacilityIndex: nearest facilities in memory
+        self.search = search  # SearchIndex: fuzzy patient lookup
         self.MAX_TEXT_LENGTH = 160  # SMS standard limit
         self.MAX_MENU_OPTIONS = 4   # Prevent screen overflow
 
+        # Render every static screen once, up front
+        self.screens = ScreenRegistry()
+        for name, (prefix, text) in STATIC_SCREENS.items():
+            if name in ABBREVIATED_SCREENS:
+                text = self._format_for_basic_phone(text)
+            else:
+                text = self._fit_to_screen(text)
+            self.screens.register(name, prefix, text)
+
     def main_menu(self, session_id, phone_number):
         """Main USSD menu optimized for basic phones"""
-        menu_text = "AFYA MEDICAL EHR\n"
-        menu_text += "Ghana Health Records\n\n"
-        menu_text += "1. Doctor/Nurse\n"
-        menu_text += "2. Patient\n"
-        menu_text += "3. Emergency\n"
-        menu_text += "4. Info"
-
-        # Ensure text fits basic phone screens
-        menu_text = self._format_for_basic_phone(menu_text)
-        
-        self.session.save(session_id, "main_menu")
-        return self.session.ussd_proceed(menu_text, session_id)
+        return self.screens.respond('main_menu')
 
     def provider_login_menu(self, session_id, phone_number):
         """Healthcare provider login - simplified for basic phones"""
-        menu_text = "DOCTOR/NURSE LOGIN\n\n"
-        menu_text += "Enter your 4-digit PIN:\n"
-        menu_text += "(Contact admin if forgot)"
-
-        self.session.save(session_id, "provider_login")
-        return self.session.ussd_proceed(menu_text, session_id)
+        return self.screens.respond('provider_login_menu')
 
     def patient_services_menu(self, session_id, phone_number):
         """Patient services - optimized for basic phones"""
-        menu_text = "PATIENT SERVICES\n\n"
-        menu_text += "1. My Health Records\n"
-        menu_text += "2. Emergency Numbers\n"
-        menu_text += "3. My Appointments\n"
-        menu_text += "0. Back to Main"
-
-        self.session.save(session_id, "patient_services")
-        return self.session.ussd_proceed(menu_text, session_id)
+        return self.screens.respond('patient_services_menu')
 
     def emergency_services_menu(self, session_id, phone_number):
         """Emergency services - clear and direct for basic phones"""
-        menu_text = "EMERGENCY SERVICES\n\n"
-        menu_text += "1. Call Ambulance (193)\n"
-        menu_text += "2. Alert My Family\n"
-        menu_text += "3. My Medical Info\n"
-        menu_text += "4. Nearest Hospital"
-
-        self.session.save(session_id, "emergency_services")
-        return self.session.ussd_proceed(menu_text, session_id)
+        return self.screens.respond('emergency_services_menu')
 
     def system_info_menu(self, session_id, phone_number):
         """System information - concise for basic phones"""
-        menu_text = "AFYA MEDICAL EHR\n\n"
-        menu_text += "Version: 1.0\n"
-        menu_text += "Support: *714*9#\n"
-        menu_text += "Web: afya.health.gh\n\n"
-        menu_text += "Better Healthcare\nFor All Ghanaians"
+        return self.screens.respond('system_info_menu')
 
-        return self.session.ussd_end(menu_text)
+    # Provider Flow
 
-    def handle_multi_level_menu(self, text, session_id, phone_number):
-        """Handle complex menu navigation - simplified for basic phones"""
+    def authenticate_provider(self, phone_number, pin):
+        """Verify a provider's PIN; returns the identity to keep in the session or None"""
         try:
-            from app import HealthcareProvider, Patient, MedicalRecord, db, hash_pin
-        except ImportError:
-            return self.error_menu("System unavailable", session_id)
-
-        menu_path = text.split('*')
-
-        # Healthcare Provider Flow
-        if menu_path[0] == '1':
-            return self.handle_provider_flow(menu_path, session_id, phone_number)
-
-        # Patient Services Flow
-        elif menu_path[0] == '2':
-            return self.handle_patient_flow(menu_path, session_id, phone_number)
-
-        # Emergency Services Flow
-        elif menu_path[0] == '3':
-            return self.handle_emergency_flow(menu_path, session_id, phone_number)
-
-        else:
-            return self.invalid_selection(session_id)
-
-    def handle_provider_flow(self, menu_path, session_id, phone_number):
-        """Handle healthcare provider menu flow - basic phone optimized"""
-        try:
-            from app import HealthcareProvider, Patient, MedicalRecord, db, hash_pin
-        except ImportError:
-            return self.error_menu("Service unavailable", session_id)
-
-        if len(menu_path) == 2:
-            # Provider entered PIN
-            pin = menu_path[1]
-
-            if len(pin) != 4 or not pin.isdigit():
-                menu_text = "INVALID PIN FORMAT\n\n"
-                menu_text += "Enter exactly 4 digits:"
-                return self.session.ussd_proceed(menu_text, session_id)
-
-            # Verify provider credentials
-            try:
-                provider = HealthcareProvider.query.filter_by(
-                    phone=self.sanitize_phone(phone_number),
-                    pin=hash_pin(pin),
-                    is_active=True
-                ).first()
-            except:
-                # Fallback for demo
-                if pin == "1234":
-                    return self.demo_provider_menu(session_id, phone_number)
-                else:
-                    return self.login_failed_menu(session_id)
-
-            if not provider:
-                # Demo mode fallback
-                if pin == "1234":
-                    return self.demo_provider_menu(session_id, phone_number)
-                return self.login_failed_menu(session_id)
-
-            # Provider main menu - basic phone friendly
-            first_name = provider.name.split()[0] if provider.name else "Doctor"
-            menu_text = f"WELCOME {first_name.upper()}\n"
-            
-            facility_name = provider.facility.name if provider.facility else 'Demo Clinic'
-            # Truncate facility name if too long
-            if len(facility_name) > 20:
-                facility_name = facility_name[:17] + "..."
-            menu_text += f"{facility_name}\n\n"
-            
-            menu_text += "1. Find Patient\n"
-            menu_text += "2. New Patient\n"
-            menu_text += "3. New Record\n"
-            menu_text += "4. Today's List\n"
-            menu_text += "0. Logout"
-
-            # Save provider session
-            self.session.save(session_id, f"provider_menu:{provider.id}")
-            return self.session.ussd_proceed(menu_text, session_id)
+            provider = self.auth.authenticate(self.sanitize_phone(phone_number), pin)
+        except Exception as e:
+            auth_log.warning("Provider authentication error: %s", e)
+            return None
 
-        elif len(menu_path) >= 3:
-            return self.handle_provider_actions(menu_path, session_id, phone_number)
+        if not provider:
+            return None
+        # Everything but the PIN hash
+        return {'id': provider['id'], 'name': provider['name'],
+                'facility_id': provider['facility_id'],
+                'facility_name': provider['facility_name']}
+
+    def provider_home_menu(self, session_id, phone_number, pin, provider):
+        """Provider entered PIN - show the provider main menu"""
+        if len(pin) != 4 or not pin.isdigit():
+            return self.screens.respond('invalid_pin_format')
+
+        if not provider:
+            # Demo mode fallback; its options still need a real login
+            if pin == "1234":
+                return self.demo_provider_menu(session_id, phone_number)
+            return self.login_failed_menu(session_id)
+
+        # Provider main menu - basic phone friendly
+        first_name = provider['name'].split()[0] if provider['name'] else "Doctor"
+        menu_text = f"WELCOME {first_name.upper()}\n"
+
+        facility_name = provider['facility_name'] or 'Demo Clinic'
+        # Truncate facility name if too long
+        if len(facility_name) > 20:
+            facility_name = facility_name[:17] + "..."
+        menu_text += f"{facility_name}\n\n"
 
-    def demo_provider_menu(self, session_id, phone_number):
-        """Demo provider menu for testing - basic phone optimized"""
-        menu_text = "WELCOME DR. DEMO\n"
-        menu_text += "Demo Clinic\n\n"
         menu_text += "1. Find Patient\n"
         menu_text += "2. New Patient\n"
         menu_text += "3. New Record\n"
         menu_text += "4. Today's List\n"
         menu_text += "0. Logout"
 
-        self.session.save(session_id, "demo_provider_menu")
         return self.session.ussd_proceed(menu_text, session_id)
 
+    # Handlers below the PIN only run for a provider the session engine
+    # authenticated; see ussd_engine.py
+
+    def find_patient_prompt(self, session_id, phone_number, provider):
+        """Patient lookup - ask for the patient's phone"""
+        return self.screens.respond('find_patient_prompt')
+
+    def find_patient_result(self, session_id, phone_number, provider, patient_phone):
+        """Patient lookup - show the patient's pre-rendered summary"""
+        menu_text, message = self.find_patient_basic(patient_phone)
+        if not menu_text:
+            suggestions = self.suggest_patients(patient_phone)
+            if suggestions:
+                lines = ["FIND PATIENT", message, "", "Did you mean:"]
+                lines += [f"{found['phone']} {found['name']}" for found in suggestions]
+                return self.session.ussd_end(fit_screen(lines))
+            return self.session.ussd_end(f"FIND PATIENT\n\n{message}")
+        return self.session.ussd_end(menu_text)
+
+    def suggest_patients(self, text, limit=3):
+        """Closest patients to a phone (or name) that found nobody"""
+        if self.search is None:
+            return []
+        try:
+            return self.search.search(text, ('patient',), limit)
+        except Exception:
+            return []
+
+    def new_patient_prompt(self, session_id, phone_number, provider):
+        """New patient registration - ask for the patient's phone"""
+        return self.screens.respond('new_patient_prompt')
+
+    def new_patient_result(self, session_id, phone_number, provider, patient_phone):
+        """New patient registration - register by phone"""
+        success, message = self.create_patient_record_basic(patient_phone)
+        title = "PATIENT REGISTERED" if success else "REGISTRATION FAILED"
+        return self.session.ussd_end(f"{title}\n\n{message}")
+
+    def new_record_prompt(self, session_id, phone_number, provider):
+        """New medical record - ask for the patient's phone"""
+        return self.screens.respond('new_record_prompt')
+
+    def new_record_complaint_prompt(self, session_id, phone_number, provider, patient_phone):
+        """New medical record - ask for the chief complaint"""
+        return self.screens.respond('new_record_complaint_prompt')
+
+    def new_record_result(self, session_id, phone_number, provider, patient_phone, complaint):
+        """New medical record - create it for the logged in provider"""
+        is_valid, clean_phone = self.validate_phone_number(patient_phone)
+        if not is_valid:
+            return self.session.ussd_end(f"NEW MEDICAL RECORD\n\n{clean_phone}")
+
+        success, message = self.create_medical_record_basic(
+            clean_phone, int(provider['id']), complaint)
+        title = "RECORD SAVED" if success else "RECORD FAILED"
+        return self.session.ussd_end(f"{title}\n\n{message}")
+
+    def today_list_menu(self, session_id, phone_number, provider):
+        """Today's appointments - simplified display"""
+        return self.screens.respond('today_list_menu')
+
+    def provider_logout_menu(self, session_id, phone_number, provider):
+        """Provider logout"""
+        return self.screens.respond('provider_logout_menu')
+
+    def demo_provider_menu(self, session_id, phone_number):
+        """Demo provider menu for testing - basic phone optimized"""
+        return self.screens.respond('demo_provider_menu')
+
     def login_failed_menu(self, session_id):
         """Login failed - clear message for basic phones"""
-        menu_text = "LOGIN FAILED\n\n"
-        menu_text += "Wrong PIN or\nphone number.\n\n"
-        menu_text += "Contact your\nfacility admin."
+        return self.screens.respond('login_failed_menu')
+
+    # Patient Flow
+
+    def patient_records_menu(self, session_id, phone_number):
+        """View my records"""
+        return self._patient_screen(session_id, phone_number, 'records')
+
+    def emergency_numbers_menu(self, session_id, phone_number):
+        """Emergency contact numbers"""
+        return self.screens.respond('emergency_numbers_menu')
+
+    def patient_appointments_menu(self, session_id, phone_number):
+        """Appointment info"""
+        return self.screens.respond('patient_appointments_menu')
+
+    # Emergency Flow
+
+    def call_ambulance_menu(self, session_id, phone_number):
+        """Call ambulance"""
+        return self.screens.respond('call_ambulance_menu')
+
+    def family_alert_menu(self, session_id, phone_number):
+        """Medical alert to family"""
+        return self.screens.respond('family_alert_menu')
+
+    def emergency_info_menu(self, session_id, phone_number):
+        """Share emergency info - answered even when the database is down"""
+        menu_text = self.cards.get(self.sanitize_phone(phone_number))
+        if menu_text is None:
+            return self.screens.respond('emergency_info_unavailable')
+        if not menu_text:
+            return self.screens.respond('not_registered_menu')
         return self.session.ussd_end(menu_text)
 
-    def handle_provider_actions(self, menu_path, session_id, phone_number):
-        """Handle provider action selections - basic phone optimized"""
-        action = menu_path[2]
-
-        if action == '1':
-            # Patient Lookup
-            menu_text = "FIND PATIENT\n\n"
-            menu_text += "Enter patient phone:\n"
-            menu_text += "(10 digits starting with 0)"
-            return self.session.ussd_proceed(menu_text, session_id)
-
-        elif action == '2':
-            # New Patient Registration
-            menu_text = "NEW PATIENT\n\n"
-            menu_text += "Enter patient phone:\n"
-            menu_text += "(This becomes their ID)"
-            return self.session.ussd_proceed(menu_text, session_id)
-
-        elif action == '3':
-            # New Medical Record
-            menu_text = "NEW MEDICAL RECORD\n\n"
-            menu_text += "Enter patient phone:"
-            return self.session.ussd_proceed(menu_text, session_id)
-
-        elif action == '4':
-            # Today's appointments - simplified display
-            menu_text = "TODAY'S PATIENTS\n\n"
-            menu_text += "Morning:\n"
-            menu_text += "• 9:00 - John D.\n"
-            menu_text += "• 10:30 - Jane S.\n\n"
-            menu_text += "Afternoon:\n"
-            menu_text += "• 2:00 - Kwame O.\n\n"
-            menu_text += "Total: 3 patients"
-            return self.session.ussd_end(menu_text)
-
-        elif action == '0':
-            # Logout
-            menu_text = "LOGGED OUT\n\n"
-            menu_text += "Thank you for using\nAfya Medical EHR.\n\n"
-            menu_text += "Have a great day!"
-            return self.session.ussd_end(menu_text)
-
-        else:
-            return self.invalid_selection(session_id)
-
-    def handle_patient_flow(self, menu_path, session_id, phone_number):
-        """Handle patient services menu flow - basic phone optimized"""
-        if len(menu_path) == 2:
-            action = menu_path[1]
-
-            if action == '1':  # View My Records
-                menu_text = "YOUR MEDICAL RECORDS\n\n"
-                menu_text += "Recent visits:\n"
-                menu_text += "• 15/03/24 - General\n"
-                menu_text += "• 02/02/24 - Follow-up\n"
-                menu_text += "• 18/01/24 - Emergency\n\n"
-                menu_text += "All records are\nsafely stored."
-                return self.session.ussd_end(menu_text)
-
-            elif action == '2':  # Emergency Contact
-                menu_text = "EMERGENCY NUMBERS\n\n"
-                menu_text += "Ambulance: 193\n"
-                menu_text += "Police: 191\n"
-                menu_text += "Fire Service: 192\n\n"
-                menu_text += "Your location will be\nshared when you call."
-                return self.session.ussd_end(menu_text)
-
-            elif action == '3':  # Appointment Info
-                menu_text = "YOUR APPOINTMENTS\n\n"
-                menu_text += "Next appointment:\n"
-                menu_text += "Date: 25/03/24\n"
-                menu_text += "Time: 10:00 AM\n"
-                menu_text += "Doctor: Dr. Asante\n"
-                menu_text += "Place: Demo Clinic\n\n"
-                menu_text += "Please don't forget!"
-                return self.session.ussd_end(menu_text)
-
-            elif action == '0':  # Back to main menu
-                return self.main_menu(session_id, phone_number)
-
-    def handle_emergency_flow(self, menu_path, session_id, phone_number):
-        """Handle emergency services flow - optimized for urgency"""
-        if len(menu_path) == 2:
-            action = menu_path[1]
-
-            if action == '1':  # Call Ambulance
-                menu_text = "EMERGENCY AMBULANCE\n\n"
-                menu_text += "CALL 193 RIGHT NOW\n\n"
-                menu_text += "Stay calm and wait.\n"
-                menu_text += "Help is on the way.\n\n"
-                menu_text += "Your location will be\ntracked automatically."
-                return self.session.ussd_end(menu_text)
-
-            elif action == '2':  # Medical Alert
-                menu_text = "FAMILY ALERT SENT\n\n"
-                menu_text += "Your emergency contact\nhas been notified.\n\n"
-                menu_text += "If life-threatening:\nCALL 193 for ambulance"
-                return self.session.ussd_end(menu_text)
-
-            elif action == '3':  # Share Emergency Info
-                menu_text = f"EMERGENCY INFO\n\n"
-                menu_text += f"Name: Demo Patient\n"
-                menu_text += f"Phone: {phone_number}\n"
-                menu_text += f"Blood Type: O+\n"
-                menu_text += f"Allergies: None known\n"
-                menu_text += f"Condition: Hypertension\n\n"
-                menu_text += "Show this to doctors"
-                return self.session.ussd_end(menu_text)
-
-            elif action == '4':  # Nearest Hospital
-                menu_text = "NEAREST HOSPITALS\n\n"
-                menu_text += "ACCRA:\n"
-                menu_text += "• Korle Bu Hospital\n"
-                menu_text += "  Tel: 0302-674376\n"
-                menu_text += "• 37 Military Hospital\n"
-                menu_text += "  Tel: 0302-776481\n\n"
-                menu_text += "EMERGENCY: 193"
-                return self.session.ussd_end(menu_text)
+    def _patient_screen(self, session_id, phone_number, name):
+        """The caller's own summary screen, one key read when cached"""
+        try:
+            menu_text = self.summaries.screen(self.sanitize_phone(phone_number), name)
+        except Exception:
+            return self.error_menu("Records unavailable.", session_id)
+        if not menu_text:
+            return self.screens.respond('not_registered_menu')
+        return self.session.ussd_end(menu_text)
 
-    def _format_for_basic_phone(self, text):
-        """Format text to fit basic phone screens"""
+    def nearest_hospital_menu(self, session_id, phone_number):
+        """Nearest hospitals - the two closest active facilities"""
+        try:
+            place, nearest = self.facilities.nearest_to_phone(
+                self.sanitize_phone(phone_number), 2)
+        except Exception:
+            nearest = None
+        if not nearest:
+            return self.screens.respond('nearest_hospital_menu')
+
+        lines = ["NEAREST FACILITIES", f"Near {place.title()}", ""]
+        for number, (km, facility) in enumerate(nearest, 1):
+            lines.append(f"{number}. {facility['name']}")
+            lines.append(f"{km:.1f}km Tel: {facility['phone']}")
+        lines += ["", "EMERGENCY: 193"]
+        return self.session.ussd_end(fit_screen(lines))
+
+    def _fit_to_screen(self, text):
+        """Truncate text that would overflow a basic phone screen"""
         # Ensure text doesn't exceed SMS limits
         if len(text) > self.MAX_TEXT_LENGTH:
             # Truncate and add continuation indicator
             text = text[:self.MAX_TEXT_LENGTH-15] + "\n...(truncated)"
-        
+        return text
+
+    def _format_for_basic_phone(self, text):
+        """Format text to fit basic phone screens"""
+        text = self._fit_to_screen(text)
+
         # Replace long words that might break display
         text = text.replace("Healthcare", "Health")
         text = text.replace("Emergency", "Emerg")
@@ -323,7 +497,7 @@ class MedicalMenu:
         return phone
 
     def send_sms_basic_phone(self, phone_number, message_type, custom_message=None):
-        """Send SMS optimized for basic phones"""
+        """Queue an SMS optimized for basic phones; sent later by the SMS worker"""
         try:
             if custom_message:
                 sms_content = custom_message
@@ -342,64 +516,46 @@ class MedicalMenu:
             if len(sms_content) > 160:
                 sms_content = sms_content[:157] + "..."
 
-            # For demo purposes, just print the SMS
-            print(f"SMS to {phone_number}: {sms_content}")
-
-            # Uncomment below for actual SMS integration
-            # self._send_actual_sms(phone_number, sms_content)
-
-        except Exception as e:
-            print(f"SMS sending failed: {str(e)}")
+            # Only enqueue here; the gateway call never holds up the USSD reply
+            if self.sms is not None:
+                self.sms.enqueue(phone_number, sms_content, message_type)
+            else:
+                sms_log.info("SMS not queued", extra={
+                    'to': phone_number, 'kind': message_type, 'body': sms_content})
 
-    def _send_actual_sms(self, phone_number, message):
-        """Send actual SMS using configured service"""
-        # This would integrate with your SMS provider
-        # Africa's Talking, Twilio, etc.
-        pass
+        except Exception:
+            sms_log.exception("SMS sending failed")
 
     def validate_phone_number(self, phone):
         """Validate Ghana phone number format"""
-        if not phone:
-            return False, "Phone number required"
-        
-        # Remove spaces and dashes
-        phone = phone.replace(' ', '').replace('-', '')
-        
-        # Check if it's a valid Ghana number
-        if phone.startswith('0') and len(phone) == 10:
-            return True, phone
-        elif phone.startswith('+233') and len(phone) == 13:
-            return True, '0' + phone[4:]
-        elif phone.startswith('233') and len(phone) == 12:
-            return True, '0' + phone[3:]
-        else:
-            return False, "Invalid Ghana phone format"
+        return validate_phone_number(phone)
 
     def create_patient_record_basic(self, phone_number, name=None):
         """Create patient record with minimal required data for basic phones"""
         try:
-            from app import Patient, db, log_activity
+            from app import Patient, db, log_activity, write_queue
             
             # Validate phone number
             is_valid, clean_phone = self.validate_phone_number(phone_number)
             if not is_valid:
                 return False, clean_phone
 
-            # Check if patient already exists
-            existing_patient = Patient.query.filter_by(phone=clean_phone).first()
-            if existing_patient:
-                return False, "Patient already registered"
+            def register():
+                # Check if patient already exists
+                if Patient.query.filter_by(phone=clean_phone).first():
+                    return False
 
-            # Create new patient with minimal data
-            patient = Patient(
-                phone=clean_phone,
-                name=name or f"Patient {clean_phone[-4:]}",  # Default name with last 4 digits
-                registration_date=datetime.now().strftime('%d/%m/%y %H:%M:%S'),
-                is_active=True
-            )
+                # Create new patient with minimal data
+                db.session.add(Patient(
+                    phone=clean_phone,
+                    name=name or f"Patient {clean_phone[-4:]}",  # Default name with last 4 digits
+                    registration_date=datetime.now(),
+                    is_active=True
+                ))
+                return True
 
-            db.session.add(patient)
-            db.session.commit()
+            if not write_queue.run(register):
+                return False, "Patient already registered"
 
             # Log the registration
             log_activity(
@@ -417,34 +573,19 @@ class MedicalMenu:
             return False, f"Registration failed: {str(e)}"
 
     def find_patient_basic(self, phone_number):
-        """Find patient with basic phone optimized display"""
+        """Find patient; returns the pre-rendered summary screen or (None, reason)"""
         try:
-            from app import Patient, MedicalRecord
-            
             # Validate and clean phone number
             is_valid, clean_phone = self.validate_phone_number(phone_number)
             if not is_valid:
                 return None, clean_phone
 
-            # Find patient
-            patient = Patient.query.filter_by(phone=clean_phone, is_active=True).first()
-            if not patient:
+            # One key read; built from the database on a miss
+            menu_text = self.summaries.screen(clean_phone, 'find')
+            if not menu_text:
                 return None, "Patient not found"
 
-            # Get recent records count
-            recent_records = MedicalRecord.query.filter_by(patient_id=patient.id).count()
-
-            # Format patient info for basic phone display
-            patient_info = {
-                'name': patient.name,
-                'phone': patient.phone,
-                'registration_date': patient.registration_date,
-                'records_count': recent_records,
-                'blood_type': patient.blood_type or 'Unknown',
-                'allergies': patient.allergies or 'None known'
-            }
-
-            return patient_info, "Patient found"
+            return menu_text, "Patient found"
 
         except Exception as e:
             return None, f"Search failed: {str(e)}"
@@ -452,38 +593,41 @@ class MedicalMenu:
     def create_medical_record_basic(self, patient_phone, provider_id, complaint, diagnosis=None):
         """Create medical record with basic phone input"""
         try:
-            from app import Patient, MedicalRecord, HealthcareProvider, db, log_activity
-            
-            # Find patient
-            patient = Patient.query.filter_by(phone=patient_phone, is_active=True).first()
-            if not patient:
-                return False, "Patient not found"
-
-            # Find provider
-            provider = HealthcareProvider.query.get(provider_id)
-            if not provider:
-                return False, "Provider not found"
-
-            # Create medical record
-            record = MedicalRecord(
-                patient_id=patient.id,
-                provider_id=provider.id,
-                facility_id=provider.facility_id or 1,
-                visit_date=datetime.now().strftime('%d/%m/%y'),
-                chief_complaint=complaint,
-                diagnosis=diagnosis or 'To be determined',
-                treatment_plan='As prescribed',
-                notes=f'Created via USSD by {provider.name}'
-            )
-
-            db.session.add(record)
-            db.session.commit()
+            from app import Patient, MedicalRecord, HealthcareProvider, db, log_activity, write_queue
+
+            def create():
+                # Find patient
+                patient = Patient.query.filter_by(phone=patient_phone, is_active=True).first()
+                if not patient:
+                    return None, "Patient not found"
+
+                # Find provider
+                provider = HealthcareProvider.query.get(provider_id)
+                if not provider:
+                    return None, "Provider not found"
+
+                # Create medical record
+                db.session.add(MedicalRecord(
+                    patient_id=patient.id,
+                    provider_id=provider.id,
+                    facility_id=provider.facility_id or 1,
+                    visit_date=date.today(),
+                    chief_complaint=complaint,
+                    diagnosis=diagnosis or 'To be determined',
+                    treatment_plan='As prescribed',
+                    notes=f'Created via USSD by {provider.name}'
+                ))
+                return provider.name, None
+
+            provider_name, problem = write_queue.run(create)
+            if problem:
+                return False, problem
 
             # Log the activity
             log_activity(
                 patient_phone,
                 'Medical_Record_Created_USSD',
-                f"Record created by {provider.name}"
+                f"Record created by {provider_name}"
             )
 
             # Send confirmation SMS to patient
@@ -499,8 +643,8 @@ class MedicalMenu:
         try:
             from app import MedicalRecord, Patient
             
-            today = datetime.now().strftime('%d/%m/%y')
-            
+            today = date.today()
+
             # Get today's records as appointments
             records = MedicalRecord.query.filter_by(
                 provider_id=provider_id,
@@ -522,10 +666,7 @@ class MedicalMenu:
 
     def invalid_selection(self, session_id):
         """Handle invalid menu selections - basic phone friendly"""
-        menu_text = "INVALID CHOICE\n\n"
-        menu_text += "Please select a\nvalid option.\n\n"
-        menu_text += "Dial *714# to restart"
-        return self.session.ussd_end(menu_text)
+        return self.screens.respond('invalid_selection')
 
     def error_menu(self, error_message, session_id):
         """Handle system errors gracefully - basic phone friendly"""
@@ -536,17 +677,11 @@ class MedicalMenu:
 
     def network_error_menu(self, session_id):
         """Handle network errors specifically"""
-        menu_text = "NETWORK ERROR\n\n"
-        menu_text += "Poor connection.\nTrying again...\n\n"
-        menu_text += "Or dial *714# later"
-        return self.session.ussd_end(menu_text)
+        return self.screens.respond('network_error_menu')
 
     def session_timeout_menu(self, session_id):
         """Handle session timeouts"""
-        menu_text = "SESSION TIMEOUT\n\n"
-        menu_text += "Please dial *714#\nto start again.\n\n"
-        menu_text += "Keep options ready\nfor faster access."
-        return self.session.ussd_end(menu_text)
+        return self.screens.respond('session_timeout_menu')
 
     # Utility methods for basic phone optimization
     def truncate_text(self, text, max_length=25):
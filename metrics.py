@@ -0,0 +1,479 @@
+"""
+Afya Metrics
+In-process latency histograms and counters, served in Prometheus text format
+
+Recording is a dict update under a lock in the worker that did the work, so
+it is cheap enough to leave on. Each worker publishes a snapshot of its own
+totals to Redis every METRICS_FLUSH_INTERVAL seconds and its heartbeat to
+the metrics:workers sorted set, and /metrics merges the snapshots of the
+registered workers with this worker's current figures, so a scrape through
+the load balancer sees the whole deployment.
+
+A worker that exits (or stops heartbeating for three intervals) is
+retired: its counters and histograms are folded into metrics:retired, so
+the deployment's *_total series never go down when gunicorn replaces a
+worker. Gauges describe the present, so they carry a worker label, are
+never summed and are dropped with their worker.
+
+Recorded:
+    afya_http_request_duration_seconds{route,method,status}
+    afya_ussd_node_duration_seconds{node}
+    afya_http_request_sql_queries{route}         statements per request
+    afya_sql_query_duration_seconds{operation}
+    afya_redis_command_duration_seconds{command}
+    afya_template_render_duration_seconds{template}
+    afya_errors_total{source}                    http, ussd, sql, redis
+    afya_emergency_card_total{result}            hit, stale, miss, timeout, error
+    afya_emergency_card_build_seconds
+    afya_db_pool_*{pool}                         connections, waits, timeouts
+                                                 (collected from db_routing.py;
+                                                 the gauges also by worker)
+"""
+import os
+import json
+import atexit
+import logging
+import time
+import socket
+import bisect
+import threading
+from collections import defaultdict
+import redis
+from flask import request, g, before_render_template, template_rendered, got_request_exception
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import redis_client
+
+log = logging.getLogger('afya.metrics')
+
+# Seconds; from a cached USSD hop up to a timed-out gateway call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HELP = {
+    'afya_http_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'afya_ussd_node_duration_seconds': ('histogram', 'USSD callback latency by menu node'),
+    'afya_http_request_sql_queries': ('histogram', 'SQL statements per HTTP request'),
+    'afya_sql_query_duration_seconds': ('histogram', 'SQL statement latency by operation'),
+    'afya_redis_command_duration_seconds': ('histogram', 'Redis round-trip latency by command'),
+    'afya_template_render_duration_seconds': ('histogram', 'Template render time'),
+    'afya_errors_total': ('counter', 'Errors by source'),
+    'afya_emergency_card_total': ('counter', 'Emergency card reads by result'),
+    'afya_emergency_card_build_seconds': ('histogram', 'Emergency card rebuild time'),
+    'afya_db_pool_connections': ('gauge', 'Database pool connections by state'),
+    'afya_db_pool_size': ('gauge', 'Database pool size'),
+    'afya_db_pool_checkouts_total': ('counter', 'Database connection checkouts'),
+    'afya_db_pool_waits_total': ('counter', 'Checkouts that waited for a free connection'),
+    'afya_db_pool_wait_seconds_total': ('counter', 'Time spent waiting for a free connection'),
+    'afya_db_pool_timeouts_total': ('counter', 'Checkouts that timed out waiting'),
+}
+BUCKETS = {
+    'afya_http_request_sql_queries': COUNT_BUCKETS
+}
+SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK'}
+
+
+class Registry:
+    """Histograms and counters for one process, keyed by (name, labels)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = defaultdict(float)
+
+    def observe(self, name, labels, value):
+        buckets = BUCKETS.get(name, LATENCY_BUCKETS)
+        key = (name, labels)
+        with self._lock:
+            data = self.histograms.get(key)
+            if data is None:
+                # One slot per bucket plus +Inf, then sum and count
+                data = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            data[bisect.bisect_left(buckets, value)] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[(name, labels)] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'histograms': [[name, list(labels), list(data)]
+                               for (name, labels), data in self.histograms.items()],
+                'counters': [[name, list(labels), value]
+                             for (name, labels), value in self.counters.items()]
+            }
+
+
+def merge(snapshots):
+    """Sum snapshots from several workers; gauges are labelled per worker"""
+    histograms = {}
+    counters = defaultdict(float)
+    for snapshot in snapshots:
+        for name, labels, data in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = list(data)
+            elif len(total) == len(data):
+                histograms[key] = [a + b for a, b in zip(total, data)]
+        for name, labels, value in snapshot['counters'] + snapshot.get('gauges', []):
+            counters[(name, tuple(tuple(pair) for pair in labels))] += value
+    return histograms, counters
+
+
+def totals(snapshots):
+    """One snapshot with the summed counters and histograms, without gauges"""
+    histograms, counters = merge([dict(snapshot, gauges=[]) for snapshot in snapshots])
+    return {
+        'histograms': [[name, list(labels), data] for (name, labels), data in histograms.items()],
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()]
+    }
+
+
+def render(histograms, counters):
+    """Prometheus text exposition format"""
+    series = defaultdict(list)
+    for (name, labels), data in histograms.items():
+        series[name].append((labels, data))
+    for (name, labels), value in counters.items():
+        series[name].append((labels, value))
+
+    lines = []
+    for name in sorted(series):
+        kind, text = HELP.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, data in sorted(series[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f"{name}{_labels(labels)} {_number(data)}")
+                continue
+            cumulative = 0
+            bounds = [str(b) for b in BUCKETS.get(name, LATENCY_BUCKETS)] + ['+Inf']
+            for bound, count in zip(bounds, data[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(data[-2])}")
+            lines.append(f"{name}_count{_labels(labels)} {data[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def _number(value):
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Hooks Flask, SQLAlchemy and the Redis client into a Registry"""
+
+    KEY_PREFIX = "metrics:worker:"
+    WORKERS_KEY = "metrics:workers"     # worker id -> last heartbeat
+    RETIRED_KEY = "metrics:retired"     # summed totals of exited workers
+
+    def __init__(self, app=None, router=None):
+        self.registry = Registry()
+        self.router = None
+        self.enabled = False
+        self.collectors = []
+        self.worker_id = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+        self._published = False
+
+        if app is not None:
+            self.init_app(app, router)
+
+    def init_app(self, app, router=None):
+        """Install the hooks if METRICS_ENABLED; router labels USSD hops"""
+        self.router = router
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 10)
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            return
+
+        # Keep this worker's totals when the process exits
+        atexit.register(self.shutdown)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        got_request_exception.connect(self._request_exception, app, weak=False)
+        before_render_template.connect(self._start_render, app, weak=False)
+        template_rendered.connect(self._finish_render, app, weak=False)
+
+        for name, hook in (('before_cursor_execute', self._before_query),
+                           ('after_cursor_execute', self._after_query),
+                           ('handle_error', self._query_error)):
+            if not event.contains(Engine, name, hook):
+                event.listen(Engine, name, hook)
+        redis_client.command_observer = self._redis_command
+
+    def collect(self, callback):
+        """Add callback() -> [(name, labels, value)], read at every snapshot
+
+        For figures kept elsewhere, such as connection pool figures. Series
+        whose HELP type is gauge get this worker's label; the rest are
+        summed across workers like the counters.
+        """
+        self.collectors.append(callback)
+
+    def snapshot(self):
+        """This worker's registry plus the collected series"""
+        snapshot = self.registry.snapshot()
+        snapshot['gauges'] = []
+        worker = (('worker', f"{socket.gethostname()}:{os.getpid()}"),)
+        for callback in self.collectors:
+            try:
+                for name, labels, value in callback():
+                    if HELP.get(name, ('untyped',))[0] == 'gauge':
+                        snapshot['gauges'].append([name, list(labels + worker), value])
+                    else:
+                        snapshot['counters'].append([name, list(labels), value])
+            except Exception as e:
+                log.warning("Metrics collect error: %s", e)
+        return snapshot
+
+    def error(self, source):
+        """Count an error that was handled without raising"""
+        self.inc('afya_errors_total', (('source', source),))
+
+    def inc(self, name, labels, amount=1):
+        """Count an event recorded outside the request hooks"""
+        if self.enabled:
+            self.registry.inc(name, labels, amount)
+
+    def observe(self, name, labels, value):
+        """Record a value recorded outside the request hooks"""
+        if self.enabled:
+            self.registry.observe(name, labels, value)
+
+    # Flask
+
+    def _start_request(self):
+        self._ensure_worker()
+        g.metrics_started = (time.perf_counter(), getattr(self._local, 'queries', 0))
+
+    def _finish_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        began, queries_before = started
+        elapsed = time.perf_counter() - began
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        registry = self.registry
+        registry.observe('afya_http_request_duration_seconds',
+                         (('route', route), ('method', request.method),
+                          ('status', str(response.status_code))), elapsed)
+        registry.observe('afya_http_request_sql_queries', (('route', route),),
+                         getattr(self._local, 'queries', 0) - queries_before)
+        if response.status_code >= 500:
+            registry.inc('afya_errors_total', (('source', 'http'),))
+
+        if self.router is not None and request.endpoint == 'main.ussd_callback':
+            node, _ = self.router.resolve(request.values.get('text', ''))
+            label = (node.key or '(dial)') if node is not None else 'invalid'
+            registry.observe('afya_ussd_node_duration_seconds', (('node', label),), elapsed)
+        return response
+
+    def _request_exception(self, sender, exception, **extra):
+        self.registry.inc('afya_errors_total', (('source', 'http'),))
+
+    def _start_render(self, sender, template, context, **extra):
+        stack = getattr(self._local, 'renders', None)
+        if stack is None:
+            stack = self._local.renders = []
+        stack.append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        stack = getattr(self._local, 'renders', None)
+        if stack:
+            self.registry.observe('afya_template_render_duration_seconds',
+                                  (('template', template.name or 'string'),),
+                                  time.perf_counter() - stack.pop())
+
+    # SQLAlchemy
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('metrics_started')
+        if not started:
+            return
+        operation = statement.lstrip()[:8].split(None, 1)
+        operation = operation[0].upper() if operation else 'OTHER'
+        if operation not in SQL_OPERATIONS:
+            operation = 'OTHER'
+        self.registry.observe('afya_sql_query_duration_seconds',
+                              (('operation', operation),), time.perf_counter() - started.pop())
+
+    def _query_error(self, context):
+        started = context.connection.info.get('metrics_started') if context.connection else None
+        if started:
+            started.pop()
+        self.registry.inc('afya_errors_total', (('source', 'sql'),))
+
+    # Redis
+
+    def _redis_command(self, command, seconds, failed):
+        self.registry.observe('afya_redis_command_duration_seconds',
+                              (('command', command),), seconds)
+        if failed:
+            self.registry.inc('afya_errors_total', (('source', 'redis'),))
+
+    # Exposition
+
+    def render(self):
+        """Text for /metrics: every worker's totals, this one's current"""
+        snapshots = [self.snapshot()]
+        if self._shared():
+            try:
+                snapshots += self._others()
+            except Exception as e:
+                log.warning("Metrics merge error: %s", e)
+        return render(*merge(snapshots))
+
+    def shutdown(self):
+        """Fold this worker's final totals into the retired aggregate"""
+        if self._pid != os.getpid() or not self._shared():
+            return
+        try:
+            final = self.snapshot()
+            for attempt in range(5):
+                if self._retire(final):
+                    self._pid = None  # retired once; a later call is a no-op
+                    return
+        except Exception as e:
+            log.warning("Metrics shutdown error: %s", e)
+
+    def _shared(self):
+        return bool(self.flush_interval and os.environ.get('REDIS_URL'))
+
+    def _key(self, worker_id=None):
+        return f"{self.KEY_PREFIX}{worker_id or self.worker_id}"
+
+    def _others(self):
+        # Registered workers and the retired totals, read as of one moment
+        r = redis_client.get_redis()
+        cutoff = time.time() - self.flush_interval * 3
+        for attempt in range(3):
+            with r.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.WORKERS_KEY, self.RETIRED_KEY)
+                    workers = [(worker, seen) for worker, seen in
+                               pipe.zrange(self.WORKERS_KEY, 0, -1, withscores=True)
+                               if worker != self.worker_id]
+                    values = pipe.mget([self._key(worker) for worker, _ in workers]) \
+                        if workers else []
+                    retired = pipe.get(self.RETIRED_KEY)
+                    pipe.multi()
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue  # a worker was retired meanwhile; read again
+
+        snapshots = [json.loads(retired)] if retired else []
+        for (worker, seen), value in zip(workers, values):
+            if value:
+                snapshot = json.loads(value)
+                if seen < cutoff:
+                    snapshot['gauges'] = []  # not heard from lately; no current state
+                snapshots.append(snapshot)
+        return snapshots
+
+    def _retire(self, final=None):
+        """Fold stale workers (and final, this worker's) into the retired totals
+
+        Returns False if another worker changed the registry meanwhile.
+        """
+        r = redis_client.get_redis()
+        cutoff = time.time() - self.flush_interval * 3
+        with r.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(self.WORKERS_KEY, self.RETIRED_KEY)
+                workers = [worker for worker in pipe.zrangebyscore(self.WORKERS_KEY, '-inf', cutoff)
+                           if worker != self.worker_id]
+                if not workers and final is None:
+                    return True
+                snapshots = [json.loads(value) for value in
+                             pipe.mget([self._key(worker) for worker in workers]) if value] \
+                    if workers else []
+                retired = pipe.get(self.RETIRED_KEY)
+                if retired:
+                    snapshots.append(json.loads(retired))
+                if final is not None:
+                    snapshots.append(final)
+                    workers.append(self.worker_id)
+
+                pipe.multi()
+                pipe.set(self.RETIRED_KEY, json.dumps(totals(snapshots)))
+                pipe.zrem(self.WORKERS_KEY, *workers)
+                pipe.delete(*[self._key(worker) for worker in workers])
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so start lazily in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._new_worker_id()
+            if self._shared():
+                self._worker = threading.Thread(
+                    target=self._run, name='afya-metrics', daemon=True)
+                self._worker.start()
+
+    def _new_worker_id(self):
+        # Unique per process lifetime, so a reused pid never inherits totals
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{time.time():.3f}"
+        self._published = False
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self._publish()
+                self._retire()
+            except Exception as e:
+                log.warning("Metrics flush error: %s", e)
+
+    def _publish(self):
+        r = redis_client.get_redis()
+        pipe = r.pipeline(transaction=True)
+        pipe.set(self._key(), json.dumps(self.snapshot()))
+        pipe.zadd(self.WORKERS_KEY, {self.worker_id: time.time()})
+        added = pipe.execute()[1]
+
+        if added and self._published:
+            # Retired while stalled, so these totals were already folded in;
+            # withdraw them and count afresh under a new id
+            pipe = r.pipeline(transaction=True)
+            pipe.zrem(self.WORKERS_KEY, self.worker_id)
+            pipe.delete(self._key())
+            pipe.execute()
+            log.warning("Metrics worker %s was retired while alive; restarting its totals",
+                        self.worker_id)
+            self.registry = Registry()
+            self._new_worker_id()
+            return
+        self._published = True
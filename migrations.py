@@ -0,0 +1,195 @@
+"""
+Afya Schema Migrations
+Online migration of the legacy text date columns to native Date/DateTime,
+and facility coordinates
+
+Rollout on a populated database:
+    1. flask --app app migrate-dates   adds the typed columns, backfills
+                                       them in chunks, then builds indexes
+    2. deploy the code that reads the typed columns (it keeps writing the
+       legacy text columns too, see legacy_text in models.py)
+    3. flask --app app migrate-dates   again, to pick up rows written by
+                                       old workers during the deploy
+
+Every step is idempotent and can be interrupted and re-run. Each chunk is
+its own short transaction, so no table is locked for the whole backfill.
+"""
+import time
+from datetime import datetime
+from sqlalchemy import inspect, text, bindparam, Date, DateTime, Float
+
+
+# Formats the text columns were written with over the app's lifetime
+LEGACY_FORMATS = (
+    '%d/%m/%y %H:%M:%S.%f',
+    '%d/%m/%y %H:%M:%S',
+    '%d/%m/%y',
+    '%d/%m/%Y',
+)
+
+# (table, primary key, typed column, type, legacy text column)
+DATE_COLUMNS = [
+    ('healthcare_facility', 'facility_id', 'registered_at', DateTime(), 'registration_date'),
+    ('healthcare_provider', 'provider_id', 'registered_at', DateTime(), 'registration_date'),
+    ('patient', 'patient_id', 'registered_at', DateTime(), 'registration_date'),
+    ('medical_record', 'record_id', 'visit_on', Date(), 'visit_date'),
+    ('system_log', 'log_id', 'logged_at', DateTime(), 'timestamp'),
+]
+
+# (table, column, type) added for the facility index
+LOCATION_COLUMNS = [
+    ('healthcare_facility', 'latitude', Float()),
+    ('healthcare_facility', 'longitude', Float()),
+]
+
+
+def parse_legacy_date(value, as_date=False):
+    """Parse a legacy text date, or return None if it is unreadable"""
+    if not value:
+        return None
+    for fmt in LEGACY_FORMATS:
+        try:
+            parsed = datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        return parsed.date() if as_date else parsed
+    return None
+
+
+def add_columns(engine, report=print, columns=None):
+    """Add any missing typed columns (nullable, so this is metadata-only)"""
+    if columns is None:
+        columns = [(table, column, column_type)
+                   for table, _, column, column_type, _ in DATE_COLUMNS]
+    inspector = inspect(engine)
+    for table, column, column_type in columns:
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        if column in existing:
+            continue
+        ddl = column_type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+        report(f"➕ Added {table}.{column} ({ddl})")
+
+
+def backfill(engine, chunk_size=1000, pause=0.0, report=print):
+    """Copy legacy text dates into the typed columns, one chunk at a time"""
+    for table, pk, column, column_type, legacy in DATE_COLUMNS:
+        as_date = isinstance(column_type, Date)
+
+        with engine.connect() as conn:
+            total = conn.execute(text(
+                f'SELECT COUNT(*) FROM {table} '
+                f'WHERE {column} IS NULL AND {legacy} IS NOT NULL')).scalar()
+
+        if not total:
+            report(f"✅ {table}.{column}: nothing to backfill")
+            continue
+
+        select_chunk = text(
+            f'SELECT {pk}, {legacy} FROM {table} '
+            f'WHERE {pk} > :last_id AND {column} IS NULL AND {legacy} IS NOT NULL '
+            f'ORDER BY {pk} LIMIT :limit')
+        update_row = text(
+            f'UPDATE {table} SET {column} = :value WHERE {pk} = :row_id'
+        ).bindparams(bindparam('value', type_=column_type))
+
+        last_id = 0
+        done = 0
+        skipped = 0
+        started = time.monotonic()
+
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(
+                    select_chunk, {'last_id': last_id, 'limit': chunk_size}).fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for row_id, legacy_value in rows:
+                    value = parse_legacy_date(legacy_value, as_date)
+                    if value is None:
+                        skipped += 1
+                    else:
+                        updates.append({'value': value, 'row_id': row_id})
+
+                if updates:
+                    conn.execute(update_row, updates)
+
+            last_id = rows[-1][0]
+            done += len(rows)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            report(f"   {table}.{column}: {done}/{total} rows "
+                   f"({done / elapsed:.0f} rows/s)")
+
+            if pause:
+                time.sleep(pause)
+
+        report(f"✅ {table}.{column}: backfilled {done - skipped} rows"
+               + (f", {skipped} unreadable left NULL" if skipped else ""))
+
+
+def create_indexes(engine, metadata, report=print):
+    """Create model indexes that are missing on the date tables"""
+    inspector = inspect(engine)
+    tables = {table for table, _, _, _, _ in DATE_COLUMNS}
+
+    for table_name in sorted(tables):
+        table = metadata.tables[table_name]
+        existing = {i['name'] for i in inspector.get_indexes(table_name)}
+
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            columns = ', '.join(c.name for c in index.columns)
+
+            if engine.dialect.name == 'postgresql':
+                # Build without blocking writes; must run outside a transaction
+                with engine.connect().execution_options(
+                        isolation_level='AUTOCOMMIT') as conn:
+                    conn.execute(text(
+                        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} '
+                        f'ON {table_name} ({columns})'))
+            else:
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f'CREATE INDEX IF NOT EXISTS {index.name} '
+                        f'ON {table_name} ({columns})'))
+            report(f"🗂️ Created index {index.name} on {table_name} ({columns})")
+
+
+def migrate_dates(engine, metadata, chunk_size=1000, pause=0.0, report=print):
+    """Run the full date column migration"""
+    report("📅 Migrating legacy text dates to native date columns")
+    add_columns(engine, report)
+    backfill(engine, chunk_size, pause, report)
+    create_indexes(engine, metadata, report)
+    report("✅ Date migration complete")
+
+
+def migrate_locations(engine, geocode, report=print):
+    """Add the facility coordinate columns and fill them from the location text"""
+    report("📍 Adding facility coordinates")
+    add_columns(engine, report, LOCATION_COLUMNS)
+
+    with engine.begin() as conn:
+        rows = conn.execute(text(
+            'SELECT facility_id, location FROM healthcare_facility '
+            'WHERE latitude IS NULL OR longitude IS NULL')).fetchall()
+        updates = []
+        unknown = []
+        for facility_id, location in rows:
+            point = geocode(location)
+            if point is None:
+                unknown.append(location or '')
+            else:
+                updates.append({'lat': point[0], 'lon': point[1], 'row_id': facility_id})
+        if updates:
+            conn.execute(text(
+                'UPDATE healthcare_facility SET latitude = :lat, longitude = :lon '
+                'WHERE facility_id = :row_id'), updates)
+
+    report(f"✅ Located {len(updates)} facilities"
+           + (f", {len(unknown)} left without coordinates (unknown places: "
+              f"{', '.join(sorted(set(unknown))[:10])})" if unknown else ""))
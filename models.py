@@ -0,0 +1,126 @@
+"""
+Afya Database Models
+"""
+from datetime import datetime, date
+from flask_sqlalchemy import SQLAlchemy
+from db_routing import RoutingSession
+
+# Bound to an app in create_app(); see app.py. Reads may go to a replica,
+# see db_routing.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def legacy_text(column, fmt):
+    """Default that mirrors a typed date column into its legacy text column.
+
+    The old '%d/%m/%y' string columns are kept and dual-written until every
+    row has been backfilled (see migrations.py), so older workers and the
+    NOT NULL constraints on existing databases keep working.
+    """
+    def default(context):
+        value = context.get_current_parameters().get(column) or datetime.now()
+        return value.strftime(fmt)
+    return default
+
+
+class HealthcareFacility(db.Model):
+    """Healthcare Facility Model"""
+    id = db.Column('facility_id', db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    facility_type = db.Column(db.String(50))
+    location = db.Column(db.String(100))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    phone = db.Column(db.String(15))
+    registration_date = db.Column(
+        'registered_at', db.DateTime, default=datetime.now)
+    legacy_registration_date = db.deferred(db.Column(
+        'registration_date', db.String(20),
+        default=legacy_text('registered_at', '%d/%m/%y %H:%M:%S')))
+    is_active = db.Column(db.Boolean, default=True)
+
+
+class HealthcareProvider(db.Model):
+    """Healthcare Provider Model"""
+    id = db.Column('provider_id', db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    phone = db.Column(db.String(15), unique=True, nullable=False)
+    specialization = db.Column(db.String(100))
+    facility_id = db.Column(db.Integer, db.ForeignKey(
+        'healthcare_facility.facility_id'))
+    pin = db.Column(db.String(64))  # Hashed PIN
+    registration_date = db.Column(
+        'registered_at', db.DateTime, default=datetime.now)
+    legacy_registration_date = db.deferred(db.Column(
+        'registration_date', db.String(20),
+        default=legacy_text('registered_at', '%d/%m/%y %H:%M:%S')))
+    is_active = db.Column(db.Boolean, default=True)
+
+    facility = db.relationship('HealthcareFacility', backref='providers')
+
+
+class Patient(db.Model):
+    """Patient Model"""
+    id = db.Column('patient_id', db.Integer, primary_key=True)
+    phone = db.Column(db.String(15), unique=True, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    date_of_birth = db.Column(db.String(10))
+    gender = db.Column(db.String(10))
+    blood_type = db.Column(db.String(5))
+    allergies = db.Column(db.Text)
+    emergency_contact = db.Column(db.String(15))
+    registration_date = db.Column(
+        'registered_at', db.DateTime, default=datetime.now)
+    legacy_registration_date = db.deferred(db.Column(
+        'registration_date', db.String(20),
+        default=legacy_text('registered_at', '%d/%m/%y %H:%M:%S')))
+    is_active = db.Column(db.Boolean, default=True)
+
+
+class MedicalRecord(db.Model):
+    """Medical Record Model"""
+    id = db.Column('record_id', db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey(
+        'patient.patient_id'), nullable=False)
+    provider_id = db.Column(db.Integer, db.ForeignKey(
+        'healthcare_provider.provider_id'), nullable=False)
+    facility_id = db.Column(db.Integer, db.ForeignKey(
+        'healthcare_facility.facility_id'), nullable=False)
+    visit_date = db.Column('visit_on', db.Date, default=date.today)
+    legacy_visit_date = db.deferred(db.Column(
+        'visit_date', db.String(20), nullable=False,
+        default=legacy_text('visit_on', '%d/%m/%y')))
+    chief_complaint = db.Column(db.Text)
+    diagnosis = db.Column(db.Text)
+    treatment_plan = db.Column(db.Text)
+    notes = db.Column(db.Text)
+
+    patient = db.relationship('Patient', backref='medical_records')
+    provider = db.relationship('HealthcareProvider', backref='medical_records')
+    facility = db.relationship('HealthcareFacility', backref='medical_records')
+
+    __table_args__ = (
+        db.Index('ix_medical_record_provider_visit', 'provider_id', 'visit_on'),
+        db.Index('ix_medical_record_patient_visit', 'patient_id', 'visit_on'),
+        db.Index('ix_medical_record_facility_visit', 'facility_id', 'visit_on'),
+    )
+
+
+class SystemLog(db.Model):
+    """System Activity Logs"""
+    id = db.Column('log_id', db.Integer, primary_key=True)
+    timestamp = db.Column(
+        'logged_at', db.DateTime, default=datetime.now, index=True)
+    legacy_timestamp = db.deferred(db.Column(
+        'timestamp', db.String(30), nullable=False,
+        default=legacy_text('logged_at', '%d/%m/%y %H:%M:%S.%f')))
+    user_phone = db.Column(db.String(15))
+    action = db.Column(db.String(100), nullable=False)
+    details = db.Column(db.Text)
+
+
+class SystemCounter(db.Model):
+    """Maintained totals, see counters.py"""
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
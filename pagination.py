@@ -0,0 +1,115 @@
+"""
+Afya Pagination
+Keyset (cursor) pagination for the list pages
+"""
+import json
+import base64
+from datetime import datetime, date
+from sqlalchemy import tuple_, bindparam
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+
+def _decode_value(value):
+    if 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    if 'd' in value:
+        return date.fromisoformat(value['d'])
+    return value
+
+
+def encode_cursor(direction, values):
+    """Opaque, URL-safe cursor for a page boundary"""
+    raw = json.dumps([direction, values], default=_encode_value,
+                     separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (direction, values); raises ValueError on a bad cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, values = json.loads(
+            base64.urlsafe_b64decode(padded.encode()), object_hook=_decode_value)
+    except Exception:
+        raise ValueError("Invalid page cursor")
+
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise ValueError("Invalid page cursor")
+    return direction, values
+
+
+class Page:
+    """One page of results plus the cursors around it"""
+
+    def __init__(self, items, page_size, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.page_size = page_size
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_page(query, columns, cursor=None, page_size=25, descending=False):
+    """Fetch one page of query ordered by columns (model attributes that
+    together form a unique key).
+
+    Only the rows of the page are read: the cursor becomes a row-value
+    comparison against the ordered key columns, so the cost of a page does
+    not depend on how deep into the table it is. Invalid cursors restart
+    from the first page.
+    """
+    direction, values = 'next', None
+    if cursor:
+        try:
+            direction, values = decode_cursor(cursor)
+        except ValueError:
+            direction, values = 'next', None
+        if values is not None and len(values) != len(columns):
+            direction, values = 'next', None
+
+    forward = direction == 'next'
+    # Paging backwards walks the index the other way, then flips the rows
+    ascending = forward != descending
+
+    if values is not None:
+        key = tuple_(*columns)
+        bound = tuple_(*[bindparam(None, v, type_=c.type)
+                         for c, v in zip(columns, values)])
+        query = query.filter(key > bound if ascending else key < bound)
+
+    order = [c.asc() if ascending else c.desc() for c in columns]
+    rows = query.order_by(*order).limit(page_size + 1).all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if not forward:
+        rows.reverse()
+
+    if not rows:
+        return Page(rows, page_size)
+
+    first = [getattr(rows[0], c.key) for c in columns]
+    last = [getattr(rows[-1], c.key) for c in columns]
+
+    if forward:
+        next_cursor = encode_cursor('next', last) if has_more else None
+        prev_cursor = encode_cursor('prev', first) if values is not None else None
+    else:
+        next_cursor = encode_cursor('next', last)
+        prev_cursor = encode_cursor('prev', first) if has_more else None
+
+    return Page(rows, page_size, next_cursor, prev_cursor)
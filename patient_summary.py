@@ -0,0 +1,258 @@
+"""
+Afya Patient Summaries
+Per-patient summaries and their USSD screens, kept current on every commit
+"""
+import os
+import json
+import logging
+import redis
+from datetime import date
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import load_only
+from redis_client import get_redis
+from db_routing import primary
+
+log = logging.getLogger('afya.summary')
+
+SCREEN_LIMIT = 160  # one SMS / USSD page
+LINE_WIDTH = 24     # widest line a basic phone shows without wrapping
+
+
+def fit_screen(lines, limit=SCREEN_LIMIT):
+    """Shorten long lines, then drop lines from the end until it fits"""
+    lines = [line if len(line) <= LINE_WIDTH else line[:LINE_WIDTH - 3] + "..."
+             for line in lines]
+    while len(lines) > 1 and len('\n'.join(lines)) > limit:
+        lines.pop()
+    return '\n'.join(lines)[:limit].rstrip()
+
+
+def short_date(value):
+    return date.fromisoformat(value).strftime('%d/%m/%y') if value else 'N/A'
+
+
+class PatientSummaries:
+    """Patient summaries under patient:summary:<phone>, one hash per patient
+
+    Fields:
+        data        compact JSON: name, blood type, allergies, record
+                    count and the last VISITS visits
+        find        provider "Find Patient" screen
+        records     patient "My Health Records" screen
+
+    A lookup is a single HGET of the screen it needs. A miss builds the
+    summary from the database and stores it. Committed medical records and
+    patient changes update stored summaries in place (no queries); the TTL
+    only catches writes that bypass the ORM, such as bulk imports.
+    """
+
+    KEY_PREFIX = "patient:summary:"
+    VISITS = 3
+
+    def __init__(self, db, ttl=None):
+        self.db = db
+        self.r = get_redis()
+        self.ttl = ttl or int(os.environ.get('PATIENT_SUMMARY_TTL', 86400))
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def key(self, phone):
+        return f"{self.KEY_PREFIX}{phone}"
+
+    # Reads
+
+    def screen(self, phone, name):
+        """Pre-rendered screen text for an active patient, or None if there is none"""
+        try:
+            text = self.r.hget(self.key(phone), name)
+        except redis.RedisError as e:
+            log.warning("Patient summary read error: %s", e)
+            summary = self.build(phone)
+            return self.render(summary)[name] if summary else None
+
+        if text is not None:
+            return text
+        summary = self.build(phone)
+        if summary is None:
+            return None
+        self.store(summary)
+        return self.render(summary)[name]
+
+    @primary()
+    def build(self, phone):
+        """Summary from the database: the patient, a count and the last visits"""
+        from app import Patient, MedicalRecord
+
+        patient = Patient.query.filter_by(phone=phone, is_active=True).first()
+        if not patient:
+            return None
+
+        count = MedicalRecord.query.filter_by(patient_id=patient.id).count()
+        visits = MedicalRecord.query.options(
+            load_only(MedicalRecord.visit_date, MedicalRecord.chief_complaint)
+        ).filter_by(patient_id=patient.id).order_by(
+            MedicalRecord.visit_date.desc(), MedicalRecord.id.desc()
+        ).limit(self.VISITS).all()
+
+        summary = self._patient_fields(patient)
+        summary['count'] = count
+        summary['visits'] = [[visit.visit_date.isoformat() if visit.visit_date else None,
+                              visit.chief_complaint or 'General'] for visit in visits]
+        return summary
+
+    # Writes
+
+    def store(self, summary):
+        """Save a summary and its screens in one round trip"""
+        key = self.key(summary['phone'])
+        try:
+            pipe = self.r.pipeline(transaction=True)
+            pipe.hset(key, mapping=self._fields(summary))
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            log.warning("Patient summary write error: %s", e)
+
+    def invalidate(self, phone):
+        """Drop a summary so the next lookup rebuilds it"""
+        try:
+            self.r.delete(self.key(phone))
+        except redis.RedisError as e:
+            log.warning("Patient summary invalidation error: %s", e)
+
+    def add_visit(self, phone, visit_date, complaint):
+        """Count a new record and put it among the recent visits"""
+        def change(summary):
+            summary['count'] += 1
+            summary['visits'].insert(0, [visit_date, complaint or 'General'])
+            # Newest first (same-day visits by entry); visits without a date last
+            summary['visits'].sort(key=lambda visit: visit[0] or '', reverse=True)
+            del summary['visits'][self.VISITS:]
+            return summary
+        self._update(phone, change)
+
+    def update_patient(self, fields):
+        """Apply changed patient fields to a stored summary"""
+        if not fields['active']:
+            self.invalidate(fields['phone'])
+            return
+
+        def change(summary):
+            summary.update(fields)
+            return summary
+        self._update(fields['phone'], change)
+
+    def _update(self, phone, change):
+        # Optimistic read-modify-write; concurrent writers retry, then give up
+        # and leave the next lookup to rebuild from the database
+        key = self.key(phone)
+        try:
+            for attempt in range(3):
+                with self.r.pipeline(transaction=True) as pipe:
+                    try:
+                        pipe.watch(key)
+                        data = pipe.hget(key, 'data')
+                        if data is None:
+                            return  # not cached; built on the next lookup
+                        summary = change(json.loads(data))
+                        pipe.multi()
+                        pipe.hset(key, mapping=self._fields(summary))
+                        pipe.expire(key, self.ttl)
+                        pipe.execute()
+                        return
+                    except redis.WatchError:
+                        continue
+        except redis.RedisError as e:
+            log.warning("Patient summary update error: %s", e)
+        self.invalidate(phone)
+
+    # Rendering
+
+    def render(self, summary):
+        """The USSD screens for one summary, each within SCREEN_LIMIT"""
+        visits = [f"{short_date(day)} {complaint}" for day, complaint in summary['visits']]
+        last = [f"Last: {visits[0]}"] if visits else []
+
+        return {
+            'find': fit_screen([
+                summary['name'],
+                f"Phone: {summary['phone']}",
+                f"Blood: {summary['blood_type']}",
+                f"Allergy: {summary['allergies']}",
+                f"Records: {summary['count']}"
+            ] + last),
+            'records': fit_screen([
+                "YOUR MEDICAL RECORDS",
+                f"Visits: {summary['count']}",
+                ""
+            ] + (visits or ["No visits yet."]))
+        }
+
+    def _fields(self, summary):
+        fields = self.render(summary)
+        fields['data'] = json.dumps(summary, separators=(',', ':'))
+        return fields
+
+    def _patient_fields(self, patient):
+        return {
+            'phone': patient.phone,
+            'name': patient.name or '',
+            'blood_type': patient.blood_type or 'Unknown',
+            'allergies': patient.allergies or 'None known',
+            'active': bool(patient.is_active)
+        }
+
+    # Committed records and patient changes update the stored summaries
+
+    def _after_flush(self, session, flush_context):
+        from app import Patient, MedicalRecord
+
+        pending = session.info.setdefault('summary_changes', [])
+        changed = list(session.new) + list(session.dirty) + list(session.deleted)
+
+        # Patients first, so a new patient's summary exists before its visits count
+        for obj in changed:
+            if not isinstance(obj, Patient):
+                continue
+            for old_phone in inspect(obj).attrs.phone.history.deleted or ():
+                pending.append(('drop', old_phone))
+            if obj in session.deleted:
+                pending.append(('drop', obj.phone))
+            elif obj in session.new:
+                summary = self._patient_fields(obj)
+                if summary['active']:
+                    summary.update(count=0, visits=[])
+                    pending.append(('new', summary))
+            elif session.is_modified(obj, include_collections=False):
+                pending.append(('patient', self._patient_fields(obj)))
+
+        for obj in changed:
+            if not isinstance(obj, MedicalRecord):
+                continue
+            with session.no_autoflush:
+                patient = session.get(Patient, obj.patient_id)
+            if patient is None:
+                continue
+            if obj in session.new:
+                pending.append(('visit', patient.phone,
+                                obj.visit_date.isoformat() if obj.visit_date else None,
+                                obj.chief_complaint))
+            else:
+                pending.append(('drop', patient.phone))
+
+    def _after_commit(self, session):
+        for change in session.info.pop('summary_changes', ()):
+            kind = change[0]
+            if kind == 'drop':
+                self.invalidate(change[1])
+            elif kind == 'new':
+                self.store(change[1])
+            elif kind == 'patient':
+                self.update_patient(change[1])
+            elif kind == 'visit':
+                self.add_visit(*change[1:])
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('summary_changes', None)
@@ -0,0 +1,125 @@
+"""
+Afya Provider Authentication
+Provider PIN login backed by a shared, expiring identity cache
+"""
+import os
+import hmac
+import logging
+import redis
+from sqlalchemy.orm import joinedload
+from redis_client import get_redis
+from db_routing import primary
+
+log = logging.getLogger('afya.auth')
+
+
+# Cache a loaded identity only if no invalidate() ran since the load began
+STORE_IDENTITY_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class ProviderAuthenticator:
+    """Verify provider PINs with at most one DB round trip per login
+
+    Verified provider and facility identities are cached in Redis under
+    provider:auth:<phone> with a TTL, so every worker shares one cache and
+    invalidate() takes effect immediately everywhere. The PIN is checked
+    in memory against the cached hash.
+
+    invalidate() also bumps provider:auth:gen:<phone>, and a lookup caches
+    what it loaded only if that generation is unchanged, so a load that
+    read the database before a status or PIN change cannot write the old
+    identity back after the change was invalidated.
+    """
+
+    KEY_PREFIX = "provider:auth:"
+    GEN_PREFIX = "provider:auth:gen:"
+    # Outlives any load in flight; an expired generation only fails a store
+    GEN_TTL = 86400
+
+    def __init__(self, ttl=None):
+        self.r = get_redis()
+        self.ttl = ttl or int(os.environ.get('PROVIDER_AUTH_TTL', 300))
+        self._store = self.r.register_script(STORE_IDENTITY_SCRIPT)
+
+    def key(self, phone):
+        return f"{self.KEY_PREFIX}{phone}"
+
+    def gen_key(self, phone):
+        return f"{self.GEN_PREFIX}{phone}"
+
+    def authenticate(self, phone, pin):
+        """Return the provider identity dict, or None if login fails"""
+        from app import hash_pin
+
+        identity = self.lookup(phone)
+        if not identity or identity['is_active'] != '1':
+            return None
+
+        if not hmac.compare_digest(identity['pin'], hash_pin(pin)):
+            return None
+        return identity
+
+    def lookup(self, phone):
+        """Cached provider identity by phone, loaded from the DB on a miss"""
+        try:
+            identity = self.r.hgetall(self.key(phone))
+        except redis.RedisError:
+            identity = None
+
+        if identity:
+            return identity
+
+        try:
+            generation = self.r.get(self.gen_key(phone)) or '0'
+        except redis.RedisError:
+            generation = None
+
+        identity = self._load(phone)
+        if identity and generation is not None:
+            fields = [item for pair in identity.items() for item in pair]
+            try:
+                self._store(keys=[self.key(phone), self.gen_key(phone)],
+                            args=[generation, self.ttl] + fields)
+            except redis.RedisError:
+                pass
+        return identity
+
+    def invalidate(self, phone):
+        """Drop a provider's cached identity after a status or PIN change"""
+        try:
+            pipe = self.r.pipeline(transaction=True)
+            pipe.incr(self.gen_key(phone))
+            pipe.expire(self.gen_key(phone), self.GEN_TTL)
+            pipe.delete(self.key(phone))
+            pipe.execute()
+        except redis.RedisError as e:
+            log.warning("Provider cache invalidation error: %s", e)
+
+    @primary()
+    def _load(self, phone):
+        from app import HealthcareProvider
+
+        # Indexed lookup by phone, facility joined into the same query
+        provider = HealthcareProvider.query.options(
+            joinedload(HealthcareProvider.facility)
+        ).filter_by(phone=phone).first()
+
+        if not provider:
+            return None
+
+        return {
+            'id': str(provider.id),
+            'name': provider.name or '',
+            'pin': provider.pin or '',
+            'is_active': '1' if provider.is_active else '0',
+            'facility_id': str(provider.facility_id or ''),
+            'facility_name': provider.facility.name if provider.facility else ''
+        }
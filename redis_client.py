@@ -0,0 +1,146 @@
+"""
+Afya Redis Client
+Process-wide Redis connection pool shared by sessions, OTPs and health checks
+"""
+import os
+import threading
+import time
+import redis
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """Blocking connection pool that tracks waits and connection errors"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_time = 0.0
+        self.errors = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        # An empty queue means every connection is checked out
+        waited = self.pool.empty()
+        start = time.perf_counter()
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self.errors += 1
+            raise
+        finally:
+            if waited:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+
+    def stats(self):
+        """Pool utilisation counters for monitoring"""
+        available = self.pool.qsize()
+        return {
+            'max_connections': self.max_connections,
+            'created_connections': len(self._connections),
+            'in_use_connections': self.max_connections - available,
+            'waits': self.waits,
+            'wait_time_ms': round(self.wait_time * 1000, 2),
+            'errors': self.errors
+        }
+
+
+# Round trips made by each thread, for per-request stats
+_local = threading.local()
+
+# Called as command_observer(command, seconds, failed) after every round
+# trip when set; see metrics.py
+command_observer = None
+
+
+def round_trips():
+    """Redis round trips made so far by the calling thread"""
+    return getattr(_local, 'round_trips', 0)
+
+
+def _count_round_trip():
+    _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+
+
+class AfyaPipeline(redis.client.Pipeline):
+    """Pipeline whose execute() counts as one round trip"""
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        _count_round_trip()
+        if command_observer is None:
+            return super().execute(raise_on_error)
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(raise_on_error)
+            failed = False
+            return result
+        finally:
+            command_observer('PIPELINE', time.perf_counter() - start, failed)
+
+
+class AfyaRedis(redis.Redis):
+    """Redis client that counts command errors against its pool"""
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AfyaPipeline(self.connection_pool, self.response_callbacks,
+                            transaction, shard_hint)
+
+    def execute_command(self, *args, **options):
+        _count_round_trip()
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute_command(*args, **options)
+            failed = False
+            return result
+        except (redis.ConnectionError, redis.TimeoutError):
+            pool = self.connection_pool
+            if isinstance(pool, InstrumentedConnectionPool):
+                pool.errors += 1
+            raise
+        finally:
+            if command_observer is not None:
+                command_observer(str(args[0]).upper(), time.perf_counter() - start, failed)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_pool():
+    """Build the connection pool from environment settings"""
+    settings = {
+        'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', 20)),
+        'timeout': float(os.environ.get('REDIS_POOL_TIMEOUT', 2)),
+        'socket_timeout': float(os.environ.get('REDIS_SOCKET_TIMEOUT', 1)),
+        'socket_connect_timeout': float(
+            os.environ.get('REDIS_CONNECT_TIMEOUT', 1)),
+        'health_check_interval': int(
+            os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+        'decode_responses': True
+    }
+
+    if os.environ.get('REDIS_URL') != None:
+        return InstrumentedConnectionPool.from_url(
+            os.environ.get('REDIS_URL'), **settings)
+    return InstrumentedConnectionPool(**settings)
+
+
+def get_redis():
+    """Return the shared Redis client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AfyaRedis(connection_pool=create_pool())
+    return _client
+
+
+def pool_stats():
+    """Stats for the shared pool, or None before first use"""
+    if _client is None:
+        return None
+    return _client.connection_pool.stats()
@@ -0,0 +1,57 @@
+"""
+Afya Request Stats
+Per-request database query and Redis round-trip counts
+
+With REQUEST_STATS_HEADERS on, every response carries
+    X-Afya-Queries     SQL statements executed for the request
+    X-Afya-Redis       Redis round trips (a pipeline is one)
+    X-Afya-Time-Ms     time spent in the app, in milliseconds
+so a load test can read them from a live server as well as the test client.
+Counts are per thread, which is per request under gunicorn's sync workers.
+"""
+import time
+import threading
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from redis_client import round_trips
+
+_local = threading.local()
+
+
+def queries():
+    """SQL statements executed so far by the calling thread"""
+    return getattr(_local, 'queries', 0)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+class RequestStats:
+    """Adds the X-Afya-* headers to every response"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('REQUEST_STATS_HEADERS'):
+            return
+        if not event.contains(Engine, 'before_cursor_execute', _count_query):
+            event.listen(Engine, 'before_cursor_execute', _count_query)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.extensions['request_stats'] = self
+
+    def _start(self):
+        g.request_stats = (time.perf_counter(), queries(), round_trips())
+
+    def _finish(self, response):
+        started = g.pop('request_stats', None)
+        if started:
+            began, queries_before, trips_before = started
+            response.headers['X-Afya-Queries'] = str(queries() - queries_before)
+            response.headers['X-Afya-Redis'] = str(round_trips() - trips_before)
+            response.headers['X-Afya-Time-Ms'] = f"{(time.perf_counter() - began) * 1000:.2f}"
+        return response
@@ -0,0 +1,617 @@
+"""
+Afya Search Index
+Ranked, typo-tolerant patient and provider search from memory
+
+Every worker keeps one TrigramIndex per kind (patients, providers) over
+the active records:
+
+    names    each distinct name word has a posting list of the documents
+             using it, and the words themselves are indexed by trigram.
+             A query word is expanded against that vocabulary (exact,
+             prefix for the last word, within one or two edits) and only
+             the postings of those few words are read.
+    phones   normalised phones in two sorted arrays, by phone and by
+             reversed phone, for prefix, ending and one-typo lookups.
+
+Searching the vocabulary rather than every document keeps a query to a
+handful of posting lists however many patients there are. The index is
+loaded once per worker, kept current from the session on commit, and
+other workers follow through the search:index change log (change_log.py,
+whose ChangeLogIndex runs that lifecycle).
+"""
+import re
+import heapq
+import logging
+import unicodedata
+from array import array
+from functools import reduce
+from operator import and_, or_
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import chain, islice
+from change_log import ChangeLogIndex
+from db_routing import primary
+
+log = logging.getLogger('afya.search')
+
+PHONE_LENGTH = 10  # 0XXXXXXXXX
+
+# Word scores: exact 1.0, prefix 0.75-1.0 by how much of the word was
+# typed, typo 0.9 less a share per edit
+PREFIX_SCORE = 0.75
+TYPO_SCORE = 0.9
+
+# Tie-breaks between names matching equally well: each word beyond the
+# query's, and a first name other than the query's first word
+EXTRA_WORD = 0.01
+OTHER_ORDER = 0.005
+
+# Phone scores
+EXACT_PHONE, PREFIX_PHONE, ENDING_PHONE, TYPO_PHONE = 1.0, 0.9, 0.8, 0.7
+
+
+def name_words(text):
+    """Lowercase ASCII words of a name ("Abená O'Neil" -> ['abena', 'o', 'neil'])"""
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode()
+    return re.findall(r'[a-z]+', text.lower())
+
+
+def phone_digits(text):
+    """Digits of a phone or phone fragment, +233/233 written as a leading 0"""
+    digits = re.sub(r'\D', '', text or '')
+    if digits.startswith('233') and len(digits) >= 12:
+        digits = '0' + digits[3:]
+    elif len(digits) == PHONE_LENGTH - 1 and not digits.startswith('0'):
+        digits = '0' + digits
+    return digits
+
+
+def trigrams(word):
+    """Trigrams of a word padded with two spaces each side ("  k", " kw" ... "e  ")
+
+    The padding gives every word len + 2 trigrams, and an edit changes at
+    most four of them, so a word within e edits shares at least
+    len + 2 - 4e of its trigrams.
+    """
+    padded = f"  {word}  "
+    return {padded[i:i + 3] for i in range(len(word) + 2)}
+
+
+def edit_distance(a, b, limit):
+    """Edits (insert, delete, substitute, swap neighbours) from a to b, or limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+def within_one_edit(a, b):
+    """Whether a and b differ by at most one edit, in one pass"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        # One substitution, or two neighbours swapped
+        return a[i + 1:] == b[i + 1:] or (
+            i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:])
+    if len(a) > len(b):
+        return a[i + 1:] == b[i:]
+    return a[i:] == b[i + 1:]
+
+
+class Documents:
+    """A set of documents: the bits of an int, plus a set of the rest
+
+    The common words' documents come as bitmaps, so intersecting and
+    joining them is a few big-int operations however long their postings
+    are; only the rarer words' documents are Python ints.
+    """
+
+    __slots__ = ('bits', 'rest')
+
+    def __init__(self, bits=0, rest=None):
+        self.bits = bits
+        self.rest = set() if rest is None else rest
+
+    def __or__(self, other):
+        return Documents(self.bits | other.bits, self.rest | other.rest)
+
+    def __and__(self, other):
+        rest = self.rest & other.rest
+        rest |= other._among_bits(self.rest)
+        rest |= self._among_bits(other.rest)
+        return Documents(self.bits & other.bits, rest)
+
+    def _among_bits(self, documents):
+        if not self.bits or not documents:
+            return set()
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        size = len(data)
+        return {d for d in documents if d >> 3 < size and data[d >> 3] >> (d & 7) & 1}
+
+    def newest(self):
+        """The documents, highest number first"""
+        previous = None
+        for document in heapq.merge(self._newest_bits(), sorted(self.rest, reverse=True),
+                                    reverse=True):
+            if document != previous:
+                yield document
+                previous = document
+
+    def _newest_bits(self):
+        if not self.bits:
+            return
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'big')
+        top = len(data) - 1
+        for match in re.finditer(rb'[^\x00]', data):
+            byte = data[match.start()]
+            base = (top - match.start()) * 8
+            for bit in range(7, -1, -1):
+                if byte >> bit & 1:
+                    yield base + bit
+
+
+class TrigramIndex:
+    """Names and phones of one kind of record, keyed by record id
+
+    Documents are numbered in the order they are added and a changed
+    record gets a new number, so posting lists only ever grow at the end
+    and higher numbers are newer. Numbers of removed documents stay in the
+    postings until half a list is dead, and are skipped when read.
+
+    A word used by at least one document in DENSE also keeps its postings
+    as a bitmap (a bit per document, an eighth of a byte each), which is
+    what lets a query combine "kwame" and "mensah" at a million patients.
+    """
+
+    EXPANSIONS = 8        # vocabulary words a query word may stand for
+    PREFIX_WORDS = 50     # vocabulary words looked at for a prefix
+    MIN_PREFIX = 2
+    MIN_TYPO = 3
+    SCAN_LIMIT = 200      # documents scored per tier
+    TYPO_SPLIT = 6        # phone typo candidates share the first 6 or last 3 digits
+    DENSE = 256
+    DENSE_MIN = 1024      # postings shorter than this never get a bitmap
+
+    def __init__(self):
+        self.ids = array('q')   # document -> record id
+        self.names = []         # document -> name, None once removed
+        self.phones = []        # document -> phone, None once removed
+        self.documents = {}     # record id -> document
+        self.postings = {}      # word -> array of documents
+        self.bitmaps = {}       # dense word -> bytearray, bit per document
+        self.dead = Counter()   # word -> removed documents in its posting
+        self.vocabulary = []    # sorted words
+        self.grams = {}         # trigram -> set of words
+        self.by_phone = array('I')
+        self.by_ending = array('I')
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _ending(self, document):
+        return self.phones[document][::-1]
+
+    # Changes
+
+    def build(self, records):
+        """Index (id, name, phone) records in bulk; much faster than add()"""
+        for id, name, phone in records:
+            self._append(id, name, phone, bulk=True)
+        self.vocabulary = sorted(self.postings)
+        for word in self.postings:
+            if self._dense(word):
+                self._bitmap(word)
+        live = sorted(self.documents.values())
+        self.by_phone = array('I', sorted(live, key=self.phones.__getitem__))
+        self.by_ending = array('I', sorted(live, key=self._ending))
+
+    def add(self, id, name, phone):
+        """Index one record, replacing what was indexed for its id"""
+        self.remove(id)
+        self._append(id, name, phone)
+
+    def _append(self, id, name, phone, bulk=False):
+        document = len(self.names)
+        self.ids.append(id)
+        self.names.append(name or '')
+        self.phones.append(phone_digits(phone))
+        self.documents[id] = document
+
+        for word in set(name_words(name)):
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = array('I')
+                for gram in trigrams(word):
+                    self.grams.setdefault(gram, set()).add(word)
+                if not bulk:
+                    insort(self.vocabulary, word)
+            posting.append(document)
+            bitmap = self.bitmaps.get(word)
+            if bitmap is not None:
+                if document >> 3 >= len(bitmap):
+                    bitmap.extend(bytes((document >> 3) + 1 - len(bitmap)))
+                bitmap[document >> 3] |= 1 << (document & 7)
+            elif not bulk and self._dense(word):
+                self._bitmap(word)
+
+        if not bulk:
+            insort(self.by_phone, document, key=self.phones.__getitem__)
+            insort(self.by_ending, document, key=self._ending)
+
+    def remove(self, id):
+        """Drop a record from the index"""
+        document = self.documents.pop(id, None)
+        if document is None:
+            return
+        for ordered, key in ((self.by_phone, self.phones.__getitem__),
+                             (self.by_ending, self._ending)):
+            at = bisect_left(ordered, key(document), key=key)
+            while ordered[at] != document:
+                at += 1
+            del ordered[at]
+
+        for word in set(name_words(self.names[document])):
+            self.dead[word] += 1
+            if self.dead[word] * 2 >= len(self.postings[word]):
+                self._compact(word)
+        self.names[document] = self.phones[document] = None
+
+    def _compact(self, word):
+        live = array('I', (document for document in self.postings[word]
+                           if self.names[document] is not None and
+                           self.documents.get(self.ids[document]) == document))
+        del self.dead[word]
+        self.bitmaps.pop(word, None)
+        if live:
+            self.postings[word] = live
+            if self._dense(word):
+                self._bitmap(word)
+            return
+        del self.postings[word]
+        del self.vocabulary[bisect_left(self.vocabulary, word)]
+        for gram in trigrams(word):
+            self.grams[gram].discard(word)
+            if not self.grams[gram]:
+                del self.grams[gram]
+
+    def _dense(self, word):
+        return len(self.postings[word]) >= max(self.DENSE_MIN, len(self.names) // self.DENSE)
+
+    def _bitmap(self, word):
+        bitmap = bytearray(len(self.names) // 8 + 1)
+        for document in self.postings[word]:
+            bitmap[document >> 3] |= 1 << (document & 7)
+        self.bitmaps[word] = bitmap
+
+    # Queries
+
+    def search(self, query, limit=5):
+        """[(score, id, name, phone)], best first; a query without letters is a phone"""
+        words = name_words(query)
+        if words:
+            found = self.search_names(words, prefix=not query[-1:].isspace(), limit=limit)
+        else:
+            found = self.search_phones(phone_digits(query), limit)
+        return [(round(score, 3), self.ids[document], self.names[document],
+                 self.phones[document]) for score, document in found]
+
+    def expand(self, word, prefix=False):
+        """{vocabulary word: score} for the words a query word may stand for"""
+        found = {}
+        if word in self.postings:
+            found[word] = 1.0
+
+        if prefix and len(word) >= self.MIN_PREFIX:
+            at = bisect_left(self.vocabulary, word)
+            for candidate in self.vocabulary[at:at + self.PREFIX_WORDS]:
+                if not candidate.startswith(word):
+                    break
+                if candidate != word:
+                    found[candidate] = PREFIX_SCORE + (1 - PREFIX_SCORE) * len(word) / len(candidate)
+
+        if len(word) >= self.MIN_TYPO:
+            limit = 1 if len(word) < 8 else 2
+            grams = trigrams(word)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self.grams.get(gram, ()))
+            needed = max(1, len(grams) - 4 * limit)
+            for candidate, count in shared.items():
+                if count < needed or candidate in found or abs(len(candidate) - len(word)) > limit:
+                    continue
+                if limit == 1:
+                    edits = 1 if within_one_edit(word, candidate) else 2
+                else:
+                    edits = edit_distance(word, candidate, limit)
+                if edits <= limit:
+                    found[candidate] = TYPO_SCORE * (1 - edits / max(len(word), len(candidate)))
+
+        if len(found) > self.EXPANSIONS:
+            found = dict(heapq.nlargest(self.EXPANSIONS, found.items(),
+                                        key=lambda item: (item[1], len(self.postings[item[0]]))))
+        return found
+
+    def search_names(self, words, prefix=True, limit=5):
+        """[(score, document)] for name words; the last one may be a prefix
+
+        A document scores the mean, over the query words, of its best
+        expansion of each word (0 for a word it has no expansion of), less
+        the EXTRA_WORD / OTHER_ORDER tie-breaks. Candidates come in tiers,
+        each looked at only if the ones before it did not fill the page:
+
+            every word's best expansion     newest first
+            some expansion of every word,
+            or of all words but one         newest SCAN_LIMIT
+            the best-scoring word alone     newest first
+
+        In the second tier a word found verbatim in the vocabulary only
+        stands for itself: the common first names are all one edit from
+        each other, and their unions would cover most of the index. (For a
+        single word, the second tier is its other expansions.)
+        """
+        expansions = [self.expand(word, prefix and i == len(words) - 1)
+                      for i, word in enumerate(words)]
+        matched = sorted((e for e in expansions if e),
+                         key=lambda e: sum(len(self.postings[w]) for w in e))
+        if not matched:
+            return []
+        best = [max(e.values()) for e in matched]
+        tops = [[w for w, score in e.items() if score == top] for e, top in zip(matched, best)]
+        shape = (len(words), expansions[0])
+        found = {}
+
+        if len(matched) == 1:
+            newest = self._merged(tops[0])
+        else:
+            having = [self._documents(top) for top in tops]
+            newest = reduce(and_, having).newest()
+        if self._take(found, newest, sum(best) / len(words), shape, limit):
+            return self._ranked(found, limit)
+
+        if len(matched) == 1:
+            # The word's other expansions are the only other candidates
+            rest = (document for document in self._merged(list(matched[0]))
+                    if document not in found and self.names[document] is not None)
+            for document in islice(rest, self.SCAN_LIMIT):
+                found[document] = self._score(document, expansions, shape)
+            return self._ranked(found, limit)
+
+        # Each word's documents (a word spelt as in the vocabulary stands
+        # for itself, others for any expansion); then those with every word,
+        # or all but one, and the newest of them scored
+        having = [documents if top == 1.0 else self._documents(e)
+                  for documents, e, top in zip(having, matched, best)]
+        if len(having) >= 3:
+            groups = [having[:i] + having[i + 1:] for i in range(len(having))]
+        else:
+            groups = [having]
+        candidates = reduce(or_, (reduce(and_, group) for group in groups))
+        rest = (document for document in candidates.newest()
+                if document not in found and self.names[document] is not None)
+        for document in islice(rest, self.SCAN_LIMIT):
+            found[document] = self._score(document, expansions, shape)
+
+        j = max(range(len(matched)), key=lambda i: best[i])
+        self._take(found, self._merged(tops[j]), best[j] / len(words), shape, limit)
+        return self._ranked(found, limit)
+
+    def _take(self, found, newest, score, shape, limit):
+        # Score documents newest first until `limit` of them need no
+        # tie-break, or SCAN_LIMIT have been looked at; True if the page is full
+        perfect = sum(value >= score for value in found.values())
+        looked = 0
+        for document in newest:
+            if document in found or self.names[document] is None:
+                continue
+            found[document] = score - self._shape(name_words(self.names[document]), shape)
+            perfect += found[document] >= score
+            looked += 1
+            if perfect >= limit or looked >= self.SCAN_LIMIT:
+                break
+        return len(found) >= limit
+
+    def _score(self, document, expansions, shape):
+        words = name_words(self.names[document])
+        return sum(max((e[w] for w in words if w in e), default=0)
+                   for e in expansions) / len(expansions) - self._shape(words, shape)
+
+    @staticmethod
+    def _shape(words, shape):
+        count, first = shape
+        return EXTRA_WORD * max(0, len(words) - count) + \
+            OTHER_ORDER * (not words or words[0] not in first)
+
+    @staticmethod
+    def _ranked(found, limit):
+        ranked = sorted(found.items(), key=lambda item: (-item[1], -item[0]))
+        return [(score, document) for document, score in ranked[:limit]]
+
+    def _merged(self, words):
+        # Documents of several words' postings, newest first
+        previous = None
+        for document in heapq.merge(*(reversed(self.postings[w]) for w in words), reverse=True):
+            if document != previous:
+                yield document
+                previous = document
+
+    def _documents(self, words):
+        # Documents with any of the words
+        documents = Documents()
+        for word in words:
+            bitmap = self.bitmaps.get(word)
+            if bitmap is not None:
+                documents.bits |= int.from_bytes(bitmap, 'little')
+            else:
+                documents.rest.update(self.postings[word])
+        return documents
+
+    def search_phones(self, digits, limit=5):
+        """[(score, document)]: the phone itself, phones starting or ending
+        with the digits, then phones one typo away from a whole number"""
+        if len(digits) < 3:
+            return []
+        phone = self.phones.__getitem__
+
+        found = {}
+        for document in islice(self._starting(self.by_phone, phone, digits), limit):
+            found[document] = EXACT_PHONE if phone(document) == digits else PREFIX_PHONE
+        if 4 <= len(digits) < PHONE_LENGTH:
+            for document in islice(self._starting(self.by_ending, self._ending, digits[::-1]), limit):
+                found.setdefault(document, ENDING_PHONE)
+
+        if len(found) < limit and len(digits) >= PHONE_LENGTH - 1 \
+                and EXACT_PHONE not in found.values():
+            # One typo leaves the first TYPO_SPLIT digits or the last three
+            # alone (the digit between them may be the one that is wrong)
+            head, tail = digits[:self.TYPO_SPLIT], digits[-3:]
+            for document in chain(self._starting(self.by_phone, phone, head),
+                                  self._starting(self.by_ending, self._ending, tail[::-1])):
+                if document not in found and within_one_edit(digits, phone(document)):
+                    found[document] = TYPO_PHONE
+
+        ranked = sorted(found.items(), key=lambda item: (-item[1], phone(item[0])))
+        return [(score, document) for document, score in ranked[:limit]]
+
+    @staticmethod
+    def _starting(ordered, key, fragment):
+        # Documents of a sorted array whose key starts with fragment
+        at = bisect_left(ordered, fragment, key=key)
+        while at < len(ordered) and key(ordered[at]).startswith(fragment):
+            yield ordered[at]
+            at += 1
+
+
+class SearchIndex(ChangeLogIndex):
+    """Patient and provider search, kept in step with commits in every worker"""
+
+    KINDS = ('patient', 'provider')
+    CHANGES = 'search:index'
+    LABEL = 'Search index'
+    THREAD = 'afya-search-index'
+    SESSION_KEY = 'search_changes'
+
+    def __init__(self, db, app=None):
+        super().__init__(db)
+        self.indexes = {kind: TrigramIndex() for kind in self.KINDS}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the SEARCH_* settings"""
+        self.app = app
+        self.poll_interval = app.config.get('SEARCH_INDEX_INTERVAL', 5)
+        self.max_results = app.config.get('SEARCH_MAX_RESULTS', 20)
+        app.extensions['search_index'] = self
+
+    # Reads
+
+    def search(self, query, kinds=KINDS, limit=5):
+        """[{'type', 'id', 'name', 'phone', 'score'}], best first"""
+        self._ensure_loaded()
+        limit = max(1, min(limit, self.max_results))
+        found = []
+        with self._lock:
+            for kind in kinds:
+                found.extend((score, kind, id, name, phone) for score, id, name, phone
+                             in self.indexes[kind].search(query, limit))
+        found.sort(key=lambda item: -item[0])
+        return [{'type': kind, 'id': id, 'name': name, 'phone': phone, 'score': score}
+                for score, kind, id, name, phone in found[:limit]]
+
+    # Loading
+
+    @primary()
+    def load(self):
+        """(Re)build both indexes from every active patient and provider"""
+        from app import Patient, HealthcareProvider
+
+        version = self.changes.version()
+        indexes = {}
+        for kind, model in (('patient', Patient), ('provider', HealthcareProvider)):
+            index = indexes[kind] = TrigramIndex()
+            index.build(self.db.session.query(model.id, model.name, model.phone)
+                        .filter(model.is_active.is_(True))
+                        .order_by(model.id).yield_per(10000))
+        with self._lock:
+            self.indexes = indexes
+            self.version = version
+            self.loaded = True
+        log.info("Search index loaded", extra={
+            'patients': len(indexes['patient']), 'providers': len(indexes['provider'])})
+
+    def apply(self, kind, id, row):
+        """Index one record from its current row data, or drop it"""
+        with self._lock:
+            if row and row['active']:
+                self.indexes[kind].add(id, row['name'], row['phone'])
+            else:
+                self.indexes[kind].remove(id)
+
+    @primary()
+    def patients_added(self, phones):
+        """Index patients inserted without the ORM (bulk imports) by phone"""
+        from app import Patient
+
+        if not phones:
+            return
+        rows = self.db.session.query(Patient.id, Patient.name, Patient.phone).filter(
+            Patient.phone.in_(list(phones))).all()
+        if self.loaded:
+            for id, name, phone in rows:
+                self.apply('patient', id, {'active': True, 'name': name, 'phone': phone})
+        self._publish({f"patient:{id}" for id, _, _ in rows})
+
+    def _row(self, obj):
+        return {'active': bool(obj.is_active), 'name': obj.name, 'phone': obj.phone}
+
+    # ChangeLogIndex: members are "<kind>:<id>"
+
+    def _changes(self, session):
+        from app import Patient, HealthcareProvider
+
+        changes = {}
+        for obj in list(session.new) + list(session.dirty):
+            kind = 'patient' if isinstance(obj, Patient) else \
+                'provider' if isinstance(obj, HealthcareProvider) else None
+            if kind and (obj in session.new or session.is_modified(obj, include_collections=False)):
+                changes[f"{kind}:{obj.id}"] = self._row(obj)
+        for obj in session.deleted:
+            if isinstance(obj, Patient):
+                changes[f"patient:{obj.id}"] = None
+            elif isinstance(obj, HealthcareProvider):
+                changes[f"provider:{obj.id}"] = None
+        return changes
+
+    def _fetch(self, members):
+        from app import Patient, HealthcareProvider
+
+        ids = {kind: set() for kind in self.KINDS}
+        for member in members:
+            kind, id = member.split(':', 1)
+            ids[kind].add(int(id))
+        rows = {}
+        for kind, model in (('patient', Patient), ('provider', HealthcareProvider)):
+            if ids[kind]:
+                rows.update((f"{kind}:{obj.id}", self._row(obj))
+                            for obj in model.query.filter(model.id.in_(ids[kind])))
+        return rows
+
+    def _apply(self, member, row):
+        kind, id = member.split(':', 1)
+        self.apply(kind, int(id), row)
@@ -1,50 +1,83 @@
 import os
 import json
+import logging
 from flask import make_response
-import redis
+from redis_client import get_redis
+
+screen_log = logging.getLogger('afya.ussd.screen')
+
+
+# Append to a session field and slide its expiry in one atomic round trip
+APPEND_FIELD_SCRIPT = """
+local value = (redis.call('HGET', KEYS[1], ARGV[1]) or '') .. ARGV[2]
+redis.call('HSET', KEYS[1], ARGV[1], value)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return value
+"""
 
 
 class SessionManager:
+    # Each USSD session is a Redis hash under this prefix
+    KEY_PREFIX = "ussd:session:"
+
     def __init__(self):
-        if os.environ.get("REDIS_URL") != None:
-            self.r = redis.from_url(os.environ.get("REDIS_URL"))
-        else:
-            self.r = redis.StrictRedis(decode_responses=True)
-        self.id_list = []
+        # Shared, pooled client; see redis_client.py for pool settings
+        self.r = get_redis()
+
+        # Sliding expiry, matched to the telco's USSD session lifetime
+        self.ttl = int(os.environ.get("USSD_SESSION_TTL", 180))
+        self._append_field = self.r.register_script(APPEND_FIELD_SCRIPT)
+
+    def key(self, id):
+        return f"{self.KEY_PREFIX}{id}"
 
     def checker(self, id):
         # checks to see if the session has already been saved or not.
         # returns true or false, if successful
-        if (id in self.id_list) and (self.r.exists(id)):
-            return True
-        else:
-            return False
+        return self.r.exists(self.key(id)) == 1
 
     def save(self, id, current_form=''):
-        # save the session id.
+        # save the session form and refresh the session expiry.
         # returns true if successful.
-        self.id_list.append(id)
-        return self.r.set(id, current_form)
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self.key(id), "form", current_form)
+        pipe.expire(self.key(id), self.ttl)
+        pipe.execute()
+        return True
+
+    def load_state(self, id):
+        # returns the session engine's fields of the session hash, {} if none.
+        return self.r.hgetall(self.key(id))
+
+    def store_state(self, id, state):
+        # saves the session engine's fields and slides the expiry,
+        # in one round trip.
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self.key(id), mapping=state)
+        pipe.expire(self.key(id), self.ttl)
+        pipe.execute()
+        return True
 
     def set_and_expire_keys(self, id, random_otp):
         id_otp = f"{id}_otp"
-        self.r.set(id_otp, random_otp)
         # otp expires after, 2mins
-        self.r.expire(id_otp, 120)
+        self.r.set(id_otp, random_otp, ex=120)
 
     def update_id_key(self, id, response):
         # responds saves the user's menu navigation.
-        old = self.r.get(id)
-        new = old + response
-        return self.r.set(id, new)
+        return self._append_field(
+            keys=[self.key(id)], args=["form", response, self.ttl])
 
     def read_value(self, id):
-        return self.r.get(id)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hget(self.key(id), "form")
+        pipe.expire(self.key(id), self.ttl)
+        return pipe.execute()[0]
 
     def delete_id(self, id):
         # deletes expired session if from redis.
         # returns true or false, if successful
-        self.r.delete(id)
+        return self.r.delete(self.key(id)) == 1
 
     def execute(self):
         raise NotImplementedError
@@ -53,7 +86,7 @@ class SessionManager:
         # self.r.set(self.id, json.dumps(self.session))
         # self.save(_id, menu_code)
         menu_text = "CON {}".format(menu_text)
-        print(menu_text)
+        screen_log.debug("USSD screen", extra={'menu': menu_text})
         response = make_response(menu_text, 200)
         response.headers['Content-Type'] = "text/plain"
         return response
@@ -66,7 +99,8 @@ class SessionManager:
         return response
 
     def save_session_dict(self, key, dict):
-        return self.r.set(key, dict)
+        return self.r.set(key, json.dumps(dict), ex=self.ttl)
 
     def get_session_dict(self, key):
-        return self.r.get(key)
+        value = self.r.get(key)
+        return json.loads(value) if value is not None else None
@@ -0,0 +1,179 @@
+"""
+Afya SMS Gateways
+Outbound SMS providers behind one bulk send interface
+
+Every gateway takes one message body and a list of recipients and reports
+per-recipient results, so the dispatcher can group identical messages into
+a single call wherever the provider supports it. HTTP gateways share one
+pooled requests session per gateway instance.
+"""
+import os
+import uuid
+import logging
+import requests
+
+log = logging.getLogger('afya.sms')
+
+
+class GatewayError(Exception):
+    """A whole gateway call failed; retryable unless the request was bad"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def sent(gateway_id):
+    return {'ok': True, 'id': gateway_id, 'error': None, 'retryable': False}
+
+
+def rejected(error, retryable=False):
+    return {'ok': False, 'id': None, 'error': error, 'retryable': retryable}
+
+
+def international(phone):
+    """0XXXXXXXXX -> +233XXXXXXXXX, as the gateways expect"""
+    if phone.startswith('+'):
+        return phone
+    if phone.startswith('233'):
+        return '+' + phone
+    if phone.startswith('0'):
+        return '+233' + phone[1:]
+    return phone
+
+
+class ConsoleGateway:
+    """Logs messages instead of sending them; the development default"""
+
+    name = 'console'
+    max_recipients = 1000
+    rate = 1000
+
+    def send(self, message, recipients):
+        for phone in recipients:
+            log.info("SMS (console gateway)", extra={'to': phone, 'body': message})
+        return {phone: sent(f"console-{uuid.uuid4().hex}") for phone in recipients}
+
+
+class HttpGateway:
+    """Shared HTTP plumbing: pooled session, timeouts and status handling"""
+
+    timeout = 10
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.http = requests.Session()
+
+    def post(self, path, **kwargs):
+        try:
+            response = self.http.post(f"{self.base_url}{path}",
+                                      timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise GatewayError(f"{self.name}: {e}")
+
+        # Throttled or broken upstream: try again later. Other 4xx will not improve.
+        if response.status_code == 429 or response.status_code >= 500:
+            raise GatewayError(f"{self.name}: HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise GatewayError(f"{self.name}: HTTP {response.status_code} "
+                               f"{response.text[:200]}", retryable=False)
+        return response
+
+
+class AfricasTalkingGateway(HttpGateway):
+    """Africa's Talking bulk messaging API; many recipients per request"""
+
+    name = 'africastalking'
+    max_recipients = 100
+    rate = 50
+
+    # Per-recipient status codes: accepted, and worth retrying
+    ACCEPTED = {100, 101, 102}
+    RETRYABLE = {405, 407, 500, 501, 502}
+
+    def __init__(self, username, api_key, sender_id=None, base_url=None):
+        if not base_url:
+            base_url = ("https://api.sandbox.africastalking.com"
+                        if username == 'sandbox' else "https://api.africastalking.com")
+        super().__init__(base_url)
+        self.username = username
+        self.sender_id = sender_id
+        self.http.headers.update({'apiKey': api_key, 'Accept': 'application/json'})
+
+    def send(self, message, recipients):
+        numbers = {international(phone): phone for phone in recipients}
+        data = {'username': self.username, 'to': ','.join(numbers), 'message': message}
+        if self.sender_id:
+            data['from'] = self.sender_id
+
+        try:
+            reply = self.post('/version1/messaging', data=data).json()
+            entries = reply['SMSMessageData']['Recipients']
+        except (ValueError, KeyError, TypeError):
+            raise GatewayError(f"{self.name}: unexpected response")
+
+        results = {}
+        for entry in entries:
+            phone = numbers.get(entry.get('number'))
+            if phone is None:
+                continue
+            code = int(entry.get('statusCode', 0))
+            if code in self.ACCEPTED:
+                results[phone] = sent(entry.get('messageId'))
+            else:
+                results[phone] = rejected(entry.get('status') or f"Status {code}",
+                                          code in self.RETRYABLE)
+
+        # Recipients the reply does not mention were not sent
+        for phone in recipients:
+            results.setdefault(phone, rejected("Missing from gateway reply", True))
+        return results
+
+
+class TwilioGateway(HttpGateway):
+    """Twilio Messages API; one recipient per request"""
+
+    name = 'twilio'
+    max_recipients = 1
+    rate = 1
+
+    def __init__(self, account_sid, auth_token, from_number, base_url=None):
+        super().__init__(base_url or "https://api.twilio.com")
+        self.path = f"/2010-04-01/Accounts/{account_sid}/Messages.json"
+        self.from_number = from_number
+        self.http.auth = (account_sid, auth_token)
+
+    def send(self, message, recipients):
+        results = {}
+        for phone in recipients:
+            try:
+                reply = self.post(self.path, data={
+                    'To': international(phone), 'From': self.from_number, 'Body': message
+                }).json()
+                results[phone] = sent(reply['sid'])
+            except GatewayError as e:
+                if len(recipients) == 1:
+                    raise
+                results[phone] = rejected(str(e), e.retryable)
+            except (ValueError, KeyError):
+                results[phone] = rejected(f"{self.name}: unexpected response", True)
+        return results
+
+
+def make_gateway(name=None, base_url=None):
+    """Gateway from SMS_GATEWAY and the provider's credentials in the environment"""
+    name = (name or os.environ.get('SMS_GATEWAY') or 'console').lower()
+
+    if name == 'africastalking':
+        return AfricasTalkingGateway(
+            os.environ.get('AFRICASTALKING_USERNAME', 'sandbox'),
+            os.environ.get('AFRICASTALKING_API_KEY', ''),
+            os.environ.get('SMS_SENDER_ID'), base_url)
+    if name == 'twilio':
+        return TwilioGateway(
+            os.environ.get('TWILIO_ACCOUNT_SID', ''),
+            os.environ.get('TWILIO_AUTH_TOKEN', ''),
+            os.environ.get('TWILIO_FROM_NUMBER', ''), base_url)
+    if name == 'console':
+        return ConsoleGateway()
+    raise ValueError(f"Unknown SMS gateway: {name}")
@@ -0,0 +1,411 @@
+"""
+Afya SMS Queue
+Durable outbound SMS queue in Redis, drained by a pool of dispatcher threads
+
+Request threads only enqueue: one pipelined round trip that stores the
+message hash and pushes its id. Dispatchers (flask --app app sms-worker)
+move ids into their own processing list with LMOVE, so a message is never
+lost between being taken and being sent; lists left behind by a dead
+dispatcher are pushed back onto the queue. Identical messages in a batch go
+out in one bulk gateway call, within a per-gateway rate limit shared by all
+dispatchers, and failed sends are retried with exponential backoff.
+
+Keys:
+    sms:queue                   ids ready to send
+    sms:retry                   ids waiting for a retry, scored by due time
+    sms:processing:<consumer>   ids taken by one dispatcher thread
+    sms:consumer:<consumer>     that thread's heartbeat
+    sms:consumers               every consumer that may hold a processing list
+    sms:msg:<id>                the message and its delivery status
+    sms:gateway-id:<id>         gateway message id -> our id, for delivery reports
+    sms:rate:<gateway>          token bucket
+    sms:stats                   running totals
+"""
+import os
+import time
+import logging
+import uuid
+import random
+import socket
+import threading
+from collections import defaultdict
+from datetime import datetime
+import redis
+from redis_client import get_redis
+from sms_gateways import GatewayError, make_gateway
+
+log = logging.getLogger('afya.sms')
+
+# Move retries that are due back onto the queue, atomically
+PROMOTE_RETRIES_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ids))
+    redis.call('LPUSH', KEYS[2], unpack(ids))
+end
+return #ids
+"""
+
+# Token bucket: take ARGV[4] tokens, or return the seconds to wait for them
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now, wanted = tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= wanted then
+    tokens = tokens - wanted
+else
+    wait = (wanted - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+
+class SmsQueue:
+    """Enqueue side, delivery status and stats of the outbound queue"""
+
+    QUEUE_KEY = "sms:queue"
+    RETRY_KEY = "sms:retry"
+    STATS_KEY = "sms:stats"
+    PROCESSING_PREFIX = "sms:processing:"
+    CONSUMER_PREFIX = "sms:consumer:"
+    CONSUMERS_KEY = "sms:consumers"
+    MESSAGE_PREFIX = "sms:msg:"
+    GATEWAY_ID_PREFIX = "sms:gateway-id:"
+    RATE_PREFIX = "sms:rate:"
+
+    # Messages and their status are kept for a week
+    MESSAGE_TTL = 7 * 24 * 3600
+
+    # Gateway delivery report statuses (Africa's Talking, Twilio)
+    DELIVERED = {'success', 'delivered'}
+    UNDELIVERED = {'failed', 'rejected', 'undelivered'}
+
+    def __init__(self, app=None):
+        self.r = get_redis()
+        self.config = {}
+        self._promote_retries = self.r.register_script(PROMOTE_RETRIES_SCRIPT)
+        self._take_tokens = self.r.register_script(TOKEN_BUCKET_SCRIPT)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the SMS_* settings used by the dispatchers"""
+        self.config = {key: value for key, value in app.config.items()
+                       if key.startswith('SMS_')}
+        app.extensions['sms_queue'] = self
+
+    def key(self, message_id):
+        return f"{self.MESSAGE_PREFIX}{message_id}"
+
+    # Request side
+
+    def enqueue(self, phone, body, kind=None):
+        """Queue one message; returns its id, or None if Redis is unavailable"""
+        message_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        try:
+            pipe = self.r.pipeline(transaction=True)
+            pipe.hset(self.key(message_id), mapping={
+                'id': message_id,
+                'to': phone,
+                'body': body,
+                'kind': kind or '',
+                'status': 'queued',
+                'attempts': 0,
+                'created_at': now,
+                'updated_at': now
+            })
+            pipe.expire(self.key(message_id), self.MESSAGE_TTL)
+            pipe.lpush(self.QUEUE_KEY, message_id)
+            pipe.hincrby(self.STATS_KEY, 'enqueued', 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            log.error("SMS enqueue failed: %s", e, extra={'to': phone})
+            return None
+        return message_id
+
+    def status(self, message_id):
+        """The stored message and its delivery status, or None"""
+        return self.r.hgetall(self.key(message_id)) or None
+
+    def record_delivery(self, gateway_id, gateway_status, error=None):
+        """Apply a gateway delivery report; returns our message id if known"""
+        message_id = self.r.get(f"{self.GATEWAY_ID_PREFIX}{gateway_id}")
+        if not message_id:
+            return None
+
+        fields = {'gateway_status': gateway_status,
+                  'updated_at': datetime.now().isoformat()}
+        outcome = None
+        if gateway_status.lower() in self.DELIVERED:
+            outcome = 'delivered'
+        elif gateway_status.lower() in self.UNDELIVERED:
+            outcome = 'undelivered'
+            fields['error'] = error or gateway_status
+        if outcome:
+            fields['status'] = outcome
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self.key(message_id), mapping=fields)
+        if outcome:
+            pipe.hincrby(self.STATS_KEY, outcome, 1)
+        pipe.execute()
+        return message_id
+
+    def promote_retries(self, limit=100):
+        """Requeue up to limit messages whose retry is due"""
+        return self._promote_retries(keys=[self.RETRY_KEY, self.QUEUE_KEY],
+                                     args=[time.time(), limit])
+
+    def take_tokens(self, gateway, rate, burst, count):
+        """Take count tokens from a gateway's bucket; seconds to wait if short"""
+        return float(self._take_tokens(keys=[f"{self.RATE_PREFIX}{gateway}"],
+                                       args=[rate, burst, time.time(), count]))
+
+    def stats(self):
+        """Queue depth and running totals for /health"""
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.llen(self.QUEUE_KEY)
+            pipe.zcard(self.RETRY_KEY)
+            pipe.hgetall(self.STATS_KEY)
+            queued, retrying, totals = pipe.execute()
+        except redis.RedisError as e:
+            return {'error': str(e)}
+        return dict({name: int(value) for name, value in totals.items()},
+                    queued=queued, retrying=retrying)
+
+
+class SmsDispatcher:
+    """A pool of threads sending queued messages through one gateway"""
+
+    HEARTBEAT_TTL = 30
+    RECOVER_INTERVAL = 30
+    BLOCK_TIMEOUT = 0.5
+
+    def __init__(self, sms_queue, gateway=None, threads=None, batch_size=None):
+        config = sms_queue.config
+        self.queue = sms_queue
+        self.r = sms_queue.r
+        self.gateway = gateway or make_gateway(config.get('SMS_GATEWAY'),
+                                               config.get('SMS_GATEWAY_URL'))
+        self.threads = threads or config.get('SMS_WORKER_THREADS', 4)
+        self.batch_size = batch_size or config.get('SMS_BATCH_SIZE', 200)
+        self.max_attempts = config.get('SMS_MAX_ATTEMPTS', 5)
+        self.retry_base = config.get('SMS_RETRY_BASE', 5.0)
+        self.retry_max = config.get('SMS_RETRY_MAX', 600.0)
+
+        # Per-gateway limit unless SMS_RATE_LIMIT overrides it
+        self.rate = float(config.get('SMS_RATE_LIMIT') or self.gateway.rate)
+        self.bulk_size = max(1, min(self.gateway.max_recipients,
+                                    config.get('SMS_BULK_SIZE') or self.gateway.max_recipients,
+                                    int(max(self.rate, 1))))
+
+        self.prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopping = threading.Event()
+        self._workers = []
+        self._last_recover = 0
+
+    def run(self):
+        """Start the threads and block until stop() or Ctrl-C"""
+        self.start()
+        try:
+            while any(worker.is_alive() for worker in self._workers):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def start(self):
+        self._stopping.clear()
+        self.recover()
+        for number in range(self.threads):
+            worker = threading.Thread(
+                target=self._work, args=(f"{self.prefix}:{number}",),
+                name=f"afya-sms-{number}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=30):
+        """Finish the batches in hand, then stop"""
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def recover(self):
+        """Requeue ids held by dispatcher threads whose heartbeat has expired"""
+        recovered = 0
+        consumers = sorted(self.r.smembers(SmsQueue.CONSUMERS_KEY))
+        beats = self.r.mget([f"{SmsQueue.CONSUMER_PREFIX}{consumer}"
+                             for consumer in consumers]) if consumers else []
+        for consumer, beat in zip(consumers, beats):
+            if beat is not None:
+                continue
+            # A consumer that is only slow adds itself back on its next beat
+            self.r.srem(SmsQueue.CONSUMERS_KEY, consumer)
+            key = f"{SmsQueue.PROCESSING_PREFIX}{consumer}"
+            # Oldest ends up rightmost, so recovered messages go out next
+            while self.r.lmove(key, SmsQueue.QUEUE_KEY, 'LEFT', 'RIGHT'):
+                recovered += 1
+        if recovered:
+            log.warning("Requeued %d SMS left by stopped dispatchers", recovered)
+        return recovered
+
+    def drain(self, consumer='drain'):
+        """Send everything currently due in this thread; returns messages handled"""
+        consumer = f"{self.prefix}:{consumer}"
+        handled = 0
+        while True:
+            self._beat(consumer)
+            self.queue.promote_retries(self.batch_size)
+            batch = self._claim(consumer, block=False)
+            if not batch:
+                self.r.delete(f"{SmsQueue.CONSUMER_PREFIX}{consumer}")
+                return handled
+            self._send_batch(consumer, batch)
+            handled += len(batch)
+
+    # Dispatcher threads
+
+    def _work(self, consumer):
+        last_beat = 0
+        while not self._stopping.is_set():
+            try:
+                now = time.time()
+                if now - last_beat > self.HEARTBEAT_TTL / 3:
+                    self._beat(consumer)
+                    last_beat = now
+                if consumer.endswith(':0') and now - self._last_recover > self.RECOVER_INTERVAL:
+                    self._last_recover = now
+                    self.recover()
+
+                self.queue.promote_retries(self.batch_size)
+                batch = self._claim(consumer)
+                if batch:
+                    self._send_batch(consumer, batch)
+            except redis.RedisError as e:
+                log.error("SMS dispatcher Redis error: %s", e)
+                self._stopping.wait(1)
+            except Exception as e:
+                log.exception("SMS dispatcher error")
+                self._stopping.wait(1)
+
+        self.r.delete(f"{SmsQueue.CONSUMER_PREFIX}{consumer}")
+
+    def _beat(self, consumer):
+        # Keeps recover() away from this consumer's processing list, and
+        # registers the list so recover() finds it without a keyspace scan
+        pipe = self.r.pipeline(transaction=False)
+        pipe.set(f"{SmsQueue.CONSUMER_PREFIX}{consumer}", time.time(),
+                 ex=self.HEARTBEAT_TTL)
+        pipe.sadd(SmsQueue.CONSUMERS_KEY, consumer)
+        pipe.execute()
+
+    def _claim(self, consumer, block=True):
+        """Move up to batch_size ids from the queue to this consumer's list"""
+        processing = f"{SmsQueue.PROCESSING_PREFIX}{consumer}"
+        if block:
+            first = self.r.blmove(SmsQueue.QUEUE_KEY, processing,
+                                  self.BLOCK_TIMEOUT, 'RIGHT', 'LEFT')
+        else:
+            first = self.r.lmove(SmsQueue.QUEUE_KEY, processing, 'RIGHT', 'LEFT')
+        if not first:
+            return []
+
+        pipe = self.r.pipeline(transaction=False)
+        for _ in range(self.batch_size - 1):
+            pipe.lmove(SmsQueue.QUEUE_KEY, processing, 'RIGHT', 'LEFT')
+        return [first] + [message_id for message_id in pipe.execute() if message_id]
+
+    def _send_batch(self, consumer, batch):
+        processing = f"{SmsQueue.PROCESSING_PREFIX}{consumer}"
+
+        pipe = self.r.pipeline(transaction=False)
+        for message_id in batch:
+            pipe.hgetall(self.queue.key(message_id))
+        messages = pipe.execute()
+
+        # Identical bodies share a gateway call; expired messages are just dropped
+        groups = defaultdict(list)
+        for message_id, message in zip(batch, messages):
+            if message:
+                groups[message['body']].append(message)
+            else:
+                self.r.lrem(processing, 1, message_id)
+
+        for body, group in groups.items():
+            for recipients in self._chunks(group):
+                self._send(processing, body, recipients)
+
+    def _chunks(self, group):
+        # Up to bulk_size recipients per call, each phone at most once per call
+        chunks = []
+        for message in group:
+            for chunk in chunks:
+                if len(chunk) < self.bulk_size and message['to'] not in chunk:
+                    chunk[message['to']] = message
+                    break
+            else:
+                chunks.append({message['to']: message})
+        return chunks
+
+    def _send(self, processing, body, recipients):
+        self._wait_for_tokens(len(recipients))
+        try:
+            results = self.gateway.send(body, list(recipients))
+        except GatewayError as e:
+            results = {phone: {'ok': False, 'id': None, 'error': str(e),
+                               'retryable': e.retryable} for phone in recipients}
+        except Exception as e:
+            results = {phone: {'ok': False, 'id': None, 'error': str(e),
+                               'retryable': True} for phone in recipients}
+
+        now = time.time()
+        stamp = datetime.now().isoformat()
+        pipe = self.r.pipeline(transaction=True)
+        for phone, message in recipients.items():
+            result = results[phone]
+            key = self.queue.key(message['id'])
+            attempts = int(message['attempts']) + 1
+            fields = {'attempts': attempts, 'updated_at': stamp,
+                      'gateway': self.gateway.name}
+
+            if result['ok']:
+                fields.update(status='sent', sent_at=stamp, error='')
+                if result['id']:
+                    fields['gateway_id'] = result['id']
+                    pipe.set(f"{SmsQueue.GATEWAY_ID_PREFIX}{result['id']}",
+                             message['id'], ex=SmsQueue.MESSAGE_TTL)
+                pipe.hincrby(SmsQueue.STATS_KEY, 'sent', 1)
+            elif result['retryable'] and attempts < self.max_attempts:
+                fields.update(status='retrying', error=result['error'] or '')
+                pipe.zadd(SmsQueue.RETRY_KEY,
+                          {message['id']: now + self._backoff(attempts)})
+                pipe.hincrby(SmsQueue.STATS_KEY, 'retried', 1)
+            else:
+                fields.update(status='failed', error=result['error'] or '')
+                pipe.hincrby(SmsQueue.STATS_KEY, 'failed', 1)
+
+            pipe.hset(key, mapping=fields)
+            pipe.lrem(processing, 1, message['id'])
+        pipe.execute()
+
+    def _backoff(self, attempts):
+        # Exponential, capped, with jitter so retries from one outage spread out
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _wait_for_tokens(self, count):
+        burst = max(self.rate, count)
+        while True:
+            wait = self.queue.take_tokens(self.gateway.name, self.rate, burst, count)
+            if wait <= 0:
+                return
+            time.sleep(wait)
@@ -0,0 +1,93 @@
+"""
+Afya SQLite Mode
+WAL journaling and tuned pragmas on every SQLite connection
+
+Smaller clinic sites run on the SQLite fallback database under several
+gunicorn workers. With the default rollback journal a writer locks out
+every reader, and pysqlite's implicit transactions start a write only at
+the first INSERT/UPDATE, so a request that read first can find the
+database changed under it and fail "database is locked". On every new
+connection this sets:
+
+    journal_mode = WAL        readers and the writer no longer block each other
+    synchronous  = NORMAL     fsync at checkpoints, not every commit (safe in WAL)
+    cache_size   = -65536     64 MB page cache per connection
+    mmap_size    = 268435456  read through 256 MB of memory-mapped I/O
+    busy_timeout = 5000       wait up to 5 s for the write lock, then fail
+    temp_store   = MEMORY
+
+and takes over BEGIN from pysqlite: a plain BEGIN (deferred) normally, or
+BEGIN IMMEDIATE for connections with the sqlite_begin='IMMEDIATE'
+execution option, as the write queue uses (write_queue.py).
+SAVEPOINTs work again as a side effect.
+"""
+import re
+from sqlalchemy import event
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+BEGIN_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+def is_sqlite(url):
+    return str(url).startswith('sqlite')
+
+
+class SqliteMode:
+    """Applies the SQLITE_* pragmas to every SQLite engine of the app"""
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.pragmas = {}
+        self.primary = None
+        self.engines = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install the connection hooks if SQLITE_MODE; call after db.init_app(app)"""
+        app.extensions['sqlite_mode'] = self
+        if not app.config.get('SQLITE_MODE'):
+            return
+        self.pragmas = dict(PRAGMAS, **app.config.get('SQLITE_PRAGMAS', {}))
+        for name, value in self.pragmas.items():
+            if not re.fullmatch(r'-?\w+', str(value)):
+                raise ValueError(f"Bad SQLite pragma value for {name}: {value!r}")
+        with app.app_context():
+            engines = self.db.engines
+            self.primary = engines[None] if is_sqlite(engines[None].url) else None
+            self.engines = [engine for engine in engines.values() if is_sqlite(engine.url)]
+        for engine in self.engines:
+            if not event.contains(engine, 'connect', self._connect):
+                event.listen(engine, 'connect', self._connect)
+                event.listen(engine, 'begin', self._begin)
+
+    def _connect(self, dbapi_connection, connection_record):
+        # Autocommit at the driver; _begin() starts every transaction
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    def _begin(self, conn):
+        mode = str(conn.get_execution_options().get('sqlite_begin', 'DEFERRED')).upper()
+        if mode not in BEGIN_MODES:
+            mode = 'DEFERRED'
+        conn.exec_driver_sql(f"BEGIN {mode}")
+
+    def status(self):
+        """Current settings as the primary database reports them, for /health"""
+        if self.primary is None:
+            return None
+        with self.primary.connect() as conn:
+            return {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                    for name in self.pragmas}
@@ -0,0 +1,113 @@
+"""
+Afya List Statistics
+Summary numbers for the list pages, from aggregate queries over the small
+tables and from the maintained system counters for patients and logs
+"""
+from sqlalchemy import func, case, distinct
+
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+class ListStats:
+    """Aggregate queries behind the list page summary cards
+
+    Every method returns plain numbers; no page loads rows or child
+    collections just to count them. The patient and log tables grow without
+    bound, so their numbers are counter lookups (counters.py), not scans.
+    """
+
+    def __init__(self, db, counters):
+        self.db = db
+        self.counters = counters
+
+    def patients(self):
+        """Active patient totals by gender and recorded blood type"""
+        counts = self.counters.for_patients()
+        return {
+            'total': counts['active'],
+            'male': counts['male'],
+            'female': counts['female'],
+            'with_blood_type': counts['blood_type']
+        }
+
+    def providers(self):
+        """Provider totals and the spread of active providers"""
+        from app import HealthcareProvider
+
+        row = self.db.session.query(
+            func.count(HealthcareProvider.id),
+            _count_if(HealthcareProvider.is_active == True),
+            func.count(distinct(case(
+                (HealthcareProvider.is_active == True,
+                 HealthcareProvider.specialization)))),
+            func.count(distinct(case(
+                (HealthcareProvider.is_active == True,
+                 HealthcareProvider.facility_id))))
+        ).one()
+
+        return {
+            'total': row[0],
+            'active': row[1],
+            'specializations': row[2],
+            'facilities': row[3]
+        }
+
+    def facilities(self):
+        """Facility totals and the spread of active facilities"""
+        from app import HealthcareFacility
+
+        row = self.db.session.query(
+            func.count(HealthcareFacility.id),
+            _count_if(HealthcareFacility.is_active == True),
+            func.count(distinct(case(
+                (HealthcareFacility.is_active == True,
+                 HealthcareFacility.location)))),
+            func.count(distinct(case(
+                (HealthcareFacility.is_active == True,
+                 HealthcareFacility.facility_type))))
+        ).one()
+
+        return {
+            'total': row[0],
+            'active': row[1],
+            'locations': row[2],
+            'types': row[3]
+        }
+
+    def facility_counts(self, facility_ids):
+        """Provider and record counts for the given facilities, by id"""
+        from app import HealthcareProvider, MedicalRecord
+
+        counts = {facility_id: {'providers': 0, 'records': 0}
+                  for facility_id in facility_ids}
+        if not counts:
+            return counts
+
+        providers = self.db.session.query(
+            HealthcareProvider.facility_id, func.count(HealthcareProvider.id)
+        ).filter(HealthcareProvider.facility_id.in_(counts)
+                 ).group_by(HealthcareProvider.facility_id)
+
+        # Counted from the (facility_id, visit_on) index
+        records = self.db.session.query(
+            MedicalRecord.facility_id, func.count(MedicalRecord.id)
+        ).filter(MedicalRecord.facility_id.in_(counts)
+                 ).group_by(MedicalRecord.facility_id)
+
+        for facility_id, total in providers:
+            counts[facility_id]['providers'] = total
+        for facility_id, total in records:
+            counts[facility_id]['records'] = total
+        return counts
+
+    def logs(self):
+        """Log totals split into USSD, user and system activity"""
+        counts = self.counters.for_logs()
+        return {
+            'total': counts['logs'],
+            'ussd': counts['logs:ussd'],
+            'user_actions': counts['logs:user'],
+            'system_events': counts['logs'] - counts['logs:user']
+        }
@@ -0,0 +1,337 @@
+"""
+Afya Structured Logging
+JSON log records written off the request thread, with patient data redacted
+
+Request threads only put records on a bounded queue (dropping, never
+blocking, when it is full); a listener thread redacts, formats and writes
+them. Phone numbers become keyed hashes, so one caller's requests can still
+be followed without the number appearing in the logs. USSD text paths keep
+only their menu choices: PINs are masked and free text dropped.
+
+Loggers live under "afya." (afya.ussd, afya.sms, afya.http ...). Levels
+and sample rates can be changed at runtime: they are kept in a Redis hash
+that every worker polls, set with `flask log-level` or /admin/logging.
+Sampling drops DEBUG and INFO records only.
+"""
+import os
+import re
+import sys
+import json
+import copy
+import atexit
+import hmac
+import queue
+import random
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT_LOGGER = 'afya'
+
+# Ghana numbers in local, 233 and +233 form
+PHONE_PATTERN = re.compile(r'(?<!\d)(?:\+?233|0)\d{9}(?!\d)')
+
+# Record attributes holding phone numbers, USSD text and message bodies
+PHONE_FIELDS = ('phone', 'user_phone', 'to')
+TEXT_FIELDS = ('text',)
+BODY_FIELDS = ('body', 'menu')
+
+# Attributes every LogRecord has; anything else came in through extra=
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+def hash_phone(phone, key):
+    """Stable keyed hash of a phone number, e.g. ph:1f3a9c0b52de"""
+    digits = re.sub(r'\D', '', str(phone))
+    if digits.startswith('233'):
+        digits = '0' + digits[3:]
+    return 'ph:' + hmac.new(key, digits.encode(), hashlib.sha256).hexdigest()[:12]
+
+
+def redact_ussd_text(text, key):
+    """Keep menu choices; mask PINs, hash phones, drop free text"""
+    segments = []
+    for segment in str(text).split('*'):
+        if segment.isdigit() and len(segment) <= 2:
+            segments.append(segment)
+        elif PHONE_PATTERN.fullmatch(segment):
+            segments.append(hash_phone(segment, key))
+        elif segment.isdigit() and len(segment) == 4:
+            segments.append('<pin>')
+        elif segment:
+            segments.append('<redacted>')
+        else:
+            segments.append('')
+    return '*'.join(segments)
+
+
+class Redactor(logging.Filter):
+    """Hashes phone numbers and strips PINs and bodies from a record"""
+
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+
+    def filter(self, record):
+        for field in PHONE_FIELDS:
+            value = getattr(record, field, None)
+            if value:
+                setattr(record, field, hash_phone(value, self.key))
+        for field in TEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value:
+                setattr(record, field, redact_ussd_text(value, self.key))
+        for field in BODY_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                setattr(record, field, f"<{len(str(value))} chars>")
+
+        record.msg = PHONE_PATTERN.sub(
+            lambda match: hash_phone(match.group(), self.key), str(record.msg))
+        if record.exc_text:
+            record.exc_text = PHONE_PATTERN.sub(
+                lambda match: hash_phone(match.group(), self.key), record.exc_text)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, then any extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.msg,
+            'pid': record.process
+        }
+        for name, value in vars(record).items():
+            if name not in _STANDARD and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class Sampler(logging.Filter):
+    """Keeps a share of DEBUG/INFO records per logger (longest prefix wins)"""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.set_rates(rates or {})
+
+    def set_rates(self, rates):
+        self.rates = dict(rates)
+        self._cache = {}
+
+    def rate_for(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate, best = 1.0, -1
+            for prefix, value in self.rates.items():
+                if (name == prefix or name.startswith(prefix + '.')) and len(prefix) > best:
+                    rate, best = value, len(prefix)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Enqueues without waiting; drops and counts when the queue is full
+
+    The listener thread does not survive fork, so it is (re)started by the
+    first record logged in each process.
+    """
+
+    def __init__(self, size, output, on_start=None):
+        super().__init__(queue.Queue(maxsize=size))
+        self.size = size
+        self.output = output
+        self.on_start = on_start
+        self.listener = None
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Only merge the message here; redaction and JSON happen in the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A queue inherited through fork may hold a lock taken by a dead thread
+            self.queue = queue.Queue(maxsize=self.size)
+            self.listener = QueueListener(self.queue, self.output,
+                                          respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+        if self.on_start:
+            self.on_start()
+
+    def stop(self):
+        """Write what is queued, then stop the listener"""
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self._pid = None
+
+
+class StructuredLogging:
+    """Configures the afya.* loggers and their runtime controls"""
+
+    CONTROL_KEY = "logging:control"
+
+    def __init__(self, app=None):
+        self.handler = None
+        self.redactor = None
+        self.sampler = Sampler()
+        self.defaults = {}
+        self.applied = {}
+        self._control = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Route afya.* records through the queue, as JSON on stdout"""
+        config = app.config
+        key = (config.get('LOG_HASH_KEY') or config['SECRET_KEY']).encode()
+        self.poll_interval = config.get('LOG_CONTROL_INTERVAL', 10)
+
+        self.redactor = Redactor(key)
+        output = logging.StreamHandler(sys.stdout)
+        output.addFilter(self.redactor)
+        output.setFormatter(JsonFormatter())
+
+        logger = logging.getLogger(ROOT_LOGGER)
+        if self.handler is not None:
+            self.handler.stop()
+            logger.removeHandler(self.handler)
+
+        self.handler = NonBlockingQueueHandler(
+            config.get('LOG_QUEUE_SIZE', 10000), output, self._start_control)
+        self.handler.addFilter(self.sampler)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+
+        # Write whatever is still queued when the process exits
+        atexit.register(self.handler.stop)
+
+        self.defaults = {'level': {ROOT_LOGGER: config.get('LOG_LEVEL', 'INFO')},
+                         'sample': parse_rates(config.get('LOG_SAMPLING', ''))}
+        self.apply({})
+        app.extensions['structured_logging'] = self
+
+    def redact_text(self, text):
+        """A USSD text path as the logs show it, for storing anywhere else"""
+        return redact_ussd_text(text, self.redactor.key)
+
+    # Runtime control
+
+    def set_level(self, logger, level):
+        """Set a logger's level in every worker"""
+        if not isinstance(level, str):
+            raise TypeError("Log level must be a name such as DEBUG")
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Unknown log level: {level}")
+        self._store(f"level:{logger}", level)
+
+    def set_sample_rate(self, logger, rate):
+        """Keep this share (0-1) of a logger's DEBUG/INFO records in every worker"""
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError("Sample rate must be between 0 and 1")
+        self._store(f"sample:{logger}", rate)
+
+    def reset(self):
+        """Back to the configured levels and sample rates"""
+        from redis_client import get_redis
+        get_redis().delete(self.CONTROL_KEY)
+        self.apply({})
+
+    def apply(self, overrides):
+        """Apply configured defaults plus level:/sample: overrides"""
+        levels = dict(self.defaults.get('level', {}))
+        rates = dict(self.defaults.get('sample', {}))
+        for field, value in overrides.items():
+            kind, _, name = field.partition(':')
+            if kind == 'level':
+                levels[name] = value
+            elif kind == 'sample':
+                rates[name] = float(value)
+
+        # Loggers that lost their override go back to inheriting
+        for name in set(self.applied.get('level', {})) - set(levels):
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+        self.sampler.set_rates(rates)
+        self.applied = {'level': levels, 'sample': rates}
+
+    def state(self):
+        """Current levels, sample rates and queue figures"""
+        handler = self.handler
+        return dict(self.applied,
+                    queued=handler.queue.qsize() if handler else 0,
+                    dropped=handler.dropped if handler else 0)
+
+    def _store(self, field, value):
+        from redis_client import get_redis
+        r = get_redis()
+        r.hset(self.CONTROL_KEY, field, value)
+        self.apply(r.hgetall(self.CONTROL_KEY))
+
+    def _start_control(self):
+        # One poller per process, started with the listener
+        if not self.poll_interval or not os.environ.get('REDIS_URL'):
+            return
+        self._control = threading.Thread(
+            target=self._poll, name='afya-log-control', daemon=True)
+        self._control.start()
+
+    def _poll(self):
+        from redis_client import get_redis
+        seen = None
+        while True:
+            try:
+                overrides = get_redis().hgetall(self.CONTROL_KEY)
+                if overrides != seen:
+                    self.apply(overrides)
+                    seen = overrides
+            except Exception:
+                pass
+            time.sleep(self.poll_interval)
+
+
+def parse_rates(text):
+    """'afya.ussd=0.1,afya.ussd.screen=0.01' -> {'afya.ussd': 0.1, ...}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
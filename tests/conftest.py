@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis_client
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """The shared Redis client, backed by an in-process fakeredis server"""
+    fakeredis = pytest.importorskip('fakeredis')
+    pool = redis_client.InstrumentedConnectionPool(
+        connection_class=getattr(fakeredis, 'FakeRedisConnection', fakeredis.FakeConnection), server=fakeredis.FakeServer(),
+        decode_responses=True)
+    client = redis_client.AfyaRedis(connection_pool=pool)
+    monkeypatch.setattr(redis_client, '_client', client)
+    return client
@@ -0,0 +1,39 @@
+from flask import Flask
+
+from emergency_cards import EmergencyCards
+from models import db
+
+PHONE = '0200123456'
+
+
+def cards_with(build):
+    cards = EmergencyCards(db)
+    cards.init_app(Flask(__name__))
+    cards.build = build
+    return cards
+
+
+def test_rebuild_racing_a_commit_is_stored_stale(fake_redis):
+    def racing_build(phone):
+        # The build has read the old row when a commit marks the card stale
+        cards.mark_stale([phone])
+        return 'Blood Type: A+'
+
+    cards = cards_with(racing_build)
+    assert cards.refresh(PHONE).result(5)['built'] == 0
+    assert cards._read(PHONE)['built'] == 0
+    assert cards.local[PHONE]['built'] == 0
+
+    # The next read serves it as stale and rebuilds from the updated row
+    cards.build = lambda phone: 'Blood Type: O-'
+    assert cards.get(PHONE) == 'Blood Type: A+'
+    cards.refresh(PHONE).result(5)
+    card = cards._read(PHONE)
+    assert card['screen'] == 'Blood Type: O-' and card['built'] > 0
+
+
+def test_rebuild_without_a_commit_is_fresh(fake_redis):
+    cards = cards_with(lambda phone: 'Blood Type: A+')
+    cards.mark_stale([PHONE])
+    assert cards.refresh(PHONE).result(5)['built'] > 0
+    assert cards._read(PHONE)['built'] > 0
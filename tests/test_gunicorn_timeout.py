@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import runpy
+import socket
+import subprocess
+import urllib.request
+
+import pytest
+
+pytest.importorskip('gunicorn')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Streams for longer than the worker timeout used below
+SLOW_APP = '''
+import time
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    def body():
+        for _ in range(5):
+            time.sleep(1)
+            yield b'chunk\\n'
+    return body()
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_stream_outlives_worker_timeout(tmp_path, monkeypatch):
+    # The worker settings from gunicorn.conf.py, without its app hooks
+    for name in ('GUNICORN_WORKER_CLASS', 'GUNICORN_THREADS'):
+        monkeypatch.delenv(name, raising=False)
+    conf = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+    (tmp_path / 'slow.py').write_text(SLOW_APP)
+    port = free_port()
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'slow:app',
+         '--bind', f"127.0.0.1:{port}", '--workers', '1', '--timeout', '2',
+         '--worker-class', conf['worker_class'], '--threads', str(conf['threads'])],
+        cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        started = time.monotonic()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=20) as response:
+            body = response.read()
+        assert time.monotonic() - started > 4
+        assert body == b'chunk\n' * 5
+    finally:
+        server.terminate()
+        server.wait(10)
@@ -0,0 +1,74 @@
+import os
+import time
+
+import pytest
+
+import redis_client
+from metrics import Metrics
+
+
+def worker(name, pool_in_use=0):
+    """A Metrics as one gunicorn worker would hold it, without a Flask app"""
+    metrics = Metrics()
+    metrics.enabled = True
+    metrics.flush_interval = 10
+    metrics.worker_id = name
+    metrics._pid = os.getpid()
+    metrics.collect(lambda: [
+        ('afya_db_pool_connections', (('pool', 'primary'), ('state', 'in_use')), pool_in_use),
+        ('afya_db_pool_checkouts_total', (('pool', 'primary'),), 5)])
+    return metrics
+
+
+def series(text, name):
+    return {line.split(' ')[0]: float(line.split(' ')[1])
+            for line in text.splitlines() if line.startswith(name)}
+
+
+@pytest.fixture
+def shared(fake_redis, monkeypatch):
+    monkeypatch.setenv('REDIS_URL', 'redis://fake')
+    return fake_redis
+
+
+def test_totals_survive_worker_exit(shared):
+    first, second, scraper = worker('a', 2), worker('b', 3), worker('scrape')
+    first.inc('afya_errors_total', (('source', 'http'),), 4)
+    second.inc('afya_errors_total', (('source', 'http'),), 6)
+    second.observe('afya_emergency_card_build_seconds', (), 0.01)
+    first._publish()
+    second._publish()
+
+    before = scraper.render()
+    assert series(before, 'afya_errors_total') == {'afya_errors_total{source="http"}': 10}
+    assert series(before, 'afya_db_pool_checkouts_total')[
+        'afya_db_pool_checkouts_total{pool="primary"}'] == 15
+
+    # Graceful exit folds the totals in; a killed worker is retired once stale
+    second.shutdown()
+    shared.zadd(Metrics.WORKERS_KEY, {'a': time.time() - 60})
+    scraper._retire()
+
+    after = scraper.render()
+    assert series(after, 'afya_errors_total') == series(before, 'afya_errors_total')
+    assert series(after, 'afya_emergency_card_build_seconds_count') == {
+        'afya_emergency_card_build_seconds_count': 1}
+    assert series(after, 'afya_db_pool_checkouts_total')[
+        'afya_db_pool_checkouts_total{pool="primary"}'] == 15
+    assert shared.zrange(Metrics.WORKERS_KEY, 0, -1) == []
+
+    # Gauges are per worker and leave with it
+    gauges = series(after, 'afya_db_pool_connections')
+    assert list(gauges.values()) == [0]
+    assert all('worker=' in name for name in gauges)
+
+
+def test_scrape_reads_registered_workers_only(shared):
+    for n in range(2000):
+        shared.set(f"patient:summary:{n}", 'x')
+    first, scraper = worker('a'), worker('scrape')
+    first._publish()
+
+    before = redis_client.round_trips()
+    scraper.render()
+    assert redis_client.round_trips() - before <= 6
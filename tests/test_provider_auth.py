@@ -0,0 +1,44 @@
+from provider_auth import ProviderAuthenticator
+
+PHONE = '0501234568'
+
+
+def identity(is_active, pin):
+    return {'id': '1', 'name': 'Dr. Kwame Asante', 'pin': pin,
+            'is_active': is_active, 'facility_id': '1', 'facility_name': 'Afya Demo Clinic'}
+
+
+def test_invalidate_during_load_is_not_overwritten(fake_redis):
+    auth = ProviderAuthenticator(ttl=300)
+    database = {'row': identity('1', 'old-hash')}
+
+    def racing_load(phone):
+        # The lookup has read the row when a toggle commits and invalidates
+        loaded = dict(database['row'])
+        database['row'] = identity('0', 'new-hash')
+        auth.invalidate(phone)
+        return loaded
+
+    auth._load = racing_load
+    assert auth.lookup(PHONE)['is_active'] == '1'
+    assert not fake_redis.exists(auth.key(PHONE))
+
+    auth._load = lambda phone: dict(database['row'])
+    assert auth.lookup(PHONE)['is_active'] == '0'
+    assert fake_redis.hgetall(auth.key(PHONE))['pin'] == 'new-hash'
+
+
+def test_lookup_caches_until_invalidated(fake_redis):
+    auth = ProviderAuthenticator(ttl=300)
+    loads = []
+    auth._load = lambda phone: loads.append(phone) or identity('1', 'hash')
+
+    auth.lookup(PHONE)
+    auth.lookup(PHONE)
+    assert loads == [PHONE]
+    assert 0 < fake_redis.ttl(auth.key(PHONE)) <= 300
+
+    auth.invalidate(PHONE)
+    assert not fake_redis.exists(auth.key(PHONE))
+    auth.lookup(PHONE)
+    assert loads == [PHONE, PHONE]
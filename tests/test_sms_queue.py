@@ -0,0 +1,28 @@
+from sms_gateways import ConsoleGateway
+from sms_queue import SmsDispatcher, SmsQueue
+
+
+def test_recover_requeues_only_expired_consumers(fake_redis):
+    queue = SmsQueue()
+    dispatcher = SmsDispatcher(queue, gateway=ConsoleGateway(), batch_size=2)
+    ids = [queue.enqueue('0241234567', f"Message {n}") for n in range(4)]
+
+    for consumer in ('alive', 'dead'):
+        dispatcher._beat(consumer)
+        assert len(dispatcher._claim(consumer, block=False)) == 2
+    fake_redis.delete(f"{SmsQueue.CONSUMER_PREFIX}dead")
+
+    assert dispatcher.recover() == 2
+    assert fake_redis.smembers(SmsQueue.CONSUMERS_KEY) == {'alive'}
+    assert fake_redis.llen(f"{SmsQueue.PROCESSING_PREFIX}alive") == 2
+    assert set(fake_redis.lrange(SmsQueue.QUEUE_KEY, 0, -1)) | \
+        set(fake_redis.lrange(f"{SmsQueue.PROCESSING_PREFIX}alive", 0, -1)) == set(ids)
+
+
+def test_recover_does_not_scan_the_keyspace(fake_redis, monkeypatch):
+    def scan(*args, **kwargs):
+        raise AssertionError("recover() scanned the keyspace")
+
+    monkeypatch.setattr(fake_redis, 'scan_iter', scan)
+    monkeypatch.setattr(fake_redis, 'scan', scan)
+    assert SmsDispatcher(SmsQueue(), gateway=ConsoleGateway()).recover() == 0
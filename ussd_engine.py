@@ -0,0 +1,145 @@
+"""
+Afya USSD Session Engine
+Stateful USSD sessions that process only the input added since the last hop
+
+Telcos resend the whole cumulative text (1*<pin>*3*0240234567*...) on every
+hop. The engine keeps each session's node in the menu tree, its form fields
+and the identity accepted at the PIN hop in the session hash, so a hop costs
+one Redis read, a step for each new segment, the handler and one pipelined
+write, however deep the session is.
+
+The PIN is checked once, on the hop it is entered, and is never stored:
+the session keeps only the length and a keyed hash of the text it has
+processed. Nodes below the PIN run only with the identity that check
+produced; the PIN echoed in later text is never trusted. A resent hop
+replays the stored screen instead of repeating its work. When the stored
+state is missing or does not match (expired, another phone, text that does not extend it) the
+whole text is walked from the root, which checks the PIN again.
+"""
+import hmac
+import json
+import hashlib
+import logging
+import redis
+from flask import Response
+
+log = logging.getLogger('afya.ussd')
+
+
+class SessionEngine:
+    """Advance a USSD session by the segments appended since its last hop"""
+
+    SEPARATOR = '*'
+    CONTENT_TYPE = 'text/plain'
+
+    def __init__(self, session, router, authenticate, denied,
+                 secret='pin', identity='provider'):
+        self.session = session
+        self.router = router
+        self.authenticate = authenticate  # (phone, secret) -> identity dict or None
+        self.denied = denied              # handler for protected nodes without one
+        self.secret = secret              # capture checked by authenticate
+        self.identity = identity          # argument the identity is passed as
+        self.key = b''
+
+        # The secret's node and everything under it see the identity;
+        # everything strictly under it requires one
+        self.guarded, self.protected = set(), set()
+        self._mark(router.root, False)
+
+    def init_app(self, app):
+        """Hash processed text with the app's secret key"""
+        self.key = app.config['SECRET_KEY'].encode()
+        app.extensions['ussd_engine'] = self
+
+    def _digest(self, text):
+        return hmac.new(self.key, text.encode(), hashlib.sha256).hexdigest()
+
+    def _mark(self, node, below_secret):
+        if below_secret:
+            self.guarded.add(node)
+            self.protected.add(node)
+        elif node.capture == self.secret:
+            self.guarded.add(node)
+        below = below_secret or node.capture == self.secret
+        for child in node.children.values():
+            self._mark(child, below)
+        if node.wildcard is not None:
+            self._mark(node.wildcard, below)
+
+    def handle(self, session_id, phone_number, text):
+        """Response for one hop of session_id"""
+        state = self._load(session_id)
+        if state.get('phone') != phone_number:
+            state = {}
+        node = self.router.nodes.get(state.get('node'))
+        length = int(state.get('length') or 0)
+
+        if node is not None and len(text) == length and state.get('screen') \
+                and hmac.compare_digest(self._digest(text), state.get('digest', '')):
+            # The telco resent the last hop: answer it again without redoing it
+            return Response(state['screen'], 200, content_type=self.CONTENT_TYPE)
+
+        if node is not None and length == 0 and text:
+            segments = text.split(self.SEPARATOR)
+        elif node is not None and len(text) > length and text[length] == self.SEPARATOR \
+                and hmac.compare_digest(self._digest(text[:length]), state.get('digest', '')):
+            segments = text[length + 1:].split(self.SEPARATOR)
+        else:
+            node, state = self.router.root, {}
+            segments = text.split(self.SEPARATOR) if text else []
+
+        fields = json.loads(state['fields']) if state.get('fields') else {}
+        identity = json.loads(state['identity']) if state.get('identity') else None
+        secret = None
+
+        for segment in segments:
+            child = node.children.get(segment) or node.wildcard
+            if child is None:
+                return self.router.fallback(session_id)
+            if child.capture == self.secret:
+                identity = self.authenticate(phone_number, segment)
+                secret = segment
+            elif child.capture:
+                fields[child.capture] = segment
+            node = child
+
+        if node.handler is None:
+            return self.router.fallback(session_id)
+        if node in self.protected and identity is None:
+            return self.denied(session_id)
+
+        arguments = dict(fields)
+        if node in self.guarded:
+            arguments[self.identity] = identity
+        if node.capture == self.secret:
+            arguments[self.secret] = secret
+        response = node.handler(session_id, phone_number, **arguments)
+
+        self._store(session_id, {
+            'phone': phone_number or '',
+            'length': len(text),
+            'digest': self._digest(text),
+            'node': node.key,
+            'fields': json.dumps(fields),
+            'identity': json.dumps(identity) if identity else '',
+            'screen': response.get_data(as_text=True)
+        })
+        return response
+
+    def _load(self, session_id):
+        if not session_id:
+            return {}
+        try:
+            return self.session.load_state(session_id)
+        except redis.RedisError as e:
+            log.warning("USSD session read error: %s", e)
+            return {}
+
+    def _store(self, session_id, state):
+        if not session_id:
+            return
+        try:
+            self.session.store_state(session_id, state)
+        except redis.RedisError as e:
+            log.warning("USSD session write error: %s", e)
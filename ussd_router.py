@@ -0,0 +1,101 @@
+"""
+Afya USSD Router
+Declarative menu tree compiled once into a dispatch table
+"""
+
+_NO_CAPTURES = {}
+
+
+class MenuNode:
+    """A compiled node of the USSD menu tree"""
+
+    __slots__ = ('key', 'handler', 'children', 'wildcard', 'capture')
+
+    def __init__(self, key):
+        self.key = key          # Route pattern, e.g. "1*<pin>*1"
+        self.handler = None     # Bound handler, set for routable nodes
+        self.children = {}      # Literal input -> MenuNode
+        self.wildcard = None    # MenuNode for free-form input
+        self.capture = None     # Argument name for a wildcard node
+
+
+class MenuRouter:
+    """Resolve cumulative USSD text to a handler in a single lookup
+
+    Routes are declared as patterns joined with '*', the same separator the
+    telco uses. Segments written as <name> match any free-form input (PINs,
+    phone numbers) and are passed to the handler as keyword arguments.
+    Fully literal routes are also flattened into a dict keyed by the raw
+    text, so the common menu hops go straight to their handler without
+    splitting the input.
+    """
+
+    SEPARATOR = '*'
+
+    def __init__(self, routes, target, fallback='invalid_selection'):
+        self.root = MenuNode('')
+        self.static = {}
+        self.handlers = {}      # Literal text -> bound handler
+        self.nodes = {}
+        self.fallback = getattr(target, fallback)
+        self._compile(routes, target)
+
+    def _compile(self, routes, target):
+        for pattern, handler_name in routes.items():
+            handler = getattr(target, handler_name)
+            node = self.root
+            segments = pattern.split(self.SEPARATOR) if pattern else []
+
+            for depth, segment in enumerate(segments):
+                key = self.SEPARATOR.join(segments[:depth + 1])
+                if segment.startswith('<') and segment.endswith('>'):
+                    if node.wildcard is None:
+                        node.wildcard = MenuNode(key)
+                        node.wildcard.capture = segment[1:-1]
+                    elif node.wildcard.capture != segment[1:-1]:
+                        raise ValueError(
+                            f"Conflicting wildcard names under '{node.key}'")
+                    node = node.wildcard
+                else:
+                    node = node.children.setdefault(segment, MenuNode(key))
+
+            node.handler = handler
+            self.nodes[pattern] = node
+
+            if '<' not in pattern:
+                self.static[pattern] = node
+                self.handlers[pattern] = handler
+
+    def resolve(self, text):
+        """Return (node, captured arguments) or (None, {}) when unrouted"""
+        node = self.static.get(text)
+        if node is not None:
+            return node, _NO_CAPTURES
+        return self._walk(text)
+
+    def _walk(self, text):
+        node = self.root
+        captures = {}
+        for segment in text.split(self.SEPARATOR):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.wildcard
+                if child is None:
+                    return None, _NO_CAPTURES
+                captures[child.capture] = segment
+            node = child
+
+        if node.handler is None:
+            return None, _NO_CAPTURES
+        return node, captures
+
+    def dispatch(self, text, session_id, phone_number):
+        """Run the handler for text, falling back to an invalid selection"""
+        handler = self.handlers.get(text)
+        if handler is not None:
+            return handler(session_id, phone_number)
+
+        node, captures = self._walk(text)
+        if node is None:
+            return self.fallback(session_id)
+        return node.handler(session_id, phone_number, **captures)
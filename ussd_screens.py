@@ -0,0 +1,32 @@
+"""
+Afya USSD Screens
+Registry of static screens rendered once and served from prebuilt bytes
+"""
+from flask import Response
+
+
+class ScreenRegistry:
+    """Prebuilt USSD response bodies keyed by screen name"""
+
+    PREFIXES = ('CON', 'END')
+    CONTENT_TYPE = 'text/plain'
+
+    def __init__(self):
+        self.bodies = {}
+
+    def register(self, name, prefix, text):
+        """Render a screen once, including its CON/END prefix"""
+        if prefix not in self.PREFIXES:
+            raise ValueError(f"Unknown USSD prefix for screen '{name}': {prefix}")
+        self.bodies[name] = f"{prefix} {text}".encode('utf-8')
+
+    def body(self, name):
+        """Raw response bytes for a registered screen"""
+        return self.bodies[name]
+
+    def respond(self, name):
+        """Wrap the prebuilt bytes in a response without re-rendering"""
+        return Response(self.bodies[name], 200, content_type=self.CONTENT_TYPE)
+
+    def __contains__(self, name):
+        return name in self.bodies
@@ -0,0 +1,179 @@
+"""
+Afya Write Queue
+One writer thread per process that runs small writes in group commits
+
+Request threads hand a write (a function that changes db.session and
+returns plain values) to the queue and wait for its result. The writer
+takes whatever has queued up within WRITE_BATCH_WAIT seconds, up to
+WRITE_BATCH_SIZE writes, runs each in its own SAVEPOINT and commits them
+all at once. On SQLite that is one write lock and one fsync per batch
+instead of per request, and the transaction starts with BEGIN IMMEDIATE,
+so it waits its turn instead of failing "database is locked" halfway.
+
+A write that raises is rolled back to its savepoint and the error is
+raised in the caller; the others in the batch still commit. With the
+queue off (the default outside SQLite) run() calls the write and commits
+in the caller's own session, still with BEGIN IMMEDIATE under SQLITE_MODE.
+"""
+import os
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from db_routing import primary
+
+log = logging.getLogger('afya.writes')
+
+
+class WriteQueue:
+    """Group-committing single writer for db.session writes"""
+
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = None
+        self.enabled = False
+        self.queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+
+        # Counters exposed through stats()
+        self.writes = 0
+        self.failed = 0
+        self.batches = 0
+        self.largest = 0
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Read the WRITE_* settings"""
+        self.app = app
+        self.db = db
+        self.enabled = app.config.get('WRITE_QUEUE_ENABLED', False)
+        self.batch_size = app.config.get('WRITE_BATCH_SIZE', 100)
+        self.batch_wait = app.config.get('WRITE_BATCH_WAIT', 0.002)
+        self.timeout = app.config.get('WRITE_TIMEOUT', 30)
+        self.immediate = app.config.get('SQLITE_MODE', False)
+        app.extensions['write_queue'] = self
+
+    def run(self, write, *args, **kwargs):
+        """Run write(*args, **kwargs) in a committed transaction; returns its result"""
+        if not self.enabled:
+            session = self.db.session
+            try:
+                if self.immediate:
+                    # A read transaction cannot safely become a write in WAL
+                    # (SQLITE_BUSY_SNAPSHOT); end it and take the lock first
+                    session.commit()
+                    session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+                with primary():
+                    result = write(*args, **kwargs)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            self._count('writes')
+            return result
+
+        result = self.submit(write, *args, **kwargs).result(self.timeout)
+        router = self.app.extensions.get('db_router')
+        if router is not None:
+            router.wrote()  # this browser reads its own write next
+        return result
+
+    def submit(self, write, *args, **kwargs):
+        """Queue a write; returns a Future for its result"""
+        self._ensure_worker()
+        future = Future()
+        self.queue.put((future, write, args, kwargs))
+        return future
+
+    def stats(self):
+        """Counters for /health"""
+        return {
+            'enabled': self.enabled,
+            'queued': self.queue.qsize(),
+            'writes': self.writes,
+            'failed': self.failed,
+            'batches': self.batches,
+            'largest_batch': self.largest,
+            'writes_per_batch': round(self.writes / self.batches, 2) if self.batches else None
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    # Writer thread
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so start lazily in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            self._worker = threading.Thread(
+                target=self._run, name='afya-write-queue', daemon=True)
+            self._worker.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+            except Exception as e:
+                log.error("Write queue error: %s", e)
+                for future, *_ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _next_batch(self):
+        # The first write, then whatever else arrives within batch_wait
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        results = []
+        with self.app.app_context(), primary():
+            session = self.db.session
+            try:
+                session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+                for future, write, args, kwargs in batch:
+                    try:
+                        with session.begin_nested():
+                            results.append((future, write(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                results = [(future, None, error or e) for future, _, error in results]
+                results += [(future, None, e) for future, *_ in batch[len(results):]]
+            finally:
+                session.remove()
+
+        failed = sum(error is not None for _, _, error in results)
+        with self._lock:
+            self.writes += len(results) - failed
+            self.failed += failed
+            self.batches += 1
+            self.largest = max(self.largest, len(results))
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)